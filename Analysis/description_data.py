@@ -0,0 +1,194 @@
+'''
+Training data for the description generation model.
+
+The cleaned corpus is encoded once into a file of uint8 character codes (one byte per
+character), which is memory-mapped for training.  Training windows are strided views
+into the mapped file rather than copies, so memory use doesn't grow with the corpus.
+'''
+import json
+import math
+import re
+
+import numpy as np
+import sqlalchemy
+
+BAD_CHAR_REGEX = re.compile(r'[^-a-zA-Z0-9 !.,?\n:()]')
+MULTI_SPACES_REGEX = re.compile(r'(\s){2,}')
+
+# Descriptions of games (not DLC) with metacritic scores, dropping the shortest and
+# longest 1%.  Limiting to games with metacritic scores cuts out a lot of the tiny indie
+# games with broken English in their descriptions.
+DESCRIPTION_QUERY = '''
+WITH filtered_games AS (
+  SELECT *
+  FROM game_crawl_view
+  WHERE is_dlc = FALSE
+    AND game_name IS NOT NULL
+    AND metacritic_score IS NOT NULL
+),
+lower_length_limit AS (
+  SELECT percentile_cont(0.01) WITHIN GROUP (ORDER BY length(long_description)) AS lower_limit
+    FROM filtered_games
+),
+upper_length_limit AS (
+  SELECT percentile_cont(0.99) WITHIN GROUP (ORDER BY length(long_description)) AS upper_limit
+    FROM filtered_games
+)
+SELECT long_description
+FROM filtered_games
+WHERE length(long_description)
+  BETWEEN (SELECT lower_limit FROM lower_length_limit)
+    AND (SELECT upper_limit FROM upper_length_limit)
+ORDER BY random()
+LIMIT :limit
+'''
+
+# Number of characters to process at a time when encoding the corpus
+CHUNK_SIZE = 1 << 24
+
+
+def clean_description(description):
+    filtered_description = BAD_CHAR_REGEX.sub('', description)
+    # Replace two or more spaces with one space
+    filtered_description = MULTI_SPACES_REGEX.sub(r'\1\1', filtered_description)
+    return filtered_description
+
+
+def stream_descriptions(db, *, limit=None):
+    '''
+    Generate the descriptions to train on from the database, in random order, without
+    loading them all into memory.
+    '''
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        for row in conn.execute(sqlalchemy.text(DESCRIPTION_QUERY), {'limit': limit}):
+            yield row[0]
+    finally:
+        conn.close()
+
+
+def _metadata_path(path):
+    return '{}.json'.format(path)
+
+
+def build_dataset(descriptions, path):
+    '''
+    Clean the given descriptions, join them with newlines, and encode the result into
+    a dataset at the given path.  The vocabulary is every character that appears in the
+    cleaned corpus.
+
+    Return value: the DescriptionDataset
+    '''
+    # Cleaned descriptions are plain ASCII, so write the raw bytes first, counting
+    # characters as we go; then we know the vocabulary and can map the bytes to
+    # character codes in place
+    counts = np.zeros(256, dtype=np.int64)
+    with open(path, 'wb') as f:
+        for i, description in enumerate(descriptions):
+            encoded = (('\n' if i > 0 else '') + clean_description(description)).encode('ascii')
+            counts += np.bincount(np.frombuffer(encoded, dtype=np.uint8), minlength=256)
+            f.write(encoded)
+
+    byte_values = np.flatnonzero(counts)
+    chars = [chr(b) for b in byte_values]
+    lookup = np.zeros(256, dtype=np.uint8)
+    lookup[byte_values] = np.arange(len(byte_values))
+
+    n_chars = int(counts.sum())
+    if n_chars > 0:
+        data = np.memmap(path, dtype=np.uint8, mode='r+')
+        for start in range(0, n_chars, CHUNK_SIZE):
+            chunk = data[start:start + CHUNK_SIZE]
+            chunk[:] = lookup[chunk]
+        data.flush()
+        del data
+
+    with open(_metadata_path(path), 'w') as f:
+        json.dump({'chars': chars, 'n_chars': n_chars}, f)
+
+    return DescriptionDataset(path)
+
+
+def _affine_permutation(n, rng):
+    '''
+    Return (a, b) such that i -> (a * i + b) % n shuffles range(n), without having
+    to hold a permutation of every index in memory.
+    '''
+    if n <= 1:
+        return 1, 0
+    while True:
+        a = int(rng.randint(1, n))
+        if math.gcd(a, n) == 1:
+            return a, int(rng.randint(0, n))
+
+
+class DescriptionDataset:
+    '''
+    An encoded corpus on disk (see build_dataset()), memory-mapped read-only.
+    '''
+
+    def __init__(self, path):
+        with open(_metadata_path(path)) as f:
+            metadata = json.load(f)
+
+        self.chars = metadata['chars']
+        self.n_chars = metadata['n_chars']
+        self.char_to_int = {c: i for i, c in enumerate(self.chars)}
+        self.n_vocab = len(self.chars)
+        if self.n_chars > 0:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            # Can't map an empty file
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def encode(self, text):
+        return np.array([self.char_to_int[c] for c in text], dtype=np.uint8)
+
+    def decode(self, codes):
+        return ''.join(self.chars[c] for c in codes)
+
+    def transform(self, codes):
+        '''
+        Convert (..., seq_length) character codes to model input of shape
+        (..., seq_length, 1), normalized to [0, 1).
+        '''
+        return (np.asarray(codes, dtype=np.float32) / self.n_vocab)[..., np.newaxis]
+
+    def one_hot(self, codes):
+        return np.eye(self.n_vocab, dtype=np.float32)[codes]
+
+    def num_windows(self, seq_length, step=1):
+        return max(0, math.ceil((self.n_chars - seq_length) / step))
+
+    def windows(self, seq_length, step=1):
+        '''
+        Return a (num windows, seq_length + 1) view of the corpus; each row is an input
+        sequence followed by the character that comes after it.  Nothing is copied.
+        '''
+        return np.lib.stride_tricks.as_strided(
+            self.data, shape=(self.num_windows(seq_length, step), seq_length + 1),
+            strides=(step * self.data.strides[0], self.data.strides[0]), writeable=False)
+
+    def steps_per_epoch(self, seq_length, batch_size, step=1):
+        return math.ceil(self.num_windows(seq_length, step) / batch_size)
+
+    def batches(self, seq_length, batch_size, *, step=1, shuffle=True, seed=None):
+        '''
+        Generate (X, y) training batches forever, for Keras' fit_generator (use
+        steps_per_epoch() with the same arguments for the number of batches per epoch).
+        X is the transformed input sequences and y the one-hot encoded next characters.
+
+        Each epoch goes through every window once, in a new order if shuffle is True.
+        Only one batch is in memory at a time.
+        '''
+        windows = self.windows(seq_length, step)
+        n = len(windows)
+        rng = np.random.RandomState(seed)
+
+        while True:
+            a, b = _affine_permutation(n, rng) if shuffle else (1, 0)
+            for start in range(0, n, batch_size):
+                positions = np.arange(start, min(start + batch_size, n), dtype=np.int64)
+                # Reading the windows in file order is kinder to the page cache
+                batch = windows[np.sort((a * positions + b) % n)]
+                yield self.transform(batch[:, :-1]), self.one_hot(batch[:, -1])
@@ -0,0 +1,114 @@
+'''
+Generate descriptions from a trained description model.
+
+Every (seed, temperature) combination is generated together: each step runs one batched
+forward pass for all of them and samples all of their next characters at once.
+'''
+import argparse
+import os
+
+import numpy as np
+
+from description_data import DescriptionDataset
+
+DEFAULT_TEMPERATURES = (0.05, 0.1, 0.2, 0.5, 0.75, 1.0, 1.2)
+DEFAULT_NUM_CHARS = 1000
+
+# Keeps log() finite for characters the model gives zero probability
+EPSILON = 1e-8
+
+
+def sample(preds, temperatures, rng):
+    '''
+    Sample one character code per row of preds (probabilities, shape (batch, n_vocab)),
+    reweighting each row by its temperature (shape (batch,)).
+    '''
+    logits = np.log(np.maximum(preds, EPSILON)) / temperatures[:, np.newaxis]
+    # Subtract the max so low temperatures don't overflow exp()
+    weights = np.exp(logits - logits.max(axis=1, keepdims=True))
+    cumulative = np.cumsum(weights, axis=1)
+    thresholds = rng.uniform(size=len(preds)) * cumulative[:, -1]
+    return np.minimum((cumulative < thresholds[:, np.newaxis]).sum(axis=1), preds.shape[1] - 1)
+
+
+def generate(model, dataset, seeds, *, temperatures=DEFAULT_TEMPERATURES,
+             num_chars=DEFAULT_NUM_CHARS, rng=None):
+    '''
+    Generate num_chars characters following each of the seeds (arrays of character codes
+    as long as the model's input sequences) at each of the temperatures.
+
+    Return value: list of (seed index, temperature, generated text)
+    '''
+    rng = rng or np.random.RandomState()
+    seeds = np.asarray(seeds, dtype=np.uint8)
+    seq_length = seeds.shape[1]
+
+    # One row per (seed, temperature)
+    row_seeds = np.repeat(np.arange(len(seeds)), len(temperatures))
+    row_temperatures = np.tile(np.asarray(temperatures, dtype=np.float64), len(seeds))
+
+    # Each row's seed followed by the characters generated so far; the model's input at each
+    # step is a window sliding along the buffer, so nothing gets copied around
+    buffer = np.empty((len(row_seeds), seq_length + num_chars), dtype=np.uint8)
+    buffer[:, :seq_length] = seeds[row_seeds]
+
+    for i in range(num_chars):
+        preds = model.predict_on_batch(dataset.transform(buffer[:, i:i + seq_length]))
+        buffer[:, seq_length + i] = sample(preds, row_temperatures, rng)
+
+    return [(int(seed), float(temperature), dataset.decode(generated))
+            for seed, temperature, generated in zip(row_seeds, row_temperatures, buffer[:, seq_length:])]
+
+
+def random_seeds(dataset, seq_length, num_seeds, rng=None):
+    '''
+    Pick num_seeds random sequences from the corpus to start generating from.
+    '''
+    rng = rng or np.random.RandomState()
+    windows = dataset.windows(seq_length)
+    return windows[rng.randint(0, len(windows), size=num_seeds), :-1]
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Generate descriptions from a model checkpoint.')
+    parser.add_argument('checkpoint',
+                        help='Model checkpoint (ex. models/weights-improvement-31-1.6567.hdf5).')
+    parser.add_argument('--dataset', default=os.path.join('models', 'descriptions.bin'),
+                        help='Dataset the model was trained on, for its vocabulary and seeds.')
+    parser.add_argument('--temperatures', type=float, nargs='+', default=DEFAULT_TEMPERATURES,
+                        help='Temperatures to sample at.')
+    parser.add_argument('--num-seeds', type=int, default=1,
+                        help='Number of random seeds from the corpus to generate from.')
+    parser.add_argument('--num-chars', type=int, default=DEFAULT_NUM_CHARS,
+                        help='Number of characters to generate from each seed at each temperature.')
+    parser.add_argument('--random-seed', type=int,
+                        help='Seed for picking seeds and sampling, for repeatable output.')
+    parser.add_argument('--output',
+                        help='File to write samples to.  Defaults to the checkpoint with .samples.txt appended.')
+    args = parser.parse_args()
+
+    # Keras takes a while to import; no need to wait for it just to print usage
+    import keras
+
+    model = keras.models.load_model(args.checkpoint)
+    dataset = DescriptionDataset(args.dataset)
+    rng = np.random.RandomState(args.random_seed)
+
+    seq_length = model.input_shape[1]
+    seeds = random_seeds(dataset, seq_length, args.num_seeds, rng)
+    samples = generate(model, dataset, seeds, temperatures=args.temperatures,
+                       num_chars=args.num_chars, rng=rng)
+
+    output = args.output or '{}.samples.txt'.format(args.checkpoint)
+    with open(output, 'w') as f:
+        for seed_index, seed in enumerate(seeds):
+            f.write('Seed:\n{}\n'.format(dataset.decode(seed)))
+            for sample_seed, temperature, text in samples:
+                if sample_seed == seed_index:
+                    f.write('\nResult (diversity {}):\n{}\n'.format(temperature, text))
+            f.write('\n')
+    print('Wrote {} samples to {}'.format(len(samples), output))
+
+
+if __name__ == '__main__':
+    run()
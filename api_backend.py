@@ -0,0 +1,118 @@
+'''
+Get apps' full prices from the steam store's appdetails JSON API, many apps per request.
+
+The API has most of a store page's fields as a few KB of JSON, but it only gives out one
+app's full details per request, and it has no user tags or review summaries, so we'd
+still need the store page: two requests per app, more than just scraping the page.  The
+one thing it gives out for many apps at once is prices, which are also what the store
+page is worst at (see the README).  So with the api backend, apps are scraped from their
+store pages like with the http backend, and their full prices come from the API,
+PRICE_BATCH_SIZE apps per request.
+'''
+from crawl_metrics import NULL_SPAN
+from http_backend import REQUEST_TIMEOUT, THROTTLE_STATUS_CODES, Throttled, wait_for_rate_limit
+from store_parser import STORE_BASE_URL
+
+APPDETAILS_URL = '{}/api/appdetails'.format(STORE_BASE_URL)
+
+# Prices are in US dollars everywhere else
+API_PARAMS = {'cc': 'us', 'l': 'english'}
+
+# The only filter the API takes several app IDs with
+MULTI_APP_FILTER = 'price_overview'
+
+# Number of apps to look up the prices of per request.  Crawl workers claim this many apps
+# at a time so their prices can be looked up together; more means fewer requests, but
+# more apps held up behind each worker's slow pages.
+PRICE_BATCH_SIZE = 20
+
+
+def fetch_prices(session, app_ids, *, timeout=REQUEST_TIMEOUT):
+    '''
+    Fetch the full prices of the given apps with one request.
+
+    Return value: dict of app ID -> full price (see parse_price_overview()), or None if
+    steam has none for the app.  Only asking for prices, the API doesn't say whether an
+    app is free, so free apps get None too.
+    '''
+    app_ids = list(app_ids)
+    params = dict(API_PARAMS, appids=','.join(str(app_id) for app_id in app_ids), filters=MULTI_APP_FILTER)
+    response = session.get(APPDETAILS_URL, params=params, timeout=timeout)
+    if response.status_code in THROTTLE_STATUS_CODES:
+        retry_after = response.headers.get('Retry-After')
+        raise Throttled('Got status {} for prices of {} apps'.format(response.status_code, len(app_ids)),
+                        retry_after=int(retry_after) if retry_after and retry_after.isdigit() else None)
+    response.raise_for_status()
+
+    body = response.json()
+    # Steam answers with null when it's struggling (or quietly throttling us)
+    if body is None:
+        raise Throttled('Got no prices for {} apps'.format(len(app_ids)))
+
+    prices = {}
+    for app_id in app_ids:
+        app_details = body.get(str(app_id)) or {}
+        data = app_details.get('data') if app_details.get('success') else None
+        # Apps without a price get an empty list instead of an object
+        prices[app_id] = parse_price_overview(data) if isinstance(data, dict) else None
+    return prices
+
+
+def parse_price_overview(data):
+    '''
+    Return an app's full (not discounted) price from its details, 0 if it's free, or None
+    if it doesn't have one.
+    '''
+    if data.get('is_free'):
+        return 0
+    price_overview = data.get('price_overview')
+    if price_overview is None:
+        return None
+    # In cents
+    return price_overview['initial'] / 100
+
+
+class PriceLookup:
+    '''
+    Looks up the full prices of the apps a crawl worker is about to scrape, batch_size
+    apps per request.  Tell it which apps are coming up with expect(); the first time
+    one of their prices is needed, it's looked up along with the rest of theirs.
+
+    rate_limit is called before each request, if given (see
+    http_backend.wait_for_rate_limit()).
+
+    Not thread-safe; each crawl worker gets its own.
+    '''
+
+    def __init__(self, session, *, batch_size=PRICE_BATCH_SIZE, timeout=REQUEST_TIMEOUT, rate_limit=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        # Apps we'll be asked about which we haven't looked up yet
+        self._upcoming = []
+        # Prices we've looked up but haven't been asked for yet
+        self._prices = {}
+
+    def expect(self, app_ids):
+        '''
+        Note the apps we're about to be asked for the prices of, replacing the ones we
+        were told about before.  Prices looked up for any others are dropped, so if one
+        of them comes back later (ex. as a retry), its price is looked up again.
+        '''
+        self._upcoming = list(app_ids)
+        self._prices = {app_id: price for app_id, price in self._prices.items() if app_id in self._upcoming}
+
+    def full_price(self, app_id, span=NULL_SPAN):
+        '''
+        Return the app's full price (see fetch_prices()), timing the lookup, if there is
+        one, in the given crawl_metrics.Span.
+        '''
+        if app_id not in self._prices:
+            others = [other for other in self._upcoming if other != app_id and other not in self._prices]
+            batch = [app_id] + others[:self.batch_size - 1]
+            wait_for_rate_limit(self.rate_limit, span)
+            with span.phase('fetch_api'):
+                self._prices.update(fetch_prices(self.session, batch, timeout=self.timeout))
+            self._upcoming = [other for other in self._upcoming if other not in batch]
+        return self._prices.pop(app_id)
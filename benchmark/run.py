@@ -0,0 +1,354 @@
+'''
+Benchmark the crawler against the local store stand-in, so changes to the crawl hot
+path can be measured without hitting steam.
+
+Two benchmarks run:
+ - parse: parse each kind of page in the corpus repeatedly, timing each field's extraction
+ - crawl: run do_crawl() over a range of app IDs against the stand-in and a throwaway
+   Postgres database (given with --db-uri; its schema is reset!), timing each page
+   and each write to the database
+
+Results are printed and can be saved as JSON with --output; pass a previous run's
+results to --compare to flag regressions.  The stand-in is deterministic given the same
+options, so runs from different commits are comparable.
+
+Run from the repository root: python -m benchmark.run --db-uri postgresql://...
+'''
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import dataset
+import numpy as np
+from lxml import html as lxml_html
+
+import scrape
+import store_parser
+from benchmark.store_server import DEFAULT_PAGE_KB, StoreCorpus, StoreStandIn
+from crawl_metrics import CrawlMetrics, Span
+from crawl_writer import BATCH_SIZE, GAME_CRAWL_TABLE, CrawlWriter
+from db_utils import copy_rows
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_NUM_PAGES = 500
+DEFAULT_PARSE_REPEATS = 20
+# Fast enough that the stand-in's latency and the crawler itself are the bottleneck
+DEFAULT_REQUESTS_PER_SECOND = 1000
+
+# Metrics compared against a baseline, and whether bigger is better for each
+COMPARED_METRICS = {
+    ('parse', 'pages_per_second'): True,
+    ('crawl', 'pages_per_second'): True,
+    ('crawl', 'latency_p50'): False,
+    ('crawl', 'latency_p99'): False,
+    ('crawl', 'db_crawls_per_second'): True,
+}
+# Fraction by which a metric has to get worse to count as a regression
+DEFAULT_TOLERANCE = 0.1
+
+# What store_parser.extract_store_page names the phases extracting each field with
+FIELD_PHASE_PREFIX = 'field.'
+
+
+def git_revision():
+    '''
+    Return the current commit (with "-dirty" appended if there are uncommitted changes),
+    or None if we can't tell.
+    '''
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=REPO_DIR, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+def crawled_page(corpus, app_id):
+    '''
+    Return the (URL, HTML) the crawler ends up with for the app once it's through any
+    gates and redirects, or None if it never gets a page.
+    '''
+    kind = corpus.kind(app_id)
+    if kind == 'redirect_loop':
+        return None
+    elif kind == 'no_store_page':
+        return '{}/'.format(store_parser.STORE_BASE_URL), corpus.page('home.html')
+    return '{}/app/{}'.format(store_parser.STORE_BASE_URL, app_id), corpus.store_page(app_id)
+
+
+def benchmark_parse(corpus, repeats):
+    '''
+    Parse one page of each kind in the corpus repeats times, timing each step.
+
+    Return value: dict of results
+    '''
+    # One app of each kind
+    app_ids = {}
+    for app_id in range(1, len(corpus.kind_cycle) + 1):
+        app_ids.setdefault(corpus.kind(app_id), app_id)
+    pages = [(app_id, crawled_page(corpus, app_id)) for app_id in sorted(app_ids.values())]
+    pages = [(app_id, url, page.encode('utf-8')) for app_id, (url, page) in
+             ((app_id, page) for app_id, page in pages if page is not None)]
+
+    # Total seconds and number of pages for each step
+    step_times = {}
+
+    def record(step, seconds):
+        total, count = step_times.get(step, (0, 0))
+        step_times[step] = (total + seconds, count + 1)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for app_id, url, content in pages:
+            # Parse the same way the crawler does, and read the steps' times off the span
+            span = Span(app_id)
+            with span.phase('html'):
+                root = lxml_html.fromstring(content)
+            store_parser.extract_store_page(app_id, url, root, span=span)
+            for phase, seconds in span.phases.items():
+                # Fields are named without the prefix, to compare with older results
+                record(phase[len(FIELD_PHASE_PREFIX):] if phase.startswith(FIELD_PHASE_PREFIX) else phase,
+                       seconds)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'pages': len(pages) * repeats,
+        'seconds': elapsed,
+        'pages_per_second': len(pages) * repeats / elapsed,
+        # Mean microseconds per page each step ran on
+        'step_us': {step: total / count * 1e6 for step, (total, count) in step_times.items()},
+    }
+
+
+@contextlib.contextmanager
+def timed_method(cls, name, record):
+    '''
+    Within the context, call record(seconds, return value) after every call of the method.
+    Calls that raise are recorded with a return value of None.
+    '''
+    original = getattr(cls, name)
+
+    def timed(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = None
+        try:
+            result = original(self, *args, **kwargs)
+            return result
+        finally:
+            record(time.perf_counter() - start, result)
+
+    setattr(cls, name, timed)
+    try:
+        yield
+    finally:
+        setattr(cls, name, original)
+
+
+@contextlib.contextmanager
+def proxied_through(url):
+    '''
+    Within the context, send HTTP requests (from requests and Chrome) through the given proxy.
+    '''
+    names = ('http_proxy', 'HTTP_PROXY', 'no_proxy', 'NO_PROXY')
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ['http_proxy'] = os.environ['HTTP_PROXY'] = url
+    os.environ['no_proxy'] = os.environ['NO_PROXY'] = ''
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def reset_db(db, app_ids):
+    '''
+    Recreate the schema and fill in the list of apps.
+    '''
+    with open(os.path.join(REPO_DIR, 'reset_db.sql')) as f:
+        reset_sql = f.read()
+
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(reset_sql)
+        copy_rows(cursor, 'game', ('steam_app_id', 'game_name'),
+                  ((app_id, 'Benchmark Game {}'.format(app_id)) for app_id in app_ids))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def benchmark_crawl(db, stand_in, app_ids, *, backend, num_workers, requests_per_second, batch_size):
+    '''
+    Crawl the given app IDs from the stand-in into the database.
+
+    Return value: dict of results
+    '''
+    reset_db(db, app_ids)
+
+    page_seconds = []
+    flushes = []
+    metrics = CrawlMetrics()
+
+    with proxied_through(stand_in.proxy_url), \
+            timed_method(scrape.StoreScraper, 'scrape', lambda seconds, _: page_seconds.append(seconds)), \
+            timed_method(CrawlWriter, 'flush',
+                         lambda seconds, result: flushes.append((seconds, len(result[0]) if result else 0))):
+        start = time.perf_counter()
+        scrape.do_crawl(app_ids, db, backend=backend, num_workers=num_workers,
+                        requests_per_second=requests_per_second, batch_size=batch_size, metrics=metrics)
+        elapsed = time.perf_counter() - start
+
+    flush_seconds = sum(seconds for seconds, _ in flushes)
+    crawls_written = sum(written for _, written in flushes)
+    return {
+        'pages': len(page_seconds),
+        'seconds': elapsed,
+        'pages_per_second': len(page_seconds) / elapsed,
+        'latency_p50': float(np.percentile(page_seconds, 50)) if page_seconds else None,
+        'latency_p99': float(np.percentile(page_seconds, 99)) if page_seconds else None,
+        'flushes': len(flushes),
+        'crawls_written': crawls_written,
+        'db_seconds': flush_seconds,
+        'db_crawls_per_second': crawls_written / flush_seconds if flush_seconds > 0 else None,
+        'crawls_stored': db.query('SELECT count(*) AS n FROM {}'.format(GAME_CRAWL_TABLE)).next()['n'],
+        'served': dict(stand_in.stats),
+        'outcomes': dict(metrics.outcomes),
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    '''
+    Return a list of (metric, baseline value, new value) for every compared metric
+    that's more than tolerance worse than the baseline.
+    '''
+    regressions = []
+    for (section, metric), bigger_is_better in COMPARED_METRICS.items():
+        old = baseline.get(section, {}).get(metric)
+        new = results.get(section, {}).get(metric)
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if bigger_is_better else (change > tolerance):
+            regressions.append(('{}.{}'.format(section, metric), old, new))
+
+    old_steps = baseline.get('parse', {}).get('step_us', {})
+    for step, new in results.get('parse', {}).get('step_us', {}).items():
+        old = old_steps.get(step)
+        if old and (new - old) / old > tolerance:
+            regressions.append(('parse.step_us.{}'.format(step), old, new))
+
+    return regressions
+
+
+def print_results(results):
+    parse = results['parse']
+    print('Parse: {:.1f} pages/sec over {} pages'.format(parse['pages_per_second'], parse['pages']))
+    for step, us in parse['step_us'].items():
+        print('  {:<20} {:>10.1f} us/page'.format(step, us))
+
+    crawl = results.get('crawl')
+    if crawl is not None:
+        print('Crawl: {:.1f} pages/sec over {} pages ({:.1f}s)'.format(
+            crawl['pages_per_second'], crawl['pages'], crawl['seconds']))
+        if crawl['latency_p50'] is not None:
+            print('  per-page latency: p50 {:.1f} ms, p99 {:.1f} ms'.format(
+                crawl['latency_p50'] * 1000, crawl['latency_p99'] * 1000))
+        if crawl['db_crawls_per_second'] is not None:
+            print('  DB writes: {:.1f} crawls/sec ({} crawls in {} flushes, {:.2f}s)'.format(
+                crawl['db_crawls_per_second'], crawl['crawls_written'], crawl['flushes'], crawl['db_seconds']))
+        print('  served: {}'.format(', '.join('{} {}'.format(n, kind) for kind, n in sorted(crawl['served'].items()))))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmark the crawler against a local stand-in for the steam store.')
+    parser.add_argument('--db-uri',
+                        help='Throwaway Postgres database to crawl into.  ITS SCHEMA IS RESET.  '
+                        'The crawl benchmark is skipped without one.')
+    parser.add_argument('--pages', type=int, default=DEFAULT_NUM_PAGES,
+                        help='Number of apps to crawl.')
+    parser.add_argument('--parse-repeats', type=int, default=DEFAULT_PARSE_REPEATS,
+                        help='Number of times to parse each kind of page.')
+    parser.add_argument('--backend', choices=scrape.BACKENDS, default='http',
+                        help='Crawler backend to benchmark.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of crawl workers.')
+    parser.add_argument('--requests-per-second', type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help='Crawler rate limit.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Number of crawls to write to the database at a time.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the stand-in waits before serving each store page.')
+    parser.add_argument('--latency-jitter', type=float, default=0,
+                        help='Up to this many more seconds of random latency per store page.')
+    parser.add_argument('--throttle-rate', type=float,
+                        help='Store pages per second the stand-in serves before answering 429.')
+    parser.add_argument('--timeout-fraction', type=float, default=0,
+                        help='Fraction of store page requests the stand-in hangs on long enough '
+                        'for the crawler to time out.  Timed out apps are retried after the '
+                        'crawler\'s retry delay, which lengthens the run.')
+    parser.add_argument('--error-fraction', type=float, default=0,
+                        help='Fraction of store page requests answered with steam\'s error page.')
+    parser.add_argument('--page-kb', type=int, default=DEFAULT_PAGE_KB,
+                        help='Approximate size of each store page.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the stand-in\'s corpus layout and randomness.')
+    parser.add_argument('--output',
+                        help='Save results as JSON to this file.')
+    parser.add_argument('--compare',
+                        help='Results JSON from a previous run to check for regressions against.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction by which a metric has to get worse to count as a regression.')
+    args = parser.parse_args()
+
+    options = {name: value for name, value in vars(args).items()
+               if name not in ('db_uri', 'output', 'compare', 'tolerance')}
+    results = {'revision': git_revision(), 'options': options}
+
+    results['parse'] = benchmark_parse(StoreCorpus(page_kb=args.page_kb, seed=args.seed), args.parse_repeats)
+
+    if args.db_uri:
+        db = dataset.connect(args.db_uri, ensure_schema=False)
+        stand_in = StoreStandIn(latency=args.latency, latency_jitter=args.latency_jitter,
+                                throttle_rate=args.throttle_rate, timeout_fraction=args.timeout_fraction,
+                                error_fraction=args.error_fraction, page_kb=args.page_kb, seed=args.seed)
+        with stand_in:
+            results['crawl'] = benchmark_crawl(
+                db, stand_in, list(range(1, args.pages + 1)), backend=args.backend,
+                num_workers=args.workers, requests_per_second=args.requests_per_second,
+                batch_size=args.batch_size)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != options:
+            print('Warning: baseline was run with different options: {}'.format(baseline.get('options')),
+                  file=sys.stderr)
+
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for metric, old, new in regressions:
+            print('REGRESSION: {} went from {:.4g} to {:.4g} (baseline {})'.format(
+                metric, old, new, baseline.get('revision')), file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('No regressions against {}'.format(baseline.get('revision')))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,373 @@
+'''
+A local stand-in for the steam store, serving a fixed corpus of store pages so the
+crawler can be benchmarked without hitting steam.
+
+The server acts as an HTTP proxy for store.steampowered.com, so the crawler runs
+unchanged (same URLs, same gate cookies) with http_proxy pointed at it.  It also answers
+the store's appdetails API, with JSON based on a recorded response.  Which kind
+of page an app gets is a fixed function of its app ID, and latency, throttling, and
+hung requests are all driven by a seeded RNG, so runs are repeatable.
+'''
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from store_parser import STORE_BASE_URL
+from throttle import TokenBucket
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+
+# Kinds of store page in the corpus and how often each comes up, out of 100 apps
+KIND_WEIGHTS = (
+    ('game', 50),
+    ('dlc', 12),
+    ('sale', 10),
+    ('coming_soon', 6),
+    ('age_gated', 6),
+    ('nsfw_gated', 6),
+    ('region_locked', 4),
+    ('no_store_page', 4),
+    ('redirect_loop', 2),
+)
+
+# How the kinds of actual store pages differ from the plain game page
+STORE_PAGE_KINDS = {
+    'game': {},
+    'dlc': {'about': 'About This Content'},
+    'sale': {'purchase': '_purchase_sale.html'},
+    'coming_soon': {'purchase': '_purchase_coming_soon.html', 'release_date': 'Coming Soon'},
+    'age_gated': {},
+    'nsfw_gated': {},
+}
+
+# Real store pages are mostly boilerplate around the parts we care about; pad ours out
+# to about this size so parsing costs about the same
+DEFAULT_PAGE_KB = 250
+
+APP_PATH_REGEX = re.compile(r'^/(app|agecheck/app|agecheckset/app|mature/app)/(\d+)/?$')
+APPDETAILS_PATH = '/api/appdetails'
+
+# How the API's details for each kind of app differ from the recorded game's
+APP_DETAILS_KINDS = {
+    'game': {},
+    'dlc': {'type': 'dlc', 'fullgame': {'appid': '10', 'name': 'Benchmark Game 10'}},
+    'sale': {'price_overview': {'currency': 'USD', 'initial': 1499, 'final': 749, 'discount_percent': 50}},
+    'coming_soon': {'price_overview': None, 'release_date': {'coming_soon': True, 'date': 'Coming Soon'}},
+    'age_gated': {'required_age': 18},
+    'nsfw_gated': {'required_age': 18},
+}
+
+
+def _read_page(name):
+    with open(os.path.join(PAGES_DIR, name)) as f:
+        return f.read()
+
+
+class StoreCorpus:
+    '''
+    Renders the stand-in's pages.
+    '''
+
+    def __init__(self, *, page_kb=DEFAULT_PAGE_KB, seed=0):
+        self.templates = {name: _read_page(name) for name in os.listdir(PAGES_DIR)
+                          if name.endswith(('.html', '.json'))}
+
+        # Spread the kinds out over app IDs, the same way every time
+        self.kind_cycle = [kind for kind, weight in KIND_WEIGHTS for _ in range(weight)]
+        random.Random(seed).shuffle(self.kind_cycle)
+
+        # Enough related-app blocks to get each page to about page_kb
+        padding_block = self.templates['_padding.html']
+        num_blocks = max(0, page_kb * 1024 // len(padding_block.encode('utf-8')))
+        self.padding = ''.join(padding_block.replace('$PAD_ID', str(100000 + i)) for i in range(num_blocks))
+
+    def kind(self, app_id):
+        return self.kind_cycle[app_id % len(self.kind_cycle)]
+
+    def _layout(self, title, content):
+        return (self.templates['_layout.html']
+                .replace('$TITLE', title)
+                .replace('$CONTENT', content)
+                .replace('$PADDING', self.padding))
+
+    def store_page(self, app_id, kind=None):
+        '''
+        Return the HTML of the store page the given app has behind any gates.
+        '''
+        kind = kind or self.kind(app_id)
+        if kind == 'region_locked':
+            content = self.templates['region_locked.html']
+        else:
+            options = STORE_PAGE_KINDS[kind]
+            content = (self.templates['game.html']
+                       .replace('$PURCHASE', self.templates[options.get('purchase', '_purchase.html')])
+                       .replace('$ABOUT', options.get('about', 'About This Game'))
+                       .replace('$RELEASE_DATE', options.get('release_date', '21 Aug, 2012')))
+        return self._layout('Benchmark Game {} on Steam'.format(app_id),
+                            content.replace('$APP_ID', str(app_id)))
+
+    def page(self, name, app_id=0):
+        return self._layout('Welcome to Steam', self.templates[name].replace('$APP_ID', str(app_id)))
+
+    def app_details(self, app_id, kind=None):
+        '''
+        Return the API's details for the given app (the same as its store page), or None
+        if steam wouldn't have any.
+        '''
+        kind = kind or self.kind(app_id)
+        if kind not in APP_DETAILS_KINDS:
+            return None
+        details = json.loads(self.templates['appdetails.json']
+                             .replace('$APP_ID', str(app_id))
+                             .replace('$RELEASE_DATE', '21 Aug, 2012'))
+        for key, value in copy.deepcopy(APP_DETAILS_KINDS[kind]).items():
+            if value is None:
+                details.pop(key, None)
+            else:
+                details[key] = value
+        return details
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StoreStandIn:
+    '''
+    The stand-in server.  Use as a context manager, or call start() and stop().
+
+    Every store page request waits latency seconds (plus up to latency_jitter more).
+    Requests beyond throttle_rate per second (if given) get a 429 with a Retry-After.
+    timeout_fraction of store page requests hang for hang_seconds before responding,
+    to trip the crawler's request timeout.  error_fraction get steam's generic error page.
+
+    Counts of what was served are in stats.
+    '''
+
+    def __init__(self, *, latency=0, latency_jitter=0, throttle_rate=None, retry_after=1,
+                 timeout_fraction=0, hang_seconds=35, error_fraction=0, page_kb=DEFAULT_PAGE_KB,
+                 seed=0, port=0):
+        self.corpus = StoreCorpus(page_kb=page_kb, seed=seed)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_bucket = TokenBucket(throttle_rate, burst=max(1, throttle_rate)) if throttle_rate else None
+        self.retry_after = retry_after
+        self.timeout_fraction = timeout_fraction
+        self.hang_seconds = hang_seconds
+        self.error_fraction = error_fraction
+        self.port = port
+
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def proxy_url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] = self.stats.get(stat, 0) + 1
+
+    def random(self):
+        with self._rng_lock:
+            return self._rng.random()
+
+    def start(self):
+        stand_in = self
+
+        class Handler(_StoreRequestHandler):
+            server_stand_in = stand_in
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _StoreRequestHandler(BaseHTTPRequestHandler):
+    server_stand_in = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Don't spam stderr with every request
+        pass
+
+    def _cookies(self):
+        cookie = SimpleCookie()
+        cookie.load(self.headers.get('Cookie', ''))
+        return {name: morsel.value for name, morsel in cookie.items()}
+
+    def _send(self, status, body=b'', headers=(), content_type='text/html; charset=utf-8'):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def _send_page(self, html):
+        body = html.encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.server_stand_in.count('not_modified')
+            self._send(304, headers=[('ETag', etag)])
+        else:
+            self._send(200, body, headers=[('ETag', etag)])
+
+    def _redirect(self, path, cookies=()):
+        headers = [('Location', '{}{}'.format(STORE_BASE_URL, path))]
+        headers += [('Set-Cookie', '{}={}; Path=/'.format(name, value)) for name, value in cookies]
+        self._send(302, headers=headers)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        # Drain the form so the connection can be reused
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._handle()
+
+    def _throttle_and_delay(self):
+        '''
+        Slow down a request the way steam would.
+
+        Return value: whether the request should go on (False if it was throttled)
+        '''
+        stand_in = self.server_stand_in
+        if stand_in.throttle_bucket is not None and not stand_in.throttle_bucket.try_acquire():
+            stand_in.count('throttled')
+            self._send(429, b'Too many requests', headers=[('Retry-After', str(stand_in.retry_after))])
+            return False
+
+        if stand_in.random() < stand_in.timeout_fraction:
+            stand_in.count('hung')
+            time.sleep(stand_in.hang_seconds)
+        elif stand_in.latency or stand_in.latency_jitter:
+            time.sleep(stand_in.latency + stand_in.latency_jitter * stand_in.random())
+        return True
+
+    def _handle_app_details(self, query):
+        stand_in = self.server_stand_in
+        params = parse_qs(query)
+        try:
+            app_ids = [int(app_id) for app_id in params['appids'][0].split(',')]
+        except (KeyError, ValueError):
+            self._send(400, b'Bad request')
+            return
+        filters = params.get('filters', [None])[0]
+        if len(app_ids) > 1 and filters != 'price_overview':
+            # Steam won't give full details for more than one app at a time
+            self._send(400, b'Bad request')
+            return
+
+        if not self._throttle_and_delay():
+            return
+
+        if stand_in.random() < stand_in.error_fraction:
+            stand_in.count('error')
+            body = None
+        else:
+            stand_in.count('app_details')
+            body = {}
+            for app_id in app_ids:
+                details = stand_in.corpus.app_details(app_id)
+                if details is None:
+                    body[str(app_id)] = {'success': False}
+                elif filters is not None:
+                    # Apps with none of the filtered fields get an empty list
+                    body[str(app_id)] = {'success': True, 'data': {
+                        key: details[key] for key in filters.split(',') if key in details} or []}
+                else:
+                    body[str(app_id)] = {'success': True, 'data': details}
+
+        self._send(200, json.dumps(body).encode('utf-8'), content_type='application/json; charset=utf-8')
+
+    def _handle(self):
+        stand_in = self.server_stand_in
+        corpus = stand_in.corpus
+        # As a proxy we get absolute URLs; also accept plain paths for poking at it directly
+        url = urlsplit(self.path)
+        path = url.path
+
+        if path in ('', '/'):
+            stand_in.count('home')
+            self._send_page(corpus.page('home.html'))
+            return
+        elif path == APPDETAILS_PATH:
+            self._handle_app_details(url.query)
+            return
+
+        match = APP_PATH_REGEX.match(path)
+        if match is None:
+            stand_in.count('not_found')
+            self._send(404, b'Not found')
+            return
+        route, app_id = match.group(1), int(match.group(2))
+
+        if route == 'agecheck/app':
+            stand_in.count('age_gate')
+            self._send_page(corpus.page('age_gate.html', app_id))
+            return
+        elif route == 'agecheckset/app':
+            self._redirect('/app/{}/'.format(app_id), cookies=[('birthtime', '725875201'),
+                                                               ('lastagecheckage', '1-January-1993')])
+            return
+        elif route == 'mature/app':
+            self._redirect('/app/{}/'.format(app_id), cookies=[('mature_content', '1')])
+            return
+
+        # Store pages (and the API) are what the crawler is rate limited on, so that's
+        # where we slow it down
+        if not self._throttle_and_delay():
+            return
+
+        if stand_in.random() < stand_in.error_fraction:
+            stand_in.count('error')
+            self._send_page(corpus.page('error.html', app_id))
+            return
+
+        kind = corpus.kind(app_id)
+        cookies = self._cookies()
+        stand_in.count(kind)
+        try:
+            if kind == 'no_store_page':
+                self._redirect('/')
+            elif kind == 'redirect_loop':
+                self._redirect('/app/{}/'.format(app_id))
+            elif kind == 'age_gated' and 'birthtime' not in cookies:
+                self._redirect('/agecheck/app/{}/'.format(app_id))
+            elif kind == 'nsfw_gated' and 'mature_content' not in cookies:
+                # Steam shows this one in place of the store page
+                self._send_page(corpus.page('nsfw_gate.html', app_id))
+            else:
+                self._send_page(corpus.store_page(app_id, kind))
+        except (BrokenPipeError, ConnectionResetError):
+            # The crawler gave up on us (ex. after we hung)
+            pass
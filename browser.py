@@ -0,0 +1,258 @@
+'''
+Chrome for selenium crawls, set up to load store pages as cheaply as possible and to
+keep going over multi-day crawls.
+
+Chrome runs headless, skips images, media, fonts and third-party trackers, and stops
+waiting on pages once their HTML is ready.  ManagedDriver restarts it every so many
+pages (or once it's using too much memory, since it leaks over long runs) and whenever
+it crashes, so one bad page can't take down the rest of the crawl.
+'''
+import http.client
+import os
+import sys
+import urllib.error
+
+from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+
+from crawl_metrics import NULL_SPAN
+from http_backend import USER_AGENT
+
+# Seconds to wait for a page (or a script on it) before giving up with a TimeoutException
+PAGE_LOAD_TIMEOUT = 30
+SCRIPT_TIMEOUT = 10
+
+# Restart the browser after this many pages...
+PAGES_PER_DRIVER = 500
+# ...or once it's using this much memory, checked every MEMORY_CHECK_INTERVAL pages
+MAX_DRIVER_MEMORY_MB = 1500
+MEMORY_CHECK_INTERVAL = 20
+
+# "eager" returns once the HTML is parsed, without waiting on images, iframes, etc.
+PAGE_LOAD_STRATEGY = 'eager'
+
+CHROME_ARGUMENTS = (
+    '--disable-gpu',
+    '--window-size=1280,1024',
+    '--mute-audio',
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--no-first-run',
+    # /dev/shm is tiny in containers, which makes Chrome crash on big pages
+    '--disable-dev-shm-usage',
+    '--blink-settings=imagesEnabled=false',
+    # Headless Chrome says so in its user agent; look like the HTTP backend instead
+    '--user-agent={}'.format(USER_AGENT),
+)
+
+# Content settings: 2 means "block"
+CHROME_PREFS = {
+    'profile.managed_default_content_settings.images': 2,
+    'profile.managed_default_content_settings.media_stream': 2,
+    'profile.managed_default_content_settings.plugins': 2,
+    'profile.managed_default_content_settings.popups': 2,
+    'profile.managed_default_content_settings.notifications': 2,
+}
+
+# Requests Chrome shouldn't bother making: images and fonts (in case the settings above
+# miss any), video, and third-party trackers.  Steam's own scripts are left alone,
+# since the gates need them.
+BLOCKED_URL_PATTERNS = (
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.ico', '*.svg',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.mp4', '*.webm', '*.m3u8', '*.mpd', '*.m4s',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*',
+    '*youtube.com*', '*ytimg.com*',
+)
+
+# Bits of the messages chromedriver gives when the browser's gone
+CRASH_MESSAGES = ('chrome not reachable', 'session deleted', 'tab crashed', 'invalid session id',
+                  'no such session', 'disconnected', 'target window already closed')
+
+
+def chrome_options(*, headless=True):
+    options = webdriver.ChromeOptions()
+    if headless:
+        options.add_argument('--headless')
+    for argument in CHROME_ARGUMENTS:
+        options.add_argument(argument)
+    options.add_experimental_option('prefs', CHROME_PREFS)
+    return options
+
+
+def _send_devtools_command(driver, command, params):
+    # Selenium doesn't know about chromedriver's endpoint for devtools commands; teach it
+    driver.command_executor._commands['send_devtools_command'] = (
+        'POST', '/session/$sessionId/chromium/send_command')
+    return driver.execute('send_devtools_command', {'cmd': command, 'params': params})
+
+
+def start_chrome(*, headless=True, page_load_timeout=PAGE_LOAD_TIMEOUT):
+    '''
+    Start Chrome, set up to load store pages as cheaply as possible.
+    '''
+    capabilities = DesiredCapabilities.CHROME.copy()
+    capabilities['pageLoadStrategy'] = PAGE_LOAD_STRATEGY
+    driver = webdriver.Chrome(chrome_options=chrome_options(headless=headless),
+                              desired_capabilities=capabilities)
+    driver.set_page_load_timeout(page_load_timeout)
+    driver.set_script_timeout(SCRIPT_TIMEOUT)
+
+    try:
+        _send_devtools_command(driver, 'Network.enable', {})
+        _send_devtools_command(driver, 'Network.setBlockedURLs', {'urls': list(BLOCKED_URL_PATTERNS)})
+    except WebDriverException as e:
+        # Older chromedrivers don't take devtools commands; the content settings still
+        # keep images out
+        print('Unable to block requests in Chrome; continuing without: {}'.format(e), file=sys.stderr)
+
+    return driver
+
+
+def _process_tree_rss_mb(root_pid):
+    '''
+    Return the total resident memory of the process and all its descendants in MB, or
+    None if we can't tell (i.e. we're not on Linux).  Memory shared between processes
+    is counted once per process, so this overestimates a bit.
+    '''
+    if not os.path.isdir('/proc'):
+        return None
+
+    parents = {}
+    rss_pages = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                stat = f.read()
+        except OSError:
+            # The process exited while we were looking
+            continue
+        # The command name can have spaces and parens in it; everything after it is
+        # space-separated, starting with the state and parent PID.  RSS is the 24th field.
+        fields = stat[stat.rfind(')') + 2:].split()
+        parents[int(entry)] = int(fields[1])
+        rss_pages[int(entry)] = int(fields[21])
+
+    tree = {root_pid}
+    # Parents can come after their children in /proc, so keep going until nothing's added
+    while True:
+        children = {pid for pid, parent in parents.items() if parent in tree} - tree
+        if len(children) == 0:
+            break
+        tree |= children
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return sum(rss_pages.get(pid, 0) for pid in tree) * page_size / 2 ** 20
+
+
+def driver_memory_mb(driver):
+    '''
+    Return how much memory chromedriver and the browser it's running are using in MB,
+    or None if we can't tell.
+    '''
+    try:
+        return _process_tree_rss_mb(driver.service.process.pid)
+    except AttributeError:
+        return None
+
+
+def is_crash(error):
+    '''
+    Whether an exception raised while driving the browser means it (or chromedriver) died.
+    '''
+    if isinstance(error, (TimeoutException, NoSuchElementException)):
+        return False
+    elif isinstance(error, WebDriverException):
+        message = (error.msg or '').lower()
+        return any(crash_message in message for crash_message in CRASH_MESSAGES)
+    # Can't talk to chromedriver at all
+    return isinstance(error, (ConnectionError, http.client.HTTPException, urllib.error.URLError))
+
+
+class ManagedDriver:
+    '''
+    A Chrome driver which is started when it's first needed, restarted every
+    pages_per_driver pages or once it uses more than max_memory_mb (checked every
+    memory_check_interval pages), and restarted if it crashes.
+
+    Not thread-safe; each crawl worker gets its own.
+    '''
+
+    def __init__(self, *, headless=True, pages_per_driver=PAGES_PER_DRIVER,
+                 max_memory_mb=MAX_DRIVER_MEMORY_MB, memory_check_interval=MEMORY_CHECK_INTERVAL,
+                 page_load_timeout=PAGE_LOAD_TIMEOUT):
+        self.headless = headless
+        self.pages_per_driver = pages_per_driver
+        self.max_memory_mb = max_memory_mb
+        self.memory_check_interval = memory_check_interval
+        self.page_load_timeout = page_load_timeout
+
+        self.driver = None
+        # Pages loaded by the current driver
+        self.pages = 0
+        self.restarts = 0
+        self.crashes = 0
+
+    def _start(self, span):
+        with span.phase('browser_start'):
+            self.driver = start_chrome(headless=self.headless, page_load_timeout=self.page_load_timeout)
+        self.pages = 0
+
+    def _quit(self):
+        driver, self.driver = self.driver, None
+        if driver is None:
+            return
+        try:
+            driver.quit()
+        except Exception:
+            # The browser's already gone; make sure chromedriver goes with it
+            try:
+                driver.service.stop()
+            except Exception:
+                pass
+
+    def _recycle_if_due(self):
+        reason = None
+        if self.pages >= self.pages_per_driver:
+            reason = 'after {} pages'.format(self.pages)
+        elif self.pages % self.memory_check_interval == 0:
+            memory_mb = driver_memory_mb(self.driver)
+            if memory_mb is not None and memory_mb > self.max_memory_mb:
+                reason = 'using {:.0f} MB'.format(memory_mb)
+
+        if reason is not None:
+            print('Restarting Chrome {}'.format(reason), file=sys.stderr)
+            self._quit()
+            self.restarts += 1
+
+    def run(self, function, span=NULL_SPAN):
+        '''
+        Return function(driver), starting the browser first if need be.  If the browser
+        crashes, it's restarted and the function is tried once more.
+        '''
+        for attempt in range(2):
+            if self.driver is None:
+                self._start(span)
+            try:
+                result = function(self.driver)
+                break
+            except Exception as e:
+                if not is_crash(e):
+                    self.pages += 1
+                    self._recycle_if_due()
+                    raise
+                self.crashes += 1
+                print('Chrome crashed ({}: {}); restarting'.format(type(e).__name__, e), file=sys.stderr)
+                self._quit()
+                if attempt > 0:
+                    raise
+
+        self.pages += 1
+        self._recycle_if_due()
+        return result
+
+    def close(self):
+        self._quit()
@@ -0,0 +1,320 @@
+'''
+Shared queue of crawl jobs in Postgres, so crawlers on several machines can split up
+the work without crawling the same apps.
+
+Apps are queued in the crawl_job table (see enqueue()).  Crawlers claim batches of
+pending jobs with SELECT ... FOR UPDATE SKIP LOCKED, so they never wait on or claim
+each other's jobs, and hold them under a lease they keep extending while they work.
+Finished jobs are marked done (or failed, once we've given up on the app).  If a crawler
+dies, its leases run out and the jobs go back to the queue, so at most one batch of
+work is lost.
+'''
+import os
+import socket
+import sys
+import threading
+import uuid
+
+from db_utils import copy_rows
+from retry_queue import RETRY_TABLE
+
+JOB_TABLE = 'crawl_job'
+
+# Number of jobs to claim at a time
+CLAIM_SIZE = 10
+# Seconds a claim lasts without a heartbeat
+LEASE_SECONDS = 5 * 60
+# Number of times a job's lease can run out before we decide the app is killing our
+# crawlers and give up on it
+MAX_LOST_LEASES = 3
+
+RECLAIM_QUERY = '''
+UPDATE {job_table}
+SET status = CASE WHEN lost_leases + 1 >= %(max_lost_leases)s THEN 'failed' ELSE 'pending' END,
+    lost_leases = lost_leases + 1,
+    last_error = CASE WHEN lost_leases + 1 >= %(max_lost_leases)s
+      THEN 'Lease expired ' || (lost_leases + 1) || ' times' ELSE last_error END,
+    finished_at = CASE WHEN lost_leases + 1 >= %(max_lost_leases)s THEN now() END,
+    lease_owner = NULL,
+    lease_expires = NULL
+WHERE status = 'leased'
+  AND lease_expires < now()
+RETURNING steam_app_id
+'''.format(job_table=JOB_TABLE)
+
+# Skip apps which failed recently enough that they aren't due for a retry (or which
+# we've given up on for now)
+CLAIM_QUERY = '''
+UPDATE {job_table} j
+SET status = 'leased',
+    lease_owner = %(owner)s,
+    lease_expires = now() + %(lease_seconds)s * interval '1 second',
+    claims = j.claims + 1
+FROM (
+  SELECT steam_app_id
+  FROM {job_table} c
+  WHERE status = 'pending'
+    AND NOT EXISTS (
+      SELECT 1
+      FROM {retry_table} cr
+      WHERE cr.steam_app_id = c.steam_app_id
+        AND cr.next_attempt > now()
+    )
+  ORDER BY priority DESC, steam_app_id DESC
+  LIMIT %(claim_size)s
+  FOR UPDATE SKIP LOCKED
+) claimable
+WHERE j.steam_app_id = claimable.steam_app_id
+RETURNING j.steam_app_id, j.priority
+'''.format(job_table=JOB_TABLE, retry_table=RETRY_TABLE)
+
+# Jobs already claimed keep their lease; anything else goes (back) to pending
+ENQUEUE_QUERY = '''
+INSERT INTO {job_table} (steam_app_id, priority)
+SELECT steam_app_id, priority
+FROM crawl_job_enqueue
+ON CONFLICT (steam_app_id) DO UPDATE
+  SET status = 'pending',
+      priority = EXCLUDED.priority,
+      enqueued_at = now(),
+      finished_at = NULL,
+      lost_leases = 0,
+      last_error = NULL
+  WHERE {job_table}.status <> 'leased'
+'''.format(job_table=JOB_TABLE)
+
+
+def default_owner():
+    '''
+    Return a name for this crawler that's unique across machines and runs.
+    '''
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class CrawlJobQueue:
+    '''
+    Claims crawl jobs from the shared queue on behalf of one crawler.  Iterate over it to
+    get app IDs to crawl, claiming claim_size at a time, until there's nothing left to claim.
+    Claimed jobs must be finished with complete(), release(), or fail().
+
+    Leases are extended in a background thread while the queue is open; close() stops it
+    and puts any jobs we claimed but didn't finish back in the queue.  Use as a context
+    manager, or call close() when done.
+
+    Thread-safe; uses its own database connection, so job updates never get mixed up
+    with crawl writes.
+    '''
+
+    def __init__(self, db, *, owner=None, claim_size=CLAIM_SIZE, lease_seconds=LEASE_SECONDS,
+                 max_lost_leases=MAX_LOST_LEASES):
+        self.owner = owner or default_owner()
+        self.claim_size = claim_size
+        self.lease_seconds = lease_seconds
+        self.max_lost_leases = max_lost_leases
+
+        self._conn = db.engine.raw_connection()
+        self._lock = threading.Lock()
+        # IDs of the apps whose jobs we hold
+        self._held = set()
+        self._closed = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._send_heartbeats, daemon=True)
+        self._heartbeat_thread.start()
+
+    def _execute(self, query, params=None):
+        '''
+        Run a query in its own transaction and return any rows it returned.
+        '''
+        with self._lock:
+            cursor = self._conn.cursor()
+            try:
+                cursor.execute(query, params)
+                rows = cursor.fetchall() if cursor.description is not None else []
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        return rows
+
+    def reclaim_expired(self):
+        '''
+        Put jobs whose leases have run out back in the queue (or fail them, if they've
+        run out too many times).
+
+        Return value: list of the reclaimed jobs' app IDs
+        '''
+        rows = self._execute(RECLAIM_QUERY, {'max_lost_leases': self.max_lost_leases})
+        reclaimed = [app_id for app_id, in rows]
+        with self._lock:
+            self._held.difference_update(reclaimed)
+        return reclaimed
+
+    def claim(self):
+        '''
+        Claim up to claim_size pending jobs, after reclaiming any expired leases.
+
+        Return value: list of the claimed app IDs, most important first
+        '''
+        reclaimed = self.reclaim_expired()
+        if len(reclaimed) > 0:
+            print('Reclaimed {} crawl jobs with expired leases'.format(len(reclaimed)), file=sys.stderr)
+
+        claimed = self._execute(CLAIM_QUERY, {
+            'owner': self.owner,
+            'lease_seconds': self.lease_seconds,
+            'claim_size': self.claim_size,
+        })
+        claimed.sort(key=lambda row: (row[1], row[0]), reverse=True)
+        app_ids = [app_id for app_id, _ in claimed]
+        with self._lock:
+            self._held.update(app_ids)
+        return app_ids
+
+    def __iter__(self):
+        while not self._closed.is_set():
+            app_ids = self.claim()
+            if len(app_ids) == 0:
+                return
+            yield from app_ids
+
+    def heartbeat(self):
+        '''
+        Extend the leases on all the jobs we hold.
+
+        Return value: set of app IDs whose jobs we turned out to have lost (because
+        our lease ran out and someone else reclaimed them)
+        '''
+        with self._lock:
+            held = list(self._held)
+        if len(held) == 0:
+            return set()
+
+        extended = self._execute('''
+        UPDATE {job_table}
+        SET lease_expires = now() + %(lease_seconds)s * interval '1 second'
+        WHERE steam_app_id = ANY(%(app_ids)s)
+          AND status = 'leased'
+          AND lease_owner = %(owner)s
+        RETURNING steam_app_id
+        '''.format(job_table=JOB_TABLE), {
+            'lease_seconds': self.lease_seconds,
+            'app_ids': held,
+            'owner': self.owner,
+        })
+
+        lost = set(held) - {app_id for app_id, in extended}
+        with self._lock:
+            # Jobs finished while we were extending them aren't lost
+            lost &= self._held
+            self._held -= lost
+        return lost
+
+    def _send_heartbeats(self):
+        # Extend well before leases run out, so a slow database doesn't cost us any
+        while not self._closed.wait(self.lease_seconds / 3):
+            try:
+                lost = self.heartbeat()
+                if len(lost) > 0:
+                    print('Lost the leases on {} crawl jobs; another crawler may crawl them too'.format(
+                        len(lost)), file=sys.stderr)
+            except Exception as e:
+                print('Failed to extend crawl job leases; continuing', file=sys.stderr)
+                print(repr(e), file=sys.stderr)
+
+    def _finish(self, app_ids, status, error=None):
+        app_ids = list(app_ids)
+        if len(app_ids) == 0:
+            return
+
+        # Only touch jobs we still hold; if we lost one, it's someone else's now
+        self._execute('''
+        UPDATE {job_table}
+        SET status = %(status)s,
+            finished_at = CASE WHEN %(status)s = 'pending' THEN NULL ELSE now() END,
+            last_error = %(last_error)s,
+            lease_owner = NULL,
+            lease_expires = NULL
+        WHERE steam_app_id = ANY(%(app_ids)s)
+          AND status = 'leased'
+          AND lease_owner = %(owner)s
+        '''.format(job_table=JOB_TABLE), {
+            'status': status,
+            'last_error': '{}: {}'.format(type(error).__name__, error) if error is not None else None,
+            'app_ids': app_ids,
+            'owner': self.owner,
+        })
+        with self._lock:
+            self._held.difference_update(app_ids)
+
+    def complete(self, app_ids):
+        '''
+        Mark the jobs for the given apps as done.
+        '''
+        self._finish(app_ids, 'done')
+
+    def release(self, app_ids):
+        '''
+        Put the jobs for the given apps back in the queue, ex. to be retried later.
+        '''
+        self._finish(app_ids, 'pending')
+
+    def fail(self, app_id, error):
+        '''
+        Mark the job for the given app as failed for good.
+        '''
+        self._finish([app_id], 'failed', error=error)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._heartbeat_thread.join()
+        with self._lock:
+            held = list(self._held)
+        self.release(held)
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def enqueue(db, apps):
+    '''
+    Add jobs to crawl the given apps (an iterable of (app ID, priority)) to the shared
+    queue.  Apps already queued get the new priority, and finished jobs are queued
+    again; jobs currently claimed by a crawler are left alone.
+
+    Return value: number of apps queued
+    '''
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        CREATE TEMPORARY TABLE crawl_job_enqueue (
+            steam_app_id int PRIMARY KEY,
+            priority double precision NOT NULL
+        ) ON COMMIT DROP
+        ''')
+        copy_rows(cursor, 'crawl_job_enqueue', ('steam_app_id', 'priority'), apps)
+        cursor.execute(ENQUEUE_QUERY)
+        num_queued = cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return num_queued
+
+
+def job_counts(db):
+    '''
+    Return the number of jobs in each status.
+    '''
+    return {row['status']: row['n'] for row in db.query(
+        'SELECT status, count(*) AS n FROM {} GROUP BY status'.format(JOB_TABLE))}
@@ -0,0 +1,281 @@
+'''
+Instrumentation for the crawler: where each app's time went, how each app turned out,
+and how the database writes are doing.
+
+Each app crawled gets a Span timing the phases of its crawl (waiting on the rate limit,
+fetching, clicking through gates, extracting each field, ...) and recording its outcome.
+CrawlMetrics aggregates spans into counters and histograms, which can be served in
+Prometheus' text format and/or logged as JSON lines, one per app and one per DB flush.
+'''
+import bisect
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds of the histogram buckets for durations, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_PREFIX = 'steam_crawl'
+
+
+class Span:
+    '''
+    Timing and outcome of crawling one app.  Only used by one thread at a time.
+    '''
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        # Seconds spent in each phase
+        self.phases = {}
+        self.outcome = None
+        self.duration = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Time the enclosed block as the given phase.  Phases entered more than once add up.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def set_outcome(self, outcome):
+        self.outcome = outcome
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+
+class _NullSpan:
+    '''
+    Stand-in for a Span when nobody's measuring.
+    '''
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def set_outcome(self, outcome):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CrawlMetrics:
+    '''
+    Aggregated metrics for a crawl.  Thread-safe.
+
+    If given a log_file (a writable text file), every finished span and DB flush is
+    also written to it as a line of JSON.
+    '''
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.start_time = time.time()
+
+        self._lock = threading.Lock()
+        # {outcome: count}
+        self.outcomes = {}
+        # {exception type name: count}
+        self.errors = {}
+        # {phase: histogram of seconds}
+        self._phases = {}
+        self._app_durations = _Histogram()
+        self._flush_durations = _Histogram()
+        self.crawls_written = 0
+        self.crawls_failed = 0
+        # {name: (help, function returning the current value)}
+        self._gauges = {}
+        self._server = None
+
+    def start_span(self, app_id):
+        return Span(app_id)
+
+    def finish_span(self, span, outcome=None, error=None):
+        '''
+        Record a finished span.  The outcome overrides any the span already has; if
+        the crawl failed, pass the exception as error.
+        '''
+        span.finish()
+        if outcome is not None:
+            span.set_outcome(outcome)
+        error_type = type(error).__name__ if error is not None else None
+
+        with self._lock:
+            self.outcomes[span.outcome] = self.outcomes.get(span.outcome, 0) + 1
+            if error_type is not None:
+                self.errors[error_type] = self.errors.get(error_type, 0) + 1
+            for phase, seconds in span.phases.items():
+                self._phases.setdefault(phase, _Histogram()).observe(seconds)
+            self._app_durations.observe(span.duration)
+
+        self._log({
+            'event': 'app',
+            'steam_app_id': span.app_id,
+            'time': span.start_time,
+            'outcome': span.outcome,
+            'error': error_type,
+            'seconds': span.duration,
+            'phases': span.phases,
+        })
+
+    def record_flush(self, seconds, num_written, num_failed):
+        with self._lock:
+            self._flush_durations.observe(seconds)
+            self.crawls_written += num_written
+            self.crawls_failed += num_failed
+
+        self._log({
+            'event': 'flush',
+            'time': time.time(),
+            'seconds': seconds,
+            'written': num_written,
+            'failed': num_failed,
+        })
+
+    def add_gauge(self, name, help_text, function):
+        '''
+        Report the current value of function() as a gauge.
+        '''
+        with self._lock:
+            self._gauges[name] = (help_text, function)
+
+    def _log(self, record):
+        if self.log_file is not None:
+            line = json.dumps(record, sort_keys=True)
+            with self._lock:
+                self.log_file.write(line + '\n')
+                self.log_file.flush()
+
+    def summary(self):
+        '''
+        Return a short human-readable summary of the crawl so far.
+        '''
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            num_apps = sum(self.outcomes.values())
+            lines = ['Crawled {} apps in {:.0f}s ({:.2f} apps/sec)'.format(
+                num_apps, elapsed, num_apps / elapsed if elapsed > 0 else 0)]
+            lines.append('Outcomes: {}'.format(', '.join(
+                '{} {}'.format(count, outcome) for outcome, count in sorted(self.outcomes.items(), key=str))))
+            if len(self.errors) > 0:
+                lines.append('Errors: {}'.format(', '.join(
+                    '{} {}'.format(count, error) for error, count in sorted(self.errors.items()))))
+            lines.append('Mean seconds per app by phase: {}'.format(', '.join(
+                '{} {:.3f}'.format(phase, histogram.sum / histogram.count)
+                for phase, histogram in sorted(self._phases.items()))))
+            if self._flush_durations.count > 0:
+                lines.append('DB flushes: {} taking {:.3f}s on average, {} crawls written, {} failed'.format(
+                    self._flush_durations.count, self._flush_durations.sum / self._flush_durations.count,
+                    self.crawls_written, self.crawls_failed))
+        return '\n'.join(lines)
+
+    def render_prometheus(self):
+        '''
+        Return the metrics in Prometheus' text exposition format.
+        '''
+        lines = []
+
+        def metric(name, metric_type, help_text):
+            lines.append('# HELP {}_{} {}'.format(METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(METRIC_PREFIX, name, metric_type))
+
+        def sample(name, value, **labels):
+            label_str = ','.join('{}="{}"'.format(k, _label_value(v)) for k, v in sorted(labels.items()))
+            lines.append('{}_{}{} {}'.format(METRIC_PREFIX, name, '{' + label_str + '}' if label_str else '', value))
+
+        def histogram(name, hist, **labels):
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + ('+Inf',), hist.counts):
+                cumulative += count
+                sample(name + '_bucket', cumulative, le=bound, **labels)
+            sample(name + '_sum', hist.sum, **labels)
+            sample(name + '_count', hist.count, **labels)
+
+        with self._lock:
+            metric('apps_total', 'counter', 'Apps crawled, by outcome.')
+            for outcome, count in sorted(self.outcomes.items(), key=str):
+                sample('apps_total', count, outcome=outcome)
+
+            metric('errors_total', 'counter', 'Failed crawls, by exception type.')
+            for error, count in sorted(self.errors.items()):
+                sample('errors_total', count, type=error)
+
+            metric('app_seconds', 'histogram', 'Time taken to crawl each app.')
+            histogram('app_seconds', self._app_durations)
+
+            metric('phase_seconds', 'histogram', 'Time spent in each phase of crawling an app.')
+            for phase, hist in sorted(self._phases.items()):
+                histogram('phase_seconds', hist, phase=phase)
+
+            metric('db_flush_seconds', 'histogram', 'Time taken to write each batch of crawls.')
+            histogram('db_flush_seconds', self._flush_durations)
+
+            metric('crawls_written_total', 'counter', 'Crawls written to the database.')
+            sample('crawls_written_total', self.crawls_written)
+            metric('crawls_write_failed_total', 'counter', 'Crawls which failed to write to the database.')
+            sample('crawls_write_failed_total', self.crawls_failed)
+
+            metric('start_time_seconds', 'gauge', 'Unix time the crawl started.')
+            sample('start_time_seconds', self.start_time)
+
+            gauges = sorted(self._gauges.items())
+
+        for name, (help_text, function) in gauges:
+            metric(name, 'gauge', help_text)
+            sample(name, function())
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=''):
+        '''
+        Serve the metrics at /metrics on the given port, in a background thread.
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
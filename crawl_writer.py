@@ -0,0 +1,601 @@
+'''
+Batched writes of crawl results to Postgres.
+
+Rather than a round trip per crawl row and per tag/detail/genre, results are buffered
+and written with one COPY per table per batch.
+'''
+import datetime as dt
+import hashlib
+import json
+import time
+
+from db_utils import copy_rows
+from page_archive import ARCHIVE_TABLE
+
+# Table the crawls are actually stored in; game_crawl is a view over it which fills in
+# the descriptions
+GAME_CRAWL_TABLE = 'game_crawl_base'
+
+# Descriptions are stored once per distinct text in this table, keyed by their hash
+DESCRIPTION_TABLE = 'game_description'
+# Fields of the scraped results which are stored in the description table
+DESCRIPTION_FIELDS = ('short_description', 'long_description')
+
+# Columns of the crawl table we fill in from scraped results
+GAME_CRAWL_COLUMNS = (
+    'steam_app_id',
+    'crawl_time',
+    'game_name',
+    'short_description_hash',
+    'is_dlc',
+    'reviews_last_30_days',
+    'pct_positive_reviews_last_30_days',
+    'reviews_all_time',
+    'pct_positive_reviews_all_time',
+    'release_date',
+    'title',
+    'developer',
+    'publisher',
+    'num_achievements',
+    'full_price',
+    'long_description_hash',
+    'metacritic_score',
+)
+
+# For each list in the scraped results: the entity table holding its descriptions,
+# the entity table's PK, and the many-to-many join table to game_crawl
+ENTITIES = {
+    'tags': ('steam_tag', 'tag_id', 'game_crawl_tag'),
+    'game_details': ('steam_game_detail', 'detail_id', 'game_crawl_detail'),
+    'genres': ('steam_genre', 'genre_id', 'game_crawl_genre'),
+}
+
+# One row per app holding its latest crawl, with the lists as arrays, for analysis
+LATEST_TABLE = 'game_latest'
+
+# Narrow history of the numbers we track over time, with a row only when one of them changes
+HISTORY_TABLE = 'game_metric_history'
+HISTORY_METRICS = (
+    'reviews_all_time',
+    'pct_positive_reviews_all_time',
+    'reviews_last_30_days',
+    'pct_positive_reviews_last_30_days',
+    'full_price',
+    'metacritic_score',
+)
+# SQL condition for whether a row of a window partitioned by app and ordered by crawl
+# time is the app's first or has different metrics from the row before it
+HISTORY_CHANGED = ' OR '.join(['row_number() OVER w = 1'] + [
+    '{0} IS DISTINCT FROM lag({0}) OVER w'.format(metric) for metric in HISTORY_METRICS])
+
+# Columns of the index of archived pages
+ARCHIVE_COLUMNS = ('steam_app_id', 'crawl_time', 'url', 'content_hash', 'backend')
+
+# Per-app record of the last time we saw each app's store page and what was on it
+STATE_TABLE = 'game_crawl_state'
+
+# Fields of the scraped results which determine whether a store page has changed
+FINGERPRINT_FIELDS = tuple(c for c in GAME_CRAWL_COLUMNS if c != 'crawl_time') + tuple(ENTITIES)
+
+# Number of crawls to buffer before writing them
+BATCH_SIZE = 100
+# Longest we'll hold on to a crawl before writing it, in seconds
+MAX_BATCH_AGE = 60
+
+
+def description_hash(description):
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def results_fingerprint(results):
+    '''
+    Return a hash of the parts of the scraped results which matter, so we can tell whether
+    anything changed since the last time we crawled an app.
+    '''
+    normalized = {}
+    for field in FINGERPRINT_FIELDS:
+        value = results.get(field)
+        if isinstance(value, (set, frozenset, list, tuple)):
+            value = sorted(value)
+        elif isinstance(value, (dt.date, dt.datetime)):
+            value = value.isoformat()
+        normalized[field] = value
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CrawlWriter:
+    '''
+    Buffers scraped results and writes them as new crawls (along with their
+    tags, details, and genres) in batches, along with the index entries for any
+    pages we archived.  Each app's row in the latest crawl table is updated along with
+    its crawls.
+
+    If an app's page hasn't changed since the last time we crawled it (by fingerprint,
+    or because steam told us so), we only record that we saw it rather than adding a
+    whole new crawl.  Fingerprints are checked against the database as each batch is
+    written, since other crawlers may have crawled the app since we last looked.
+
+    If replace is True, crawls replace any existing crawl of the same app at the same
+    crawl time instead of being added (for re-parsing archived pages).
+
+    Not thread-safe; all writes should come from one thread.
+    '''
+
+    def __init__(self, db, *, batch_size=BATCH_SIZE, max_batch_age=MAX_BATCH_AGE, replace=False):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_batch_age = max_batch_age
+        self.replace = replace
+
+        # Mappings from descriptions to entity IDs for each of our entity tables
+        self.mappings = {
+            entity_table: {r['descr']: r[pk_name] for r in db[entity_table].find()}
+            for entity_table, pk_name, _ in ENTITIES.values()
+        }
+
+        # Fingerprints of the last crawl of each app as of our last write (only a guess at
+        # whether a crawl is new until it's written), and the validators steam gave us for its
+        # page (for conditional requests).  Only updated by this writer, but the validators
+        # are safe to read from other threads.
+        self.fingerprints = {}
+        self.validators = {}
+
+        # Hashes of the descriptions already stored
+        self.description_hashes = {r['description_hash'] for r in db.query(
+            'SELECT description_hash FROM {}'.format(DESCRIPTION_TABLE))}
+
+        if not replace:
+            for r in db[STATE_TABLE].find():
+                self.fingerprints[r['steam_app_id']] = r['fingerprint']
+                if r['etag'] is not None or r['last_modified'] is not None:
+                    self.validators[r['steam_app_id']] = (r['etag'], r['last_modified'])
+
+        self._buffer = []
+        self._pages = []
+        # Apps whose pages we saw without anything changing, as (app ID, time, validators)
+        self._heartbeats = []
+        self._oldest = None
+
+    def _mark_added(self):
+        if len(self) == 0:
+            self._oldest = time.monotonic()
+
+    def add(self, results, *, crawl_time=None, page=None, validators=None):
+        '''
+        Buffer the results of scraping a store page to be written as a new crawl.
+        The crawl time is the time the results are added unless given.
+
+        page is the (URL, content hash, backend) of the page in our archive, if we archived it.
+        validators are the (ETag, Last-Modified) steam sent with the page, if any.
+
+        Return value: whether the results look like a new crawl (False if nothing changed
+        since the last one we know of).  Whether they are is decided when they're written:
+        if nothing changed since the app's last crawl in the database, only a heartbeat is
+        recorded.
+        '''
+        self._mark_added()
+        crawl = dict(results, crawl_time=crawl_time or dt.datetime.now(dt.timezone.utc))
+
+        # Pull the lists off the main crawl record.
+        # Use sets so we don't try to insert duplicates, if there are any.
+        for key in ENTITIES:
+            crawl[key] = set(crawl.get(key, ()))
+
+        # Store descriptions by reference
+        crawl['descriptions'] = {}
+        for field in DESCRIPTION_FIELDS:
+            description = crawl.pop(field, None)
+            if description is not None:
+                hash_ = description_hash(description)
+                crawl['{}_hash'.format(field)] = hash_
+                crawl['descriptions'][hash_] = description
+
+        crawl['fingerprint'] = results_fingerprint(crawl)
+        crawl['validators'] = validators
+        crawl['page'] = (crawl['steam_app_id'], crawl['crawl_time']) + tuple(page) if page is not None else None
+
+        self._buffer.append(crawl)
+        return self.replace or self.fingerprints.get(crawl['steam_app_id']) != crawl['fingerprint']
+
+    def add_page(self, app_id, page):
+        '''
+        Buffer an index entry for an archived page we didn't get a crawl out of,
+        so we can try it again later.
+        '''
+        self._mark_added()
+        self._pages.append((app_id, dt.datetime.now(dt.timezone.utc)) + tuple(page))
+
+    def add_heartbeat(self, app_id, *, validators=None):
+        '''
+        Record that we saw the app's store page and it hadn't changed.  validators are the
+        (ETag, Last-Modified) the page has now, if any; whatever we had before is replaced.
+        '''
+        self._mark_added()
+        self._heartbeats.append((app_id, dt.datetime.now(dt.timezone.utc), validators))
+
+    def __len__(self):
+        return len(self._buffer) + len(self._pages) + len(self._heartbeats)
+
+    def seconds_until_due(self):
+        '''
+        Return the number of seconds until the buffer should be flushed, or None
+        if there's nothing buffered.
+        '''
+        if len(self) == 0:
+            return None
+        elif len(self) >= self.batch_size:
+            return 0
+        return max(0, self._oldest + self.max_batch_age - time.monotonic())
+
+    def is_due(self):
+        return self.seconds_until_due() == 0
+
+    def flush(self):
+        '''
+        Write everything buffered to the database.
+
+        If the batch can't be written in one go, each crawl is written separately so one
+        bad app doesn't sink the others.
+
+        Return value: (list of app IDs written, list of (app ID, exception) for those that failed)
+        '''
+        batch, self._buffer = self._buffer, []
+        pages, self._pages = self._pages, []
+        heartbeats, self._heartbeats = self._heartbeats, []
+        if len(batch) == 0 and len(pages) == 0 and len(heartbeats) == 0:
+            return [], []
+
+        self.db.begin()
+        try:
+            cursor = self.db.executable.connection.cursor()
+            changed, unchanged, fingerprints = self._split_unchanged(cursor, batch)
+            new_ids = self._get_or_create_entities(cursor, changed)
+            new_hashes = self._insert_descriptions(cursor, changed)
+            self._copy_crawls(cursor, changed, new_ids)
+            self._upsert_latest(cursor, changed)
+            self._insert_history(cursor, changed)
+            self._copy_pages(cursor, pages + [crawl['page'] for crawl in changed if crawl['page'] is not None])
+            self._upsert_state(cursor, changed, heartbeats + unchanged)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            return self._write_individually(batch, pages, heartbeats)
+
+        self._update_mappings(new_ids)
+        self.description_hashes.update(new_hashes)
+        self.fingerprints.update(fingerprints)
+        self._update_state(changed, heartbeats + unchanged)
+        return ([crawl['steam_app_id'] for crawl in changed]
+                + [app_id for app_id, _, _ in heartbeats + unchanged]), []
+
+    def _split_unchanged(self, cursor, batch):
+        '''
+        Split the batch into crawls which changed since the app's last crawl in the
+        database and those which didn't, locking the apps' state so no other crawler
+        can change it before we're done writing.
+
+        Return value: (crawls which changed, heartbeats for those which didn't, the
+        apps' fingerprints in the database)
+        '''
+        if self.replace or len(batch) == 0:
+            return batch, [], {}
+
+        cursor.execute('''
+        SELECT steam_app_id, fingerprint
+        FROM {table}
+        WHERE steam_app_id = ANY(%(app_ids)s)
+        ORDER BY steam_app_id
+        FOR UPDATE
+        '''.format(table=STATE_TABLE), {'app_ids': sorted({crawl['steam_app_id'] for crawl in batch})})
+        fingerprints = dict(cursor.fetchall())
+
+        changed, unchanged = [], []
+        latest = dict(fingerprints)
+        for crawl in sorted(batch, key=lambda crawl: crawl['crawl_time']):
+            if latest.get(crawl['steam_app_id']) == crawl['fingerprint']:
+                # Nothing changed; don't bother storing it all again
+                unchanged.append((crawl['steam_app_id'], crawl['crawl_time'], crawl['validators']))
+            else:
+                changed.append(crawl)
+                latest[crawl['steam_app_id']] = crawl['fingerprint']
+        return changed, unchanged, fingerprints
+
+    def _write_individually(self, batch, pages, heartbeats):
+        written, failed = [], []
+        new_ids = {entity_table: {} for entity_table, _, _ in ENTITIES.values()}
+        new_hashes = set()
+
+        self.db.begin()
+        try:
+            cursor = self.db.executable.connection.cursor()
+            changed, unchanged, fingerprints = self._split_unchanged(cursor, batch)
+            for crawl in changed:
+                # Everything from the app goes in its savepoint, down to its tags and
+                # description, so one bad value only costs us that app
+                cursor.execute('SAVEPOINT crawl_writer_app')
+                try:
+                    crawl_ids = self._get_or_create_entities(cursor, [crawl])
+                    crawl_hashes = self._insert_descriptions(cursor, [crawl])
+                    self._copy_crawls(cursor, [crawl], crawl_ids)
+                    self._upsert_latest(cursor, [crawl])
+                    self._insert_history(cursor, [crawl])
+                    self._upsert_state(cursor, [crawl], [])
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO SAVEPOINT crawl_writer_app')
+                    failed.append((crawl['steam_app_id'], e))
+                else:
+                    cursor.execute('RELEASE SAVEPOINT crawl_writer_app')
+                    written.append(crawl)
+                    # Only entities and descriptions that made it in; anything a failed app
+                    # created was rolled back with it
+                    for entity_table, ids in crawl_ids.items():
+                        new_ids[entity_table].update(ids)
+                    new_hashes.update(crawl_hashes)
+
+            # The pages are worth keeping even if we couldn't write the crawls we got from them
+            self._copy_pages(cursor, pages + [crawl['page'] for crawl in changed if crawl['page'] is not None])
+            self._upsert_state(cursor, [], heartbeats + unchanged)
+            self.db.commit()
+        except Exception as e:
+            # Couldn't even get the pages or heartbeats in; nothing was written
+            self.db.rollback()
+            return [], [(app_id, e) for app_id in
+                        [crawl['steam_app_id'] for crawl in batch] + [app_id for app_id, _, _ in heartbeats]]
+
+        self._update_mappings(new_ids)
+        self.description_hashes.update(new_hashes)
+        self.fingerprints.update(fingerprints)
+        self._update_state(written, heartbeats + unchanged)
+        return ([crawl['steam_app_id'] for crawl in written]
+                + [app_id for app_id, _, _ in heartbeats + unchanged]), failed
+
+    def _get_or_create_entities(self, cursor, batch):
+        '''
+        Make sure every tag/detail/genre in the batch exists in its entity table.
+
+        Return value: mapping from entity table to {descr: ID} for descriptions
+        that weren't already in our mappings
+        '''
+        new_ids = {}
+        for key, (entity_table, pk_name, _) in ENTITIES.items():
+            mapping = self.mappings[entity_table]
+            new_descrs = sorted({descr for crawl in batch for descr in crawl[key]
+                                 if descr not in mapping})
+            new_ids[entity_table] = {}
+            if len(new_descrs) == 0:
+                continue
+
+            # Other crawlers may be adding the same descriptions, so don't assume we're
+            # the ones creating them
+            cursor.execute('''
+            INSERT INTO {table} (descr)
+            SELECT unnest(%(descrs)s::text[])
+            ON CONFLICT (descr) DO NOTHING
+            '''.format(table=entity_table), {'descrs': new_descrs})
+            cursor.execute('''
+            SELECT descr, {pk_name}
+            FROM {table}
+            WHERE descr = ANY(%(descrs)s::text[])
+            '''.format(table=entity_table, pk_name=pk_name), {'descrs': new_descrs})
+            new_ids[entity_table] = dict(cursor.fetchall())
+        return new_ids
+
+    def _insert_descriptions(self, cursor, batch):
+        '''
+        Store any descriptions in the batch we haven't stored before.
+
+        Return value: the hashes of the descriptions
+        '''
+        new_descriptions = {hash_: description
+                            for crawl in batch
+                            for hash_, description in crawl['descriptions'].items()
+                            if hash_ not in self.description_hashes}
+        if len(new_descriptions) > 0:
+            cursor.execute('''
+            INSERT INTO {table} (description_hash, description)
+            SELECT unnest(%(hashes)s::text[]), unnest(%(descriptions)s::text[])
+            ON CONFLICT (description_hash) DO NOTHING
+            '''.format(table=DESCRIPTION_TABLE), {
+                'hashes': list(new_descriptions),
+                'descriptions': list(new_descriptions.values()),
+            })
+        return set(new_descriptions)
+
+    def _copy_crawls(self, cursor, batch, new_ids):
+        if len(batch) == 0:
+            return
+
+        if self.replace:
+            # Join tables cascade
+            cursor.execute('''
+            DELETE FROM {table}
+            WHERE (steam_app_id, crawl_time) IN (
+              SELECT unnest(%(app_ids)s::int[]), unnest(%(crawl_times)s::timestamptz[])
+            )
+            '''.format(table=GAME_CRAWL_TABLE), {
+                'app_ids': [crawl['steam_app_id'] for crawl in batch],
+                'crawl_times': [crawl['crawl_time'] for crawl in batch],
+            })
+
+        copy_rows(cursor, GAME_CRAWL_TABLE, GAME_CRAWL_COLUMNS,
+                  ([crawl.get(column) for column in GAME_CRAWL_COLUMNS] for crawl in batch))
+
+        for key, (entity_table, pk_name, join_table) in ENTITIES.items():
+            mapping = self.mappings[entity_table]
+            created = new_ids[entity_table]
+            rows = [(crawl['steam_app_id'], crawl['crawl_time'],
+                     mapping[descr] if descr in mapping else created[descr])
+                    for crawl in batch
+                    for descr in crawl[key]]
+            if len(rows) > 0:
+                copy_rows(cursor, join_table, ('steam_app_id', 'crawl_time', pk_name), rows)
+
+    def _upsert_latest(self, cursor, batch):
+        '''
+        Bring the latest crawl table up to date with the crawls just written, unless we
+        already have newer crawls for their apps (ex. when re-parsing old pages).
+        '''
+        if len(batch) == 0:
+            return
+
+        list_columns = []
+        for key, (entity_table, pk_name, join_table) in sorted(ENTITIES.items()):
+            # NULL rather than an empty array when there aren't any, like the old view
+            list_columns.append('''(
+              SELECT array_agg(e.descr ORDER BY e.descr)
+              FROM {join_table} j
+                JOIN {entity_table} e
+                  USING ({pk_name})
+              WHERE j.steam_app_id = gc.steam_app_id
+                AND j.crawl_time = gc.crawl_time
+            )'''.format(join_table=join_table, entity_table=entity_table, pk_name=pk_name))
+
+        columns = GAME_CRAWL_COLUMNS + tuple(sorted(ENTITIES))
+        cursor.execute('''
+        INSERT INTO {table} ({columns})
+        -- An app can only appear once in an upsert
+        SELECT DISTINCT ON (gc.steam_app_id) {crawl_columns}, {list_columns}
+        FROM {game_crawl_table} gc
+        WHERE (gc.steam_app_id, gc.crawl_time) IN (
+          SELECT unnest(%(app_ids)s::int[]), unnest(%(crawl_times)s::timestamptz[])
+        )
+        ORDER BY gc.steam_app_id, gc.crawl_time DESC
+        ON CONFLICT (steam_app_id) DO UPDATE SET
+          ({columns}) = ({excluded_columns})
+        WHERE EXCLUDED.crawl_time >= {table}.crawl_time
+        '''.format(
+            table=LATEST_TABLE,
+            game_crawl_table=GAME_CRAWL_TABLE,
+            columns=', '.join(columns),
+            crawl_columns=', '.join('gc.{}'.format(c) for c in GAME_CRAWL_COLUMNS),
+            list_columns=', '.join(list_columns),
+            excluded_columns=', '.join('EXCLUDED.{}'.format(c) for c in columns),
+        ), {
+            'app_ids': [crawl['steam_app_id'] for crawl in batch],
+            'crawl_times': [crawl['crawl_time'] for crawl in batch],
+        })
+
+    def _insert_history(self, cursor, batch):
+        '''
+        Add the crawls whose metrics differ from the app's previous point in the history
+        (which may be earlier in the batch) to the history.
+        '''
+        # Crawls that didn't find a store page don't tell us anything about the metrics
+        batch = [crawl for crawl in batch if crawl.get('game_name') is not None]
+        if len(batch) == 0:
+            return
+
+        columns = ('steam_app_id', 'crawl_time') + HISTORY_METRICS
+        column_types = ('int', 'timestamptz', 'int', 'real', 'int', 'real', 'real', 'int')
+        cursor.execute('''
+        WITH new_point AS (
+          SELECT *, true AS is_new
+          FROM unnest({arrays}) AS n ({columns})
+        ), previous_point AS (
+          -- The latest point we already have before each app's first new one
+          SELECT h.*, false AS is_new
+          FROM (
+            SELECT steam_app_id, min(crawl_time) AS first_crawl_time
+            FROM new_point
+            GROUP BY steam_app_id
+          ) f
+            CROSS JOIN LATERAL (
+              SELECT {columns}
+              FROM {table} h
+              WHERE h.steam_app_id = f.steam_app_id
+                AND h.crawl_time < f.first_crawl_time
+              ORDER BY h.crawl_time DESC
+              LIMIT 1
+            ) h
+        ), point AS (
+          SELECT *, {changed} AS is_changed
+          FROM (
+            SELECT * FROM previous_point
+            UNION ALL
+            SELECT * FROM new_point
+          ) p
+          WINDOW w AS (PARTITION BY steam_app_id ORDER BY crawl_time)
+        )
+        INSERT INTO {table} ({columns})
+        SELECT {columns}
+        FROM point
+        WHERE is_new AND is_changed
+        ON CONFLICT (steam_app_id, crawl_time) DO UPDATE SET
+          ({metrics}) = ({excluded_metrics})
+        '''.format(
+            table=HISTORY_TABLE,
+            arrays=', '.join('%({})s::{}[]'.format(c, t) for c, t in zip(columns, column_types)),
+            columns=', '.join(columns),
+            changed=HISTORY_CHANGED,
+            metrics=', '.join(HISTORY_METRICS),
+            excluded_metrics=', '.join('EXCLUDED.{}'.format(m) for m in HISTORY_METRICS),
+        ), {column: [crawl.get(column) for crawl in batch] for column in columns})
+
+    def _copy_pages(self, cursor, pages):
+        if len(pages) > 0:
+            copy_rows(cursor, ARCHIVE_TABLE, ARCHIVE_COLUMNS, pages)
+
+    def _upsert_state(self, cursor, batch, heartbeats):
+        if self.replace:
+            # Replaying old pages doesn't tell us anything about the current state of the store
+            return
+
+        # (last crawl time, fingerprint, last seen, etag, last modified) by app; an app can only
+        # appear once in an upsert.  Validators are always written as we got them, even if we
+        # got none (ex. the page came from the browser), so stale ones never come back.
+        states = {}
+        for crawl in batch:
+            etag, last_modified = crawl['validators'] or (None, None)
+            states[crawl['steam_app_id']] = (crawl['crawl_time'], crawl['fingerprint'], crawl['crawl_time'],
+                                             etag, last_modified)
+        for app_id, seen_time, validators in heartbeats:
+            etag, last_modified = validators or (None, None)
+            crawl_time, fingerprint, last_seen, _, _ = states.get(app_id, (None, None, None, None, None))
+            # Whatever we saw last has the validators the page has now
+            if last_seen is None or seen_time >= last_seen:
+                states[app_id] = (crawl_time, fingerprint, seen_time, etag, last_modified)
+
+        if len(states) == 0:
+            return
+
+        columns = list(zip(*states.values()))
+        cursor.execute('''
+        INSERT INTO {table} (steam_app_id, last_crawl_time, fingerprint, last_seen, etag, last_modified)
+        SELECT *
+        FROM unnest(%(app_ids)s::int[], %(crawl_times)s::timestamptz[], %(fingerprints)s::text[],
+                    %(seen_times)s::timestamptz[], %(etags)s::text[], %(last_modifieds)s::text[])
+        ON CONFLICT (steam_app_id) DO UPDATE SET
+          last_crawl_time = COALESCE(EXCLUDED.last_crawl_time, {table}.last_crawl_time),
+          fingerprint = COALESCE(EXCLUDED.fingerprint, {table}.fingerprint),
+          last_seen = GREATEST(EXCLUDED.last_seen, {table}.last_seen),
+          etag = EXCLUDED.etag,
+          last_modified = EXCLUDED.last_modified
+        '''.format(table=STATE_TABLE), {
+            'app_ids': list(states),
+            'crawl_times': list(columns[0]),
+            'fingerprints': list(columns[1]),
+            'seen_times': list(columns[2]),
+            'etags': list(columns[3]),
+            'last_modifieds': list(columns[4]),
+        })
+
+    def _update_state(self, batch, heartbeats):
+        # Only safe once the transaction writing the state has committed
+        if self.replace:
+            return
+        for crawl in batch:
+            self.fingerprints[crawl['steam_app_id']] = crawl['fingerprint']
+        # Whatever we saw last has the validators the page has now
+        seen = sorted([(crawl['crawl_time'], crawl['steam_app_id'], crawl['validators']) for crawl in batch]
+                      + [(seen_time, app_id, validators) for app_id, seen_time, validators in heartbeats],
+                      key=lambda seen: seen[0])
+        for _, app_id, validators in seen:
+            if validators is not None:
+                self.validators[app_id] = validators
+            else:
+                self.validators.pop(app_id, None)
+
+    def _update_mappings(self, new_ids):
+        # Only safe once the transaction creating the IDs has committed
+        for entity_table, ids in new_ids.items():
+            self.mappings[entity_table].update(ids)
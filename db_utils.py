@@ -0,0 +1,75 @@
+'''
+Helpers for talking to Postgres more efficiently than one row at a time.
+'''
+import datetime as dt
+import io
+
+import sqlalchemy
+
+# Number of rows to pull from the server at a time when streaming a query
+FETCH_SIZE = 1000
+
+
+def copy_value(value):
+    '''
+    Format a Python value for Postgres' COPY text format.
+    '''
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (dt.date, dt.datetime)):
+        return value.isoformat()
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def copy_rows(cursor, table, columns, rows):
+    '''
+    Write the given rows (sequences of values in the same order as the columns)
+    to the table with a single COPY.
+    '''
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_value(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buf)
+
+
+def stream_query(db, query, params=None):
+    '''
+    Generate the rows of a query (as tuples) from a server-side cursor, without loading
+    the whole result into memory.
+
+    The query runs on its own connection, so the rows can be used to drive writes which
+    get committed on the db connection as we go.
+    '''
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(sqlalchemy.text(query), params or {})
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield tuple(row)
+    finally:
+        conn.close()
+
+
+def query_rows(db, query, params=None):
+    '''
+    Return all the rows of a query (as tuples).
+
+    The query runs on its own connection, which goes back to the pool as soon as we have
+    the rows, so its transaction is over before we do anything with them.
+    '''
+    conn = db.engine.connect()
+    try:
+        return [tuple(row) for row in conn.execute(sqlalchemy.text(query), params or {})]
+    finally:
+        conn.close()
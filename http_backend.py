@@ -0,0 +1,166 @@
+'''
+Fetch steam store pages with plain HTTP requests instead of driving a browser.
+
+Much cheaper than selenium, but some pages still need a real browser; those raise
+FallbackToBrowser so the crawler can retry them with selenium.
+'''
+from urllib.parse import urljoin
+
+import requests
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
+
+from crawl_metrics import NULL_SPAN
+from store_parser import STORE_BASE_URL, ElementNotFound, extract_store_page, is_gated
+
+# Seconds to wait for steam to respond before giving up on a request
+REQUEST_TIMEOUT = 30
+
+# Number of connections to keep open to the store
+POOL_SIZE = 10
+
+# Number of redirects we'll follow for a store page before deciding it redirects to
+# itself forever.  Real pages take one or two (ex. to add the app's name to the URL).
+MAX_REDIRECTS = 5
+
+USER_AGENT = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36')
+
+# Cookies steam sets once we've gotten through its gates; sending them up front
+# means we never see the gates in the first place.
+# The birthtime is 1993-01-01, the same birthday we give the age gate in selenium.
+GATE_COOKIES = {
+    'birthtime': '725875201',
+    'lastagecheckage': '1-January-1993',
+    'mature_content': '1',
+    'wants_mature_content': '1',
+}
+
+
+# Statuses steam gives us when we're making too many requests
+THROTTLE_STATUS_CODES = frozenset((429, 503))
+
+
+class Throttled(Exception):
+    '''
+    Raised when steam tells us we're making too many requests.  retry_after is the
+    number of seconds steam asked us to wait, if it said.
+    '''
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class NotModified(Exception):
+    '''
+    Raised when steam tells us a store page hasn't changed since the last time we fetched it.
+    '''
+    pass
+
+
+class FallbackToBrowser(Exception):
+    '''
+    Raised when the HTTP backend can't handle a store page, meaning it should be
+    scraped with selenium instead.
+    '''
+    pass
+
+
+def make_session(pool_size=POOL_SIZE):
+    '''
+    Create a requests session with a connection pool sized for the crawl and
+    the cookies needed to get through steam's age/NSFW gates.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+
+    for name, value in GATE_COOKIES.items():
+        session.cookies.set(name, value, domain='store.steampowered.com', path='/')
+
+    return session
+
+
+def wait_for_rate_limit(rate_limit, span=NULL_SPAN):
+    '''
+    Block until we can make another request to steam, timing the wait in the given
+    crawl_metrics.Span.  rate_limit is a function which blocks until then (ex. a
+    throttle.TokenBucket's acquire), or None if we aren't limiting requests.
+    '''
+    if rate_limit is not None:
+        with span.phase('rate_limit'):
+            rate_limit()
+
+
+def fetch_store_page(session, app_id, timeout=REQUEST_TIMEOUT, validators=None, rate_limit=None,
+                     span=NULL_SPAN, max_redirects=MAX_REDIRECTS):
+    '''
+    Fetch the store page for the given app ID.
+
+    validators are the (ETag, Last-Modified) from the last time we fetched the page, if we
+    have them; if steam says the page hasn't changed since then, raise NotModified.
+
+    We follow redirects ourselves so each one waits for rate_limit like any other request
+    (see wait_for_rate_limit()); requests are timed in the given crawl_metrics.Span.
+
+    Return value: (the URL we ended up at after redirects, the page's HTML, the page's
+    (ETag, Last-Modified) or None if steam didn't send either), or None if the store
+    page redirects more than max_redirects times (ex. infinitely to itself)
+    '''
+    url = '{}/app/{}'.format(STORE_BASE_URL, app_id)
+
+    headers = {}
+    if validators is not None:
+        etag, last_modified = validators
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+    for _ in range(max_redirects + 1):
+        wait_for_rate_limit(rate_limit, span)
+        with span.phase('fetch'):
+            response = session.get(url, timeout=timeout, headers=headers, allow_redirects=False)
+        if not response.is_redirect:
+            break
+        # Any cookies set along the way (ex. by the gates) are already in the session
+        url = urljoin(response.url, response.headers['Location'])
+    else:
+        return None
+
+    if response.status_code == 304:
+        raise NotModified('Store page for app ID {} hasn\'t changed'.format(app_id))
+    if response.status_code in THROTTLE_STATUS_CODES:
+        retry_after = response.headers.get('Retry-After')
+        raise Throttled('Got status {} for app ID {}'.format(response.status_code, app_id),
+                        retry_after=int(retry_after) if retry_after and retry_after.isdigit() else None)
+    response.raise_for_status()
+
+    new_validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    if new_validators == (None, None):
+        new_validators = None
+    return response.url, response.content, new_validators
+
+
+def parse_store_page_http(app_id, url, content, span=NULL_SPAN):
+    '''
+    Extract all the information we can from a store page fetched over HTTP, raising
+    FallbackToBrowser if we'll need a browser to get it.  Parsing is timed in the
+    given crawl_metrics.Span.
+    '''
+    with span.phase('html'):
+        root = lxml_html.fromstring(content)
+
+    if is_gated(url, root):
+        # The cookies weren't enough to get us through; we'll need to click through
+        raise FallbackToBrowser('Unable to get past the gate for app ID {}'.format(app_id))
+
+    try:
+        return extract_store_page(app_id, url, root, span=span)
+    except ElementNotFound as e:
+        # Parts of some pages are only filled in by javascript
+        raise FallbackToBrowser('Incomplete store page for app ID {}'.format(app_id)) from e
+
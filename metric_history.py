@@ -0,0 +1,141 @@
+'''
+Compact history of the numbers we track about each app over time: review counts and
+scores, price, and metacritic score.
+
+Most crawls of an app find the same numbers as the crawl before, so rather than keeping
+them all, game_metric_history only gets a row when one of them changes (see
+crawl_writer.CrawlWriter._insert_history); each value holds until the app's next row.
+load_history() reads the change points for many apps at once, and aligned_history()
+turns them into one series per app on a common time grid for the notebooks.
+'''
+import argparse
+import os
+
+import dataset
+import numpy as np
+import pandas as pd
+
+from crawl_writer import GAME_CRAWL_TABLE, HISTORY_CHANGED, HISTORY_METRICS, HISTORY_TABLE
+from db_utils import stream_query
+
+# Default spacing of the time grid series are aligned on
+ALIGN_FREQ = '1D'
+
+HISTORY_QUERY = '''
+SELECT steam_app_id, crawl_time AT TIME ZONE 'UTC' AS crawl_time, {metrics}
+FROM {table}
+WHERE (CAST(:app_ids AS int[]) IS NULL OR steam_app_id = ANY(CAST(:app_ids AS int[])))
+  AND (CAST(:start AS timestamptz) IS NULL OR crawl_time >= :start)
+  AND (CAST(:end AS timestamptz) IS NULL OR crawl_time < :end)
+UNION ALL
+-- The values each app had going into the range
+(
+  SELECT DISTINCT ON (steam_app_id) steam_app_id, crawl_time AT TIME ZONE 'UTC' AS crawl_time, {metrics}
+  FROM {table}
+  WHERE CAST(:start AS timestamptz) IS NOT NULL
+    AND (CAST(:app_ids AS int[]) IS NULL OR steam_app_id = ANY(CAST(:app_ids AS int[])))
+    AND crawl_time < :start
+  ORDER BY steam_app_id, crawl_time DESC
+)
+ORDER BY steam_app_id, crawl_time
+'''
+
+# Back-fill the history from every crawl we have, keeping only the change points
+REBUILD_QUERY = '''
+INSERT INTO {table} (steam_app_id, crawl_time, {metrics})
+SELECT steam_app_id, crawl_time, {metrics}
+FROM (
+  SELECT steam_app_id, crawl_time, {metrics}, {changed} AS is_changed
+  FROM {game_crawl_table}
+  WHERE game_name IS NOT NULL
+  WINDOW w AS (PARTITION BY steam_app_id ORDER BY crawl_time)
+) p
+WHERE is_changed
+'''.format(table=HISTORY_TABLE, game_crawl_table=GAME_CRAWL_TABLE, metrics=', '.join(HISTORY_METRICS),
+           changed=HISTORY_CHANGED)
+
+
+def load_history(db, *, app_ids=None, metrics=HISTORY_METRICS, start=None, end=None):
+    '''
+    Load the change points of the given metrics for the given apps (or all of them) as a
+    DataFrame with columns steam_app_id, crawl_time (in UTC), and one column per metric,
+    ordered by app and crawl time.
+
+    If start is given, each app's last point before start is included too, since its
+    values still hold at start.  Points at or after end are left out.
+    '''
+    metrics = list(metrics)
+    unknown = set(metrics) - set(HISTORY_METRICS)
+    if len(unknown) > 0:
+        raise ValueError('Unknown metrics: {}'.format(', '.join(sorted(unknown))))
+
+    query = HISTORY_QUERY.format(table=HISTORY_TABLE, metrics=', '.join(metrics))
+    rows = stream_query(db, query, {
+        'app_ids': list(app_ids) if app_ids is not None else None,
+        'start': start,
+        'end': end,
+    })
+    return pd.DataFrame.from_records(list(rows), columns=['steam_app_id', 'crawl_time'] + metrics)
+
+
+def aligned_history(history, metric, *, freq=ALIGN_FREQ, start=None, end=None):
+    '''
+    Align one metric of the history from load_history() on a common time grid, one
+    point every freq (a pandas frequency string) from start to end (by default, the
+    first and last points in the history).
+
+    Return value: DataFrame indexed by time with a column per app, holding each app's
+    value as of the end of each step (NaN before the app's first point)
+    '''
+    history = history[['steam_app_id', 'crawl_time', metric]].sort_values(['steam_app_id', 'crawl_time'])
+    step = pd.tseries.frequencies.to_offset(freq)
+    # Label each point with the grid time it holds at; only the last point in each step counts
+    grid_time = history['crawl_time'].dt.floor(freq) + step
+    history = history.assign(grid_time=grid_time).drop_duplicates(['steam_app_id', 'grid_time'], keep='last')
+
+    # A change to a missing value (ex. a game losing its metacritic score) is still a
+    # change, so mark those to keep the forward fill from papering over them
+    values = history[metric].fillna(np.inf)
+    wide = (history.assign(**{metric: values})
+            .pivot(index='grid_time', columns='steam_app_id', values=metric))
+
+    start = pd.Timestamp(start).ceil(freq) if start is not None else wide.index.min()
+    end = pd.Timestamp(end) if end is not None else wide.index.max()
+    grid = pd.date_range(start, end, freq=freq)
+
+    # Points before the grid starts carry over into it
+    wide = wide.reindex(wide.index.union(grid)).ffill().reindex(grid)
+    return wide.replace(np.inf, np.nan)
+
+
+def rebuild_history(db):
+    '''
+    Replace the history with one built from every crawl in the database.
+
+    Return value: number of change points in the history
+    '''
+    db.begin()
+    try:
+        cursor = db.executable.connection.cursor()
+        cursor.execute('TRUNCATE {}'.format(HISTORY_TABLE))
+        cursor.execute(REBUILD_QUERY)
+        num_points = cursor.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return num_points
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Rebuild the review and price history from every crawl so far.')
+    parser.parse_args()
+
+    db = dataset.connect(os.environ['POSTGRES_URI'], ensure_schema=False)
+
+    num_points = rebuild_history(db)
+    print('Rebuilt the history with {} change points'.format(num_points))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,195 @@
+-- Bring a database from before descriptions were moved out of game_crawl (when it was a
+-- table holding every crawl, descriptions and all) up to the current schema, keeping
+-- every crawl along with its genres, details, and tags, and filling in game_latest.
+--
+-- Run it with psql, from any directory:
+--   psql "$POSTGRES_URI" -f migrate_game_crawl.sql
+--
+-- The old tables are set aside in their own schema, reset_db.sql creates the current
+-- schema, and the old data is copied into it before the old tables are dropped.  It all
+-- happens in one transaction, so if anything goes wrong, the database is left as it was.
+-- Anything else the current schema has (the retry queue, the page archive index, the
+-- review and price history, etc.) starts out empty; run metric_history.py afterwards to
+-- fill in the history.
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+CREATE SCHEMA migrate_game_crawl;
+
+-- Their indexes, constraints, and ID sequences go with them, so the new tables can
+-- reuse the names
+ALTER TABLE game SET SCHEMA migrate_game_crawl;
+ALTER TABLE game_crawl SET SCHEMA migrate_game_crawl;
+ALTER TABLE steam_genre SET SCHEMA migrate_game_crawl;
+ALTER TABLE game_crawl_genre SET SCHEMA migrate_game_crawl;
+ALTER TABLE steam_tag SET SCHEMA migrate_game_crawl;
+ALTER TABLE game_crawl_tag SET SCHEMA migrate_game_crawl;
+ALTER TABLE steam_game_detail SET SCHEMA migrate_game_crawl;
+ALTER TABLE game_crawl_detail SET SCHEMA migrate_game_crawl;
+
+\ir reset_db.sql
+
+INSERT INTO game (steam_app_id, game_name)
+SELECT steam_app_id, game_name
+FROM migrate_game_crawl.game;
+
+-- Keep the IDs, so the link tables can be copied as they are
+INSERT INTO steam_genre (genre_id, descr)
+SELECT genre_id, descr
+FROM migrate_game_crawl.steam_genre;
+
+INSERT INTO steam_tag (tag_id, descr)
+SELECT tag_id, descr
+FROM migrate_game_crawl.steam_tag;
+
+INSERT INTO steam_game_detail (detail_id, descr)
+SELECT detail_id, descr
+FROM migrate_game_crawl.steam_game_detail;
+
+SELECT setval(pg_get_serial_sequence('steam_genre', 'genre_id'), max(genre_id), true)
+FROM steam_genre
+HAVING count(*) > 0;
+
+SELECT setval(pg_get_serial_sequence('steam_tag', 'tag_id'), max(tag_id), true)
+FROM steam_tag
+HAVING count(*) > 0;
+
+SELECT setval(pg_get_serial_sequence('steam_game_detail', 'detail_id'), max(detail_id), true)
+FROM steam_game_detail
+HAVING count(*) > 0;
+
+-- Hashed the same way as crawl_writer.description_hash()
+INSERT INTO game_description (description_hash, description)
+SELECT encode(sha256(convert_to(description, 'UTF8')), 'hex'), description
+FROM (
+  SELECT short_description AS description FROM migrate_game_crawl.game_crawl
+  UNION
+  SELECT long_description FROM migrate_game_crawl.game_crawl
+) d
+WHERE description IS NOT NULL;
+
+INSERT INTO game_crawl_base (
+  steam_app_id,
+  crawl_time,
+  game_name,
+  short_description_hash,
+  is_dlc,
+  reviews_last_30_days,
+  pct_positive_reviews_last_30_days,
+  reviews_all_time,
+  pct_positive_reviews_all_time,
+  release_date,
+  title,
+  developer,
+  publisher,
+  num_achievements,
+  full_price,
+  long_description_hash,
+  metacritic_score
+)
+SELECT
+  steam_app_id,
+  crawl_time,
+  game_name,
+  encode(sha256(convert_to(short_description, 'UTF8')), 'hex'),
+  is_dlc,
+  reviews_last_30_days,
+  pct_positive_reviews_last_30_days,
+  reviews_all_time,
+  pct_positive_reviews_all_time,
+  release_date,
+  title,
+  developer,
+  publisher,
+  num_achievements,
+  full_price,
+  encode(sha256(convert_to(long_description, 'UTF8')), 'hex'),
+  metacritic_score
+FROM migrate_game_crawl.game_crawl;
+
+INSERT INTO game_crawl_genre (steam_app_id, crawl_time, genre_id)
+SELECT steam_app_id, crawl_time, genre_id
+FROM migrate_game_crawl.game_crawl_genre;
+
+INSERT INTO game_crawl_tag (steam_app_id, crawl_time, tag_id)
+SELECT steam_app_id, crawl_time, tag_id
+FROM migrate_game_crawl.game_crawl_tag;
+
+INSERT INTO game_crawl_detail (steam_app_id, crawl_time, detail_id)
+SELECT steam_app_id, crawl_time, detail_id
+FROM migrate_game_crawl.game_crawl_detail;
+
+-- The latest crawl of each app, the same as crawl_writer.CrawlWriter._upsert_latest()
+-- keeps it from here on
+INSERT INTO game_latest (
+  steam_app_id,
+  crawl_time,
+  game_name,
+  short_description_hash,
+  is_dlc,
+  reviews_last_30_days,
+  pct_positive_reviews_last_30_days,
+  reviews_all_time,
+  pct_positive_reviews_all_time,
+  release_date,
+  title,
+  developer,
+  publisher,
+  num_achievements,
+  full_price,
+  long_description_hash,
+  metacritic_score,
+  game_details,
+  genres,
+  tags
+)
+SELECT DISTINCT ON (gc.steam_app_id)
+  gc.steam_app_id,
+  gc.crawl_time,
+  gc.game_name,
+  gc.short_description_hash,
+  gc.is_dlc,
+  gc.reviews_last_30_days,
+  gc.pct_positive_reviews_last_30_days,
+  gc.reviews_all_time,
+  gc.pct_positive_reviews_all_time,
+  gc.release_date,
+  gc.title,
+  gc.developer,
+  gc.publisher,
+  gc.num_achievements,
+  gc.full_price,
+  gc.long_description_hash,
+  gc.metacritic_score,
+  -- NULL rather than an empty array when there aren't any, like the crawler writes them
+  (
+    SELECT array_agg(e.descr ORDER BY e.descr)
+    FROM game_crawl_detail j
+      JOIN steam_game_detail e
+        USING (detail_id)
+    WHERE j.steam_app_id = gc.steam_app_id
+      AND j.crawl_time = gc.crawl_time
+  ),
+  (
+    SELECT array_agg(e.descr ORDER BY e.descr)
+    FROM game_crawl_genre j
+      JOIN steam_genre e
+        USING (genre_id)
+    WHERE j.steam_app_id = gc.steam_app_id
+      AND j.crawl_time = gc.crawl_time
+  ),
+  (
+    SELECT array_agg(e.descr ORDER BY e.descr)
+    FROM game_crawl_tag j
+      JOIN steam_tag e
+        USING (tag_id)
+    WHERE j.steam_app_id = gc.steam_app_id
+      AND j.crawl_time = gc.crawl_time
+  )
+FROM game_crawl_base gc
+ORDER BY gc.steam_app_id, gc.crawl_time DESC;
+
+DROP SCHEMA migrate_game_crawl CASCADE;
+
+COMMIT;
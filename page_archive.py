@@ -0,0 +1,66 @@
+'''
+Compressed, content-addressed archive of raw store pages, so we can re-parse old crawls
+after fixing the parser instead of crawling them all over again.
+
+Pages are stored as zstd-compressed files named by the SHA-256 of their content, so
+identical pages are only stored once.  The page_archive table indexes which page we
+saw for each app at each crawl time.
+'''
+import hashlib
+import os
+import tempfile
+
+import zstandard
+
+ARCHIVE_TABLE = 'page_archive'
+
+COMPRESSION_LEVEL = 10
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class PageArchive:
+    '''
+    A directory of archived pages.  Safe to share between threads and processes.
+    '''
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _path(self, hash_):
+        return os.path.join(self.root_dir, hash_[:2], '{}.html.zst'.format(hash_))
+
+    def store(self, content):
+        '''
+        Archive the given page content (bytes), if we don't have it already.
+
+        Return value: the content's hash, which is its key in the archive
+        '''
+        hash_ = content_hash(content)
+        path = self._path(hash_)
+        if os.path.exists(path):
+            return hash_
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(content)
+
+        # Write to a temporary file and move it into place so nobody ever sees half a page
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return hash_
+
+    def load(self, hash_):
+        '''
+        Return the content of the archived page with the given hash.
+        '''
+        with open(self._path(hash_), 'rb') as f:
+            return zstandard.ZstdDecompressor().decompress(f.read())
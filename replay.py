@@ -0,0 +1,139 @@
+'''
+Re-parse archived store pages and rewrite the crawls we got from them, so parser fixes
+can be applied to old crawls without crawling steam all over again.
+
+Pages are parsed in parallel across all cores; see scrape.py's --archive-dir for
+archiving pages in the first place.  Only pages whose crawls came from the store page
+alone can be replayed; crawls from the api backend also hold prices from steam's API,
+which the page can't give us back, so those pages are skipped.
+'''
+import argparse
+import os
+import sys
+import traceback
+from multiprocessing import Pool
+
+import dataset
+from tqdm import tqdm
+
+from crawl_writer import BATCH_SIZE, CrawlWriter
+from db_utils import stream_query
+from page_archive import ARCHIVE_TABLE, PageArchive
+from store_parser import parse_store_page
+
+# Number of pages to hand a worker process at a time
+CHUNK_SIZE = 16
+
+# Backends whose crawls we get entirely from the store page, so re-parsing the page gets
+# the whole crawl back (see scrape.BACKENDS).  Pages archived before we recorded the
+# backend are from these too, as far as we know.
+REPLAYABLE_BACKENDS = ('selenium', 'http', None)
+
+ARCHIVED_PAGES_QUERY = '''
+SELECT steam_app_id, crawl_time, url, content_hash, backend
+FROM {archive_table}
+WHERE (CAST(:min_app_id AS int) IS NULL OR steam_app_id >= :min_app_id)
+  AND (CAST(:max_app_id AS int) IS NULL OR steam_app_id <= :max_app_id)
+ORDER BY steam_app_id, crawl_time
+'''.format(archive_table=ARCHIVE_TABLE)
+
+# Each worker process' archive
+_archive = None
+
+
+def _init_worker(archive_dir):
+    global _archive
+    _archive = PageArchive(archive_dir)
+
+
+def replay_page(archived_page):
+    '''
+    Re-parse an archived page (a row from the archive table).  Runs in a worker process.
+
+    Return value: (app ID, crawl time, results, None), or (app ID, crawl time, None,
+    formatted exception) if the page couldn't be parsed
+    '''
+    app_id, crawl_time, url, content_hash, _ = archived_page
+    try:
+        return app_id, crawl_time, parse_store_page(app_id, url, _archive.load(content_hash)), None
+    except Exception:
+        return app_id, crawl_time, None, traceback.format_exc()
+
+
+def do_replay(db, archive_dir, *, min_app_id=None, max_app_id=None, num_workers=None,
+              batch_size=BATCH_SIZE):
+    '''
+    Re-parse every archived page for apps with IDs in the given range (inclusive) using
+    num_workers processes (by default, one per core), replacing the crawls we got from them.
+    Pages from backends we can't replay (see REPLAYABLE_BACKENDS) are skipped.
+
+    Return value: (number of crawls rewritten, number of pages which failed, number of
+    pages skipped)
+    '''
+    writer = CrawlWriter(db, batch_size=batch_size, replace=True)
+    num_written, num_failed, num_skipped = 0, 0, 0
+
+    def flush():
+        nonlocal num_written, num_failed
+        written, failed = writer.flush()
+        num_written += len(written)
+        num_failed += len(failed)
+        for app_id, error in failed:
+            print('Failed to write replayed crawl for app ID {}: {}'.format(app_id, error),
+                  file=sys.stderr)
+
+    def replayable(archived_pages):
+        nonlocal num_skipped
+        for archived_page in archived_pages:
+            if archived_page[-1] in REPLAYABLE_BACKENDS:
+                yield archived_page
+            else:
+                num_skipped += 1
+
+    archived_pages = stream_query(db, ARCHIVED_PAGES_QUERY, {
+        'min_app_id': min_app_id,
+        'max_app_id': max_app_id,
+    })
+
+    with Pool(num_workers, initializer=_init_worker, initargs=(archive_dir,)) as pool:
+        replayed = pool.imap_unordered(replay_page, replayable(archived_pages), chunksize=CHUNK_SIZE)
+        for app_id, crawl_time, results, error in tqdm(replayed):
+            if error is not None:
+                print('Failed to parse archived page for app ID {} crawled at {}:\n{}'.format(
+                    app_id, crawl_time, error), file=sys.stderr)
+                num_failed += 1
+                continue
+
+            writer.add(results, crawl_time=crawl_time)
+            if writer.is_due():
+                flush()
+    flush()
+
+    return num_written, num_failed, num_skipped
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Re-parse archived store pages and rewrite their crawls.')
+    parser.add_argument('archive_dir',
+                        help='Directory the crawler archived pages in.')
+    parser.add_argument('--min-app-id', type=int,
+                        help='Only replay pages for apps with at least this ID.')
+    parser.add_argument('--max-app-id', type=int,
+                        help='Only replay pages for apps with at most this ID.')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes to parse pages with.  Defaults to the number of cores.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Number of crawls to write to the database at a time.')
+    args = parser.parse_args()
+
+    db = dataset.connect(os.environ['POSTGRES_URI'], ensure_schema=False)
+
+    num_written, num_failed, num_skipped = do_replay(db, args.archive_dir, min_app_id=args.min_app_id,
+                                                     max_app_id=args.max_app_id, num_workers=args.workers,
+                                                     batch_size=args.batch_size)
+    print('Rewrote {} crawls; {} pages failed; skipped {} pages from the api backend'.format(
+        num_written, num_failed, num_skipped))
+
+
+if __name__ == '__main__':
+    run()
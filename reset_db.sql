@@ -7,13 +7,35 @@ CREATE TABLE game (
     CONSTRAINT game_pk PRIMARY KEY (steam_app_id)
 );
 
-DROP TABLE IF EXISTS game_crawl CASCADE;
+-- Store page descriptions, stored once no matter how many crawls they appear in
+DROP TABLE IF EXISTS game_description CASCADE;
 
-CREATE TABLE game_crawl (
+CREATE TABLE game_description (
+    -- SHA-256 of the description
+    description_hash text,
+    description text NOT NULL,
+
+    CONSTRAINT game_description_pk PRIMARY KEY (description_hash)
+);
+
+-- game_crawl used to be a table before descriptions were moved out of it.  This throws
+-- away its crawls; to keep them, run migrate_game_crawl.sql instead.
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = current_schema() AND tablename = 'game_crawl') THEN
+    DROP TABLE game_crawl CASCADE;
+  END IF;
+END
+$$;
+
+DROP TABLE IF EXISTS game_crawl_base CASCADE;
+
+-- Crawled data, with descriptions by reference; see the game_crawl view for the full crawls
+CREATE TABLE game_crawl_base (
     steam_app_id int,
     crawl_time timestamp with time zone DEFAULT (now() at time zone 'utc'),
     game_name text,
-    short_description text,
+    short_description_hash text,
     is_dlc boolean,
     reviews_last_30_days int,
     pct_positive_reviews_last_30_days real,
@@ -25,14 +47,22 @@ CREATE TABLE game_crawl (
     publisher text,
     num_achievements int,
     full_price real,
-    long_description text,
+    long_description_hash text,
     metacritic_score int,
+    -- When the crawl was written (or rewritten, ex. by replay.py), for incremental exports
+    written_at timestamp with time zone NOT NULL DEFAULT now(),
 
     CONSTRAINT game_crawl_pk PRIMARY KEY (steam_app_id, crawl_time),
     CONSTRAINT game_game_crawl_fk FOREIGN KEY (steam_app_id)
-        REFERENCES game (steam_app_id)
+        REFERENCES game (steam_app_id),
+    CONSTRAINT short_description_game_crawl_fk FOREIGN KEY (short_description_hash)
+        REFERENCES game_description (description_hash),
+    CONSTRAINT long_description_game_crawl_fk FOREIGN KEY (long_description_hash)
+        REFERENCES game_description (description_hash)
 );
 
+CREATE INDEX game_crawl_base_written_at_idx ON game_crawl_base (written_at);
+
 DROP TABLE IF EXISTS steam_genre CASCADE;
 
 CREATE TABLE steam_genre (
@@ -52,7 +82,7 @@ CREATE TABLE game_crawl_genre (
 
     CONSTRAINT game_crawl_genre_pk PRIMARY KEY (steam_app_id, crawl_time, genre_id),
     CONSTRAINT game_crawl_game_crawl_genre_fk FOREIGN KEY (steam_app_id, crawl_time)
-        REFERENCES game_crawl (steam_app_id, crawl_time) ON DELETE CASCADE,
+        REFERENCES game_crawl_base (steam_app_id, crawl_time) ON DELETE CASCADE,
     CONSTRAINT steam_genre_game_crawl_genre_fk FOREIGN KEY (genre_id)
         REFERENCES steam_genre (genre_id)
 );
@@ -76,7 +106,7 @@ CREATE TABLE game_crawl_tag (
 
     CONSTRAINT game_crawl_tag_pk PRIMARY KEY (steam_app_id, crawl_time, tag_id),
     CONSTRAINT game_crawl_game_crawl_tag_fk FOREIGN KEY (steam_app_id, crawl_time)
-        REFERENCES game_crawl (steam_app_id, crawl_time) ON DELETE CASCADE,
+        REFERENCES game_crawl_base (steam_app_id, crawl_time) ON DELETE CASCADE,
     CONSTRAINT steam_tag_game_crawl_tag_fk FOREIGN KEY (tag_id)
         REFERENCES steam_tag (tag_id)
 );
@@ -100,43 +130,206 @@ CREATE TABLE game_crawl_detail (
 
     CONSTRAINT game_crawl_detail_pk PRIMARY KEY (steam_app_id, crawl_time, detail_id),
     CONSTRAINT game_crawl_game_crawl_detail_fk FOREIGN KEY (steam_app_id, crawl_time)
-        REFERENCES game_crawl (steam_app_id, crawl_time) ON DELETE CASCADE,
+        REFERENCES game_crawl_base (steam_app_id, crawl_time) ON DELETE CASCADE,
     CONSTRAINT steam_game_detail_game_crawl_detail_fk FOREIGN KEY (detail_id)
         REFERENCES steam_game_detail (detail_id)
 );
 
+-- What we last saw on each app's store page, so we can skip storing crawls that didn't change
+DROP TABLE IF EXISTS game_crawl_state CASCADE;
+
+CREATE TABLE game_crawl_state (
+    steam_app_id int,
+    -- The crawl holding what's currently on the store page
+    last_crawl_time timestamp with time zone,
+    -- Hash of the data in that crawl
+    fingerprint text,
+    -- Last time we fetched the store page, whether or not it changed
+    last_seen timestamp with time zone,
+    -- Validators for conditional requests
+    etag text,
+    last_modified text,
+
+    CONSTRAINT game_crawl_state_pk PRIMARY KEY (steam_app_id),
+    CONSTRAINT game_game_crawl_state_fk FOREIGN KEY (steam_app_id)
+        REFERENCES game (steam_app_id)
+);
+
+DROP TABLE IF EXISTS crawl_retry CASCADE;
+
+CREATE TABLE crawl_retry (
+    steam_app_id int,
+    attempts int NOT NULL,
+    -- Crawls which failed because steam was throttling us (or timed out), counted
+    -- separately since they usually aren't the app's fault
+    throttles int NOT NULL DEFAULT 0,
+    next_attempt timestamp with time zone NOT NULL,
+    last_error text,
+
+    CONSTRAINT crawl_retry_pk PRIMARY KEY (steam_app_id),
+    CONSTRAINT game_crawl_retry_fk FOREIGN KEY (steam_app_id)
+        REFERENCES game (steam_app_id)
+);
+
+-- Review counts, scores, and prices over time, with a row only when one of them changes
+-- (so each value holds until the app's next row); see metric_history.py
+DROP TABLE IF EXISTS game_metric_history CASCADE;
+
+CREATE TABLE game_metric_history (
+    steam_app_id int,
+    crawl_time timestamp with time zone,
+    reviews_all_time int,
+    pct_positive_reviews_all_time real,
+    reviews_last_30_days int,
+    pct_positive_reviews_last_30_days real,
+    full_price real,
+    metacritic_score int,
+
+    -- Also the index for scanning an app's history over a range of time
+    CONSTRAINT game_metric_history_pk PRIMARY KEY (steam_app_id, crawl_time),
+    CONSTRAINT game_game_metric_history_fk FOREIGN KEY (steam_app_id)
+        REFERENCES game (steam_app_id)
+);
+
+-- Shared queue of apps to crawl, claimed by crawlers (possibly on several machines)
+-- under leases they extend while they work; see crawl_jobs.py
+DROP TABLE IF EXISTS crawl_job CASCADE;
+
+CREATE TABLE crawl_job (
+    steam_app_id int,
+    status text NOT NULL DEFAULT 'pending',
+    priority double precision NOT NULL,
+    enqueued_at timestamp with time zone NOT NULL DEFAULT now(),
+    lease_owner text,
+    lease_expires timestamp with time zone,
+    claims int NOT NULL DEFAULT 0,
+    lost_leases int NOT NULL DEFAULT 0,
+    finished_at timestamp with time zone,
+    last_error text,
+
+    CONSTRAINT crawl_job_pk PRIMARY KEY (steam_app_id),
+    CONSTRAINT crawl_job_status_check CHECK (status IN ('pending', 'leased', 'done', 'failed')),
+    CONSTRAINT game_crawl_job_fk FOREIGN KEY (steam_app_id)
+        REFERENCES game (steam_app_id)
+);
+
+-- Keep claiming and reclaiming cheap no matter how many finished jobs pile up
+CREATE INDEX crawl_job_pending_idx ON crawl_job (priority DESC, steam_app_id DESC)
+    WHERE status = 'pending';
+CREATE INDEX crawl_job_leased_idx ON crawl_job (lease_expires)
+    WHERE status = 'leased';
+
+-- Index of raw store pages saved by the crawler; the pages themselves are files named by their hash.
+-- Not tied to game_crawl, since we keep pages we failed to get a crawl out of and since
+-- re-parsing pages replaces their crawls.
+DROP TABLE IF EXISTS page_archive CASCADE;
+
+CREATE TABLE page_archive (
+    steam_app_id int,
+    crawl_time timestamp with time zone,
+    url text,
+    content_hash text NOT NULL,
+    -- Which of scrape.py's backends we got the crawl from the page with; NULL for pages
+    -- archived before we kept track
+    backend text,
+
+    CONSTRAINT page_archive_pk PRIMARY KEY (steam_app_id, crawl_time),
+    CONSTRAINT game_page_archive_fk FOREIGN KEY (steam_app_id)
+        REFERENCES game (steam_app_id)
+);
+
+DROP VIEW IF EXISTS game_crawl CASCADE;
+
+-- Crawls with their descriptions filled in, in the shape game_crawl had as a table
+CREATE VIEW game_crawl AS
+SELECT
+  gc.steam_app_id,
+  gc.crawl_time,
+  gc.game_name,
+  sd.description AS short_description,
+  gc.is_dlc,
+  gc.reviews_last_30_days,
+  gc.pct_positive_reviews_last_30_days,
+  gc.reviews_all_time,
+  gc.pct_positive_reviews_all_time,
+  gc.release_date,
+  gc.title,
+  gc.developer,
+  gc.publisher,
+  gc.num_achievements,
+  gc.full_price,
+  ld.description AS long_description,
+  gc.metacritic_score
+FROM
+  game_crawl_base gc
+    LEFT JOIN game_description sd
+      ON sd.description_hash = gc.short_description_hash
+    LEFT JOIN game_description ld
+      ON ld.description_hash = gc.long_description_hash;
+
+-- Latest crawl of each app with its genres, details, and tags, kept up to date by the crawler
+-- so analysis doesn't have to go through every crawl
+DROP TABLE IF EXISTS game_latest CASCADE;
+
+CREATE TABLE game_latest (
+    steam_app_id int,
+    crawl_time timestamp with time zone NOT NULL,
+    game_name text,
+    short_description_hash text,
+    is_dlc boolean,
+    reviews_last_30_days int,
+    pct_positive_reviews_last_30_days real,
+    reviews_all_time int,
+    pct_positive_reviews_all_time real,
+    release_date date,
+    title text,
+    developer text,
+    publisher text,
+    num_achievements int,
+    full_price real,
+    long_description_hash text,
+    metacritic_score int,
+    game_details text[],
+    genres text[],
+    tags text[],
+
+    CONSTRAINT game_latest_pk PRIMARY KEY (steam_app_id),
+    CONSTRAINT game_game_latest_fk FOREIGN KEY (steam_app_id)
+        REFERENCES game (steam_app_id)
+);
+
+CREATE INDEX game_latest_is_dlc_idx ON game_latest (is_dlc);
+CREATE INDEX game_latest_tags_idx ON game_latest USING gin (tags);
+CREATE INDEX game_latest_genres_idx ON game_latest USING gin (genres);
+
 DROP VIEW IF EXISTS game_crawl_view CASCADE;
 
+-- Latest crawl of each app, with descriptions filled in
 CREATE VIEW game_crawl_view AS
-WITH game_genres AS (
-  SELECT gcg.steam_app_id, array_agg(sg.descr) AS genres
-  FROM game_crawl_genre gcg
-    JOIN steam_genre sg
-      USING (genre_id)
-  GROUP BY gcg.steam_app_id
-), game_details AS (
-  SELECT gcd.steam_app_id, array_agg(sgd.descr) AS details
-  FROM game_crawl_detail gcd
-    JOIN steam_game_detail sgd
-      USING (detail_id)
-  GROUP BY gcd.steam_app_id
-), game_tags AS (
-  SELECT gct.steam_app_id, array_agg(st.descr) AS tags
-  FROM game_crawl_tag gct
-    JOIN steam_tag st
-      USING (tag_id)
-  GROUP BY gct.steam_app_id
-)
 SELECT
-  gc.*,
-  gg.genres,
-  gd.details,
-  gt.tags
+  gl.steam_app_id,
+  gl.crawl_time,
+  gl.game_name,
+  sd.description AS short_description,
+  gl.is_dlc,
+  gl.reviews_last_30_days,
+  gl.pct_positive_reviews_last_30_days,
+  gl.reviews_all_time,
+  gl.pct_positive_reviews_all_time,
+  gl.release_date,
+  gl.title,
+  gl.developer,
+  gl.publisher,
+  gl.num_achievements,
+  gl.full_price,
+  ld.description AS long_description,
+  gl.metacritic_score,
+  gl.genres,
+  gl.game_details AS details,
+  gl.tags
 FROM
-  game_crawl gc
-    LEFT JOIN game_genres gg
-      USING (steam_app_id)
-    LEFT JOIN game_details gd
-      USING (steam_app_id)
-    LEFT JOIN game_tags gt
-      USING (steam_app_id);
+  game_latest gl
+    LEFT JOIN game_description sd
+      ON sd.description_hash = gl.short_description_hash
+    LEFT JOIN game_description ld
+      ON ld.description_hash = gl.long_description_hash;
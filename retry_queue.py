@@ -0,0 +1,166 @@
+'''
+Persistent queue of apps whose crawls failed, so they're retried later instead of lost.
+'''
+import contextlib
+import heapq
+import random
+import threading
+import time
+
+RETRY_TABLE = 'crawl_retry'
+
+# Number of failed crawls after which we give up on an app for a while
+MAX_ATTEMPTS = 5
+# Seconds to wait before the first retry; doubles with each failed attempt
+BASE_DELAY = 60
+# Longest we'll ever wait before retrying
+MAX_DELAY = 6 * 60 * 60
+# Seconds to leave an app alone once we've given up on it, before trying it again.  It
+# then gets one attempt per GIVE_UP_DELAY until a crawl succeeds.
+GIVE_UP_DELAY = 30 * 24 * 60 * 60
+
+# Count the failure (only the latest error is kept)
+RECORD_FAILURE_QUERY = '''
+INSERT INTO {retry_table} AS cr (steam_app_id, attempts, next_attempt, last_error)
+VALUES (%(app_id)s, 1, now(), %(last_error)s)
+ON CONFLICT (steam_app_id) DO UPDATE
+  SET attempts = cr.attempts + 1,
+      last_error = EXCLUDED.last_error
+RETURNING attempts
+'''.format(retry_table=RETRY_TABLE)
+
+# Count a crawl which failed because steam was throttling us, separately from attempts
+RECORD_THROTTLE_QUERY = '''
+INSERT INTO {retry_table} AS cr (steam_app_id, attempts, throttles, next_attempt, last_error)
+VALUES (%(app_id)s, 0, 1, now(), %(last_error)s)
+ON CONFLICT (steam_app_id) DO UPDATE
+  SET throttles = cr.throttles + 1,
+      last_error = EXCLUDED.last_error
+RETURNING throttles
+'''.format(retry_table=RETRY_TABLE)
+
+# Schedule a retry without counting an attempt
+RESCHEDULE_QUERY = '''
+INSERT INTO {retry_table} AS cr (steam_app_id, attempts, next_attempt, last_error)
+VALUES (%(app_id)s, 0, now() + %(delay)s * interval '1 second', %(last_error)s)
+ON CONFLICT (steam_app_id) DO UPDATE
+  SET next_attempt = EXCLUDED.next_attempt,
+      last_error = EXCLUDED.last_error
+'''.format(retry_table=RETRY_TABLE)
+
+
+def _error_text(error):
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+class RetryQueue:
+    '''
+    Tracks failed crawl attempts per app in the database and schedules retries with
+    exponential delay.  Attempts are counted in the database, so crawlers sharing it
+    (ex. claiming from the shared job queue) count them together.
+
+    Failures must be recorded from a single thread (the one writing to the DB), but
+    any thread can take due retries off the queue.
+
+    If retry_locally is False, retries are only scheduled in the database, for whichever
+    crawl gets to the app once it's due (ex. a crawler on another machine claiming it
+    from the shared job queue); nothing ever comes off this queue.
+    '''
+
+    def __init__(self, db, *, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 give_up_delay=GIVE_UP_DELAY, retry_locally=True):
+        self.db = db
+        self.retry_locally = retry_locally
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.give_up_delay = give_up_delay
+        # Heap of (time.time() the retry is due, app ID) for retries due during this run
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.db.begin()
+        try:
+            yield self.db.executable.connection.cursor()
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def _schedule(self, cursor, app_id, delay, error):
+        cursor.execute(RESCHEDULE_QUERY, {'app_id': app_id, 'delay': delay, 'last_error': _error_text(error)})
+        if self.retry_locally and delay < self.give_up_delay:
+            with self._lock:
+                heapq.heappush(self._pending, (time.time() + delay, app_id))
+
+    def _record_failure(self, cursor, app_id, error):
+        cursor.execute(RECORD_FAILURE_QUERY, {'app_id': app_id, 'last_error': _error_text(error)})
+        attempts, = cursor.fetchone()
+
+        if attempts >= self.max_attempts:
+            delay = self.give_up_delay
+        else:
+            # Add some jitter so retries of apps which failed together don't all come due together
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(1, 1.25)
+        self._schedule(cursor, app_id, delay, error)
+        return delay < self.give_up_delay
+
+    def record_failure(self, app_id, error):
+        '''
+        Record a failed crawl for the app and schedule a retry, unless we've tried too many
+        times already, in which case the app is left alone for give_up_delay.
+
+        Return value: whether the app will be retried before then
+        '''
+        with self._transaction() as cursor:
+            return self._record_failure(cursor, app_id, error)
+
+    def record_throttle(self, app_id, error, delay):
+        '''
+        Schedule a retry for an app whose crawl failed because steam was throttling us (or
+        timed out), after the given number of seconds.  These usually aren't the app's
+        fault, so they don't count as attempts, at first.  Once the app has been throttled
+        max_attempts times, though, it's probably the app (ex. its page always times out),
+        so from then on they count like any other failure (see record_failure()).
+
+        Return value: whether the app will be retried before give_up_delay
+        '''
+        with self._transaction() as cursor:
+            cursor.execute(RECORD_THROTTLE_QUERY, {'app_id': app_id, 'last_error': _error_text(error)})
+            throttles, = cursor.fetchone()
+            if throttles > self.max_attempts:
+                return self._record_failure(cursor, app_id, error)
+
+            self._schedule(cursor, app_id, delay * random.uniform(1, 1.25), error)
+            return True
+
+    def record_successes(self, app_ids):
+        '''
+        Forget about any previous failures for the apps.
+        '''
+        app_ids = list(app_ids)
+        if len(app_ids) > 0:
+            with self._transaction() as cursor:
+                cursor.execute('DELETE FROM {} WHERE steam_app_id = ANY(%(app_ids)s)'.format(RETRY_TABLE),
+                               {'app_ids': app_ids})
+
+    def pop_due(self):
+        '''
+        Return the ID of an app whose retry is due, or None if there aren't any.
+        '''
+        with self._lock:
+            if len(self._pending) > 0 and self._pending[0][0] <= time.time():
+                return heapq.heappop(self._pending)[1]
+        return None
+
+    def seconds_until_next(self):
+        '''
+        Return the number of seconds until the next retry is due, or None if there
+        are no retries scheduled.
+        '''
+        with self._lock:
+            if len(self._pending) == 0:
+                return None
+            return max(0, self._pending[0][0] - time.time())
@@ -0,0 +1,135 @@
+'''
+Decide which apps to crawl next, based on what we've seen in previous crawls.
+'''
+import datetime as dt
+
+from db_utils import query_rows
+from crawl_writer import GAME_CRAWL_TABLE, LATEST_TABLE, STATE_TABLE
+from retry_queue import RETRY_TABLE
+
+# Apps we've never crawled always come first
+NEVER_CRAWLED_PRIORITY = 1e9
+
+# Priorities are in units of "days since we last crawled the app"; the following
+# are bonuses (or weights) on top of that.
+
+# Apps whose last crawl found no store page (redirects, region locks, etc.) rarely grow one
+NO_STORE_PAGE_WEIGHT = 0.1
+# Bonus per log(1 + new reviews per day); apps getting lots of reviews are changing quickly
+REVIEW_VELOCITY_WEIGHT = 10
+# Unreleased apps will eventually get a release date, price, reviews, etc.
+UNRELEASED_BONUS = 30
+
+# Don't bother recrawling apps we crawled more recently than this
+MIN_RECRAWL_AGE = '1 day'
+
+# Number of apps to look up at a time.  Each page is its own query, so we never hold a
+# transaction open (and hold back vacuum on the tables the crawl is writing to) for the
+# whole crawl.
+PAGE_SIZE = 5000
+
+# The latest crawl of each app comes straight from game_latest, and the one before it
+# from a single index lookup per app, so each page costs O(apps) rather than a pass over
+# every crawl we've ever done
+PRIORITY_QUERY = '''
+WITH app_priority AS (
+  SELECT
+    g.steam_app_id,
+    CASE
+      WHEN l.crawl_time IS NULL THEN :never_crawled_priority
+      ELSE
+        -- Staleness; we may have seen the page more recently than our last crawl if it
+        -- hadn't changed
+        EXTRACT(EPOCH FROM CAST(:as_of AS timestamptz) - GREATEST(l.crawl_time, s.last_seen)) / 86400
+          * (CASE WHEN l.game_name IS NULL THEN :no_store_page_weight ELSE 1 END)
+        -- Review velocity: new reviews per day since the previous crawl, or the last
+        -- 30 days' worth of reviews if we've only crawled the app once
+        + :review_velocity_weight * ln(1 + GREATEST(0, COALESCE(
+            (l.reviews_all_time - p.reviews_all_time)
+              / GREATEST(EXTRACT(EPOCH FROM l.crawl_time - p.crawl_time) / 86400, 1),
+            l.reviews_last_30_days / 30.0,
+            0)))
+        -- Unreleased
+        + CASE WHEN l.game_name IS NOT NULL AND l.release_date IS NULL
+            THEN :unreleased_bonus ELSE 0 END
+    END AS priority
+  FROM game g
+    LEFT JOIN {latest_table} l
+      USING (steam_app_id)
+    LEFT JOIN LATERAL (
+      SELECT crawl_time, reviews_all_time
+      FROM {game_crawl_table} pc
+      WHERE pc.steam_app_id = l.steam_app_id
+        AND pc.crawl_time < l.crawl_time
+      ORDER BY pc.crawl_time DESC
+      LIMIT 1
+    ) p ON true
+    LEFT JOIN {state_table} s
+      USING (steam_app_id)
+    LEFT JOIN {retry_table} cr
+      USING (steam_app_id)
+  -- Skip any apps we've given up on for now or which failed recently enough that
+  -- they aren't due for a retry
+  WHERE (cr.steam_app_id IS NULL OR cr.next_attempt <= now())
+    AND (l.crawl_time IS NULL
+         OR (:recrawl AND GREATEST(l.crawl_time, s.last_seen)
+                            < CAST(:as_of AS timestamptz) - CAST(:min_recrawl_age AS interval)))
+)
+SELECT steam_app_id, priority
+FROM app_priority
+-- Pick up after the last page
+WHERE CAST(:after_priority AS double precision) IS NULL
+   OR (priority, steam_app_id) < (:after_priority, :after_app_id)
+-- Newest apps first among the ones we've never crawled
+ORDER BY priority DESC, steam_app_id DESC
+LIMIT :limit
+'''.format(game_crawl_table=GAME_CRAWL_TABLE, latest_table=LATEST_TABLE, retry_table=RETRY_TABLE,
+           state_table=STATE_TABLE)
+
+
+def prioritized_apps(db, *, recrawl=False, limit=None, min_recrawl_age=MIN_RECRAWL_AGE):
+    '''
+    Generate (app ID, priority) for apps to crawl, most important first.
+
+    Apps we've never crawled come first.  If recrawl is True, apps we've already crawled
+    (at least min_recrawl_age ago) follow, prioritized by how stale our data is,
+    how quickly they're picking up reviews, and whether they're unreleased.
+    Only up to limit apps are generated, if given.
+
+    Apps are looked up a page at a time as they're needed, each page with its own short
+    query.  Priorities are all figured as of when we started, so apps keep their place
+    in line while we crawl; apps crawled in the meantime drop out.
+    '''
+    params = {
+        'never_crawled_priority': NEVER_CRAWLED_PRIORITY,
+        'no_store_page_weight': NO_STORE_PAGE_WEIGHT,
+        'review_velocity_weight': REVIEW_VELOCITY_WEIGHT,
+        'unreleased_bonus': UNRELEASED_BONUS,
+        'recrawl': recrawl,
+        'min_recrawl_age': min_recrawl_age,
+        'as_of': dt.datetime.now(dt.timezone.utc),
+        'after_priority': None,
+        'after_app_id': None,
+    }
+
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_size = PAGE_SIZE if remaining is None else min(PAGE_SIZE, remaining)
+        rows = query_rows(db, PRIORITY_QUERY, dict(params, limit=page_size))
+        for app_id, priority in rows:
+            yield app_id, float(priority)
+
+        if len(rows) < page_size:
+            break
+        if remaining is not None:
+            remaining -= len(rows)
+        # Keep the priority exactly as the database had it, so the next page starts right after
+        params['after_app_id'], params['after_priority'] = rows[-1]
+
+
+def prioritized_app_ids(db, **kwargs):
+    '''
+    Same as prioritized_apps, but only generates the app IDs.
+    '''
+    for app_id, _ in prioritized_apps(db, **kwargs):
+        yield app_id
@@ -1,89 +1,106 @@
+import argparse
+import collections
 import requests
 import dataset
 import os
+import signal
 import sys
-import re
-import datetime as dt
 import time
 import traceback
+import threading
+import queue
 from tqdm import tqdm
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException, ElementNotVisibleException, TimeoutException
-from dateutil.parser import parse as dtparse
+from lxml import html as lxml_html
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+
+from api_backend import PRICE_BATCH_SIZE, PriceLookup
+from browser import MAX_DRIVER_MEMORY_MB, PAGES_PER_DRIVER, ManagedDriver
+from crawl_jobs import CLAIM_SIZE, LEASE_SECONDS, CrawlJobQueue, enqueue, job_counts
+from crawl_metrics import NULL_SPAN, CrawlMetrics
+from crawl_writer import BATCH_SIZE, CrawlWriter
+from db_utils import copy_rows
+from http_backend import (FallbackToBrowser, NotModified, Throttled, fetch_store_page, make_session,
+                          parse_store_page_http, wait_for_rate_limit)
+from page_archive import PageArchive
+from retry_queue import GIVE_UP_DELAY, MAX_ATTEMPTS, RetryQueue
+from scheduler import prioritized_app_ids, prioritized_apps
+from store_parser import STORE_BASE_URL, extract_store_page, is_gated
+from throttle import AdaptiveRateController, TokenBucket
 
 # Number of seconds to sleep between crawls
 CRAWL_TIMEOUT = 10
-# Number of timeouts from steam after which we take a long nap (crawl_timeout * 100)
-STEAM_TIMEOUT_THRESHOLD = 5
-
-THIRTY_DAY_REVIEW_REGEX = re.compile(r'^([0-9]+)% of the ([,0-9]+) user reviews in the last 30 days')
-ALL_TIME_REVIEW_REGEX = re.compile(r'^([0-9]+)% of the ([,0-9]+) user reviews for this game')
-DETAILS_BOX_REGEX = re.compile(r'^Title: ([^\n]+)'
-                               r'(?:\nGenre: ([^\n]+))?'
-                               r'(?:\nDeveloper: ([^\n]+))?'
-                               r'(?:\nPublisher: ([^\n]+))?')
-NUM_ACHIEVEMENTS_REGEX = re.compile(r'Includes ([,[0-9]+) Steam Achievements')
-
-FREE_TO_PLAY_PHRASES = frozenset(('free to play', 'free', 'play for free!', 'free demo', 'play for free',
-                                  'free mod', 'play now', 'install theme'))
-FREE_TO_PLAY_REGEXES = frozenset((re.compile('Play .* Demo'),))
-
-# NOTE: Release dates will have punctuation removed before checking
-# against these phrases
-COMING_SOON_PHRASES = frozenset(('coming soon', 'to be announced',
-                                 'tbd', 'when you least expect it', 'tba',
-                                 'скоро', 'not yet available', 'early access soon',
-                                 'eventually', 'coming this year', 'alpha now available',
-                                 'soon', 'early access', 'tba - add to your wishlist',
-                                 'sign up for the close alpha', 'early access coming soon',
-                                 'when its ready', 'free alpha', 'before the second apocalypse',
-                                 'soon™', 'when it is finished', 'when the time comes', 'when its done',
-                                 'wishlist to get notified', ))
-
-# Some release dates are vague ex. "Summer 2017" or "Q2 2016"; map a season/quarter to a month so Python
-# can parse the date
-SEASON_MONTH_MAPPING = {
-    "summer": "july",
-    "spring": "april",
-    "winter": "january",
-    "fall": "october",
-    "q1": "february",
-    "q2": "may",
-    "q3": "august",
-    "q4": "november",
-}
-
-YEAR_REGEX = re.compile(r'(\d{4})')
+# By default, keep the same pace as sleeping between crawls, no matter how many workers we have
+DEFAULT_REQUESTS_PER_SECOND = 1 / CRAWL_TIMEOUT
+# Never slow down past one request per long nap (crawl_timeout * 100), no matter
+# how much steam is throttling us
+MIN_REQUESTS_PER_SECOND = 1 / (CRAWL_TIMEOUT * 100)
+
+# Errors which mean steam is struggling or throttling us, so we should back off
+THROTTLE_ERRORS = (TimeoutException, requests.Timeout, Throttled)
+
+# Ways we know how to fetch store pages:
+#  - selenium drives a real browser, clicking through any gates
+#  - http fetches pages with plain requests, falling back to selenium for pages it can't handle
+#  - api fetches pages like http, but gets full prices from the store's appdetails JSON API,
+#    for many apps per request (see api_backend)
+BACKENDS = ('selenium', 'http', 'api')
+
+APP_LIST_URL = 'http://api.steampowered.com/ISteamApps/GetAppList/v0001/'
 
 
 def upsert_all_apps(db):
     '''
-    Get the full list of steam apps and upsert them in our database
-    on the basis of steam's app ID.
+    Get the full list of steam apps and sync it into our database
+    on the basis of steam's app ID: new apps are added and apps steam
+    has renamed get their new names.
+
+    The list is loaded into a temporary table and merged in a single statement,
+    so this is cheap enough to do before every crawl.
+
+    Return value: (number of apps added, number of apps renamed)
     '''
-    json = requests.get('http://api.steampowered.com/ISteamApps/GetAppList/v0001/').json()
+    start = time.monotonic()
+    json = requests.get(APP_LIST_URL).json()
 
     apps = json['applist']['apps']['app']
+    # The list has the occasional duplicate app ID; go with the last one
+    app_names = {app['appid']: app['name'] for app in apps}
 
     db.begin()
-
-    for app in tqdm(apps):
-        db['game'].upsert({
-            'steam_app_id': app['appid'],
-            'game_name': app['name'],
-        }, keys=['app_id'])
-
-    db.commit()
-
-
-def clean_release_str(str_):
-    '''
-    Apply some cleaning to a string which we've already determined isn't a date in order
-    to more conveniently match it to a list of known phrases
-    '''
-    return (str_.lower().strip()
-            .replace('!', '').replace('.', '').replace('?', '')
-            .replace("'", ''))
+    try:
+        cursor = db.executable.connection.cursor()
+        cursor.execute('''
+        CREATE TEMPORARY TABLE app_list_sync (
+            steam_app_id int PRIMARY KEY,
+            game_name text
+        ) ON COMMIT DROP
+        ''')
+        copy_rows(cursor, 'app_list_sync', ('steam_app_id', 'game_name'), app_names.items())
+
+        # Steam sometimes lists apps without a name; don't let that clobber a name we already have.
+        # xmax is only 0 for newly inserted rows, which lets us tell inserts from updates
+        cursor.execute('''
+        INSERT INTO game (steam_app_id, game_name)
+        SELECT steam_app_id, game_name
+        FROM app_list_sync
+        ON CONFLICT (steam_app_id) DO UPDATE
+          SET game_name = EXCLUDED.game_name
+          WHERE game.game_name IS DISTINCT FROM EXCLUDED.game_name
+            AND EXCLUDED.game_name <> ''
+        RETURNING (xmax = 0) AS inserted
+        ''')
+        changes = [inserted for inserted, in cursor.fetchall()]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    num_added = sum(changes)
+    num_renamed = len(changes) - num_added
+    print('Synced {} apps from steam: {} added, {} renamed in {:.1f}s'.format(
+        len(app_names), num_added, num_renamed, time.monotonic() - start))
+
+    return num_added, num_renamed
 
 
 def pass_through_age_gate(driver):
@@ -134,388 +151,499 @@ def pass_through_nsfw_gate(driver):
         return False
 
 
-def scrape_store_page(driver, app_id):
+def load_store_page(driver, app_id, span=NULL_SPAN, rate_limit=None):
     '''
-    Extract all the information we can from the store page for a given app ID.
+    Load the store page for a given app ID, clicking through any gates.
+    Loading and clicking are timed in the given crawl_metrics.Span.  rate_limit is
+    called before loading the page and before each round of clicking through gates (which
+    loads another page), if given (see http_backend.wait_for_rate_limit()).
 
-    Use the given driver so we don't have to worry about closing it when we exit.
+    Return value: (the URL we ended up at, the page's source, the parsed page)
     '''
-    # TODO (maybe): add "ignore_reason" field to track why we skipped an app
-    results = {'steam_app_id': app_id}
-    store_base_url = "http://store.steampowered.com"
-    app_url = "{}/app/{}".format(store_base_url, app_id)
-    driver.get(app_url)
+    app_url = "{}/app/{}".format(STORE_BASE_URL, app_id)
+    wait_for_rate_limit(rate_limit, span)
+    with span.phase('page_load'):
+        driver.get(app_url)
 
     # We may have to pass through multiple gates; keep going until
-    # the page doesn't match either gate
+    # the page doesn't match either gate.  Check for gates in the snapshot
+    # so we only poke at the browser when there's something to click.
     while True:
-        age_gate_found = pass_through_age_gate(driver)
-        nsfw_gate_found = pass_through_nsfw_gate(driver)
+        url = driver.current_url
+        page_source = driver.page_source
+        with span.phase('html'):
+            root = lxml_html.fromstring(page_source)
 
-        if not (age_gate_found or nsfw_gate_found):
+        if not is_gated(url, root):
             break
 
-    if driver.current_url in (store_base_url, '{}/'.format(store_base_url)):
-        # We were redirected; the app doesn't have a store page.
-        return results
-    elif 'store.steampowered.com/video' in driver.current_url:
-        # This is a trailer for something else; we'll get the actual app later.
-        return results
-    elif 'store.steampowered.com/sale' in driver.current_url:
-        # This redirects to a store sale page for some reason; ignore it.
-        return results
-
-    try:
-        # If this succeeds, the app has no store page; its store page
-        # redirects to its community hub instead.  Skip it.
-        driver.find_element_by_id('AppHubCards')
-        return results
-    except NoSuchElementException:
-        pass
-
-    try:
-        # If this succeeds, we've got a steam store error
-        error_element = driver.find_element_by_id('error_box')
-        error_text = error_element.find_element_by_class_name('error')
-        if error_text.text == 'This item is currently unavailable in your region':
-            # We can't see this app; ignore it
-            return results
-    except NoSuchElementException:
-        pass
-
-    try:
-        # If this succeeds, Chrome is showing us an error
-        error_element = driver.find_element_by_class_name('error-code')
-        if error_element.text == 'ERR_TOO_MANY_REDIRECTS':
-            # Something wonky with the server response for this store page;
-            # it's redirecting infinitely to itself.  Ignore it
-            return results
-    except NoSuchElementException:
-        pass
-
-    # Get the description first, since it tells us whether the app is streaming video
-    # (which means we don't care about it)
-    descriptions = driver.find_elements_by_class_name('game_area_description')
-    for description in descriptions:
-        if description.text.startswith('ABOUT THIS GAME'):
-            results['is_dlc'] = False
-            results['long_description'] = description.text
-        elif description.text.startswith('ABOUT THIS CONTENT'):
-            results['is_dlc'] = True
-            results['long_description'] = description.text
-        elif description.text.startswith('FEATURE LIST'):
-            # This has always been DLC, from what I've seen, but I don't
-            # think we can assume that
-            results['is_dlc'] = None
-            results['long_description'] = description.text
-        elif description.text.startswith('ABOUT THIS SERIES'):
-            # This is streaming video; we don't care about it, so just return
-            return results
-        elif description.text.startswith('ABOUT THIS SOFTWARE'):
-            # This is computer software; ignore it
-            return results
-        elif description.text.startswith('ABOUT THIS VIDEO'):
-            # Video content; ignore it
-            return results
-        elif description.text.startswith('ABOUT THIS HARDWARE'):
-            # Steam hardware; ignore it
-            return results
-    if 'long_description' not in results and len(descriptions) > 0:
-        raise RuntimeError('Unable to parse description for app_id {}'.format(app_id))
-
-    results['game_name'] = (driver
-                            .find_element_by_class_name('apphub_AppName')
-                            .text)
-
-    try:
-        results['short_description'] = (driver
-                                        .find_element_by_class_name('game_description_snippet')
-                                        .text)
-    except NoSuchElementException:
-        # DLC doesn't have a short description
-        pass
-
-    reviews_texts = [element.get_attribute('data-store-tooltip')
-                     for element in (driver
-                                     .find_elements_by_class_name('user_reviews_summary_row'))]
+        wait_for_rate_limit(rate_limit, span)
+        with span.phase('gates'):
+            age_gate_found = pass_through_age_gate(driver)
+            nsfw_gate_found = pass_through_nsfw_gate(driver)
 
-    for text in reviews_texts:
-        thirty_day_match = THIRTY_DAY_REVIEW_REGEX.match(text)
+        if not (age_gate_found or nsfw_gate_found):
+            break
 
-        if thirty_day_match:
-            results['pct_positive_reviews_last_30_days'] = int(thirty_day_match.group(1))
-            results['reviews_last_30_days'] = int(thirty_day_match.group(2).replace(',', ''))
-        else:
-            all_time_match = ALL_TIME_REVIEW_REGEX.match(text)
+    return url, page_source, root
 
-            if all_time_match:
-                results['pct_positive_reviews_all_time'] = int(all_time_match.group(1))
-                results['reviews_all_time'] = int(all_time_match.group(2).replace(',', ''))
 
-    try:
-        raw_date = driver.find_element_by_css_selector('.release_date .date').text
+def scrape_store_page(driver, app_id):
+    '''
+    Extract all the information we can from the store page for a given app ID.
 
-        # Replace seasons with months if needed
-        for season, month in SEASON_MONTH_MAPPING.items():
-            if season in raw_date.lower():
-                raw_date = raw_date.lower().replace(season, month)
+    Use the given driver so we don't have to worry about closing it when we exit.
+    Once we're through any gates, the page is parsed from a single snapshot of its
+    source rather than asking the browser for each field.
+    '''
+    url, _, root = load_store_page(driver, app_id)
+    return extract_store_page(app_id, url, root)
 
-        try:
-            results['release_date'] = dtparse(raw_date)
-        except ValueError:
-            # Failed to parse the date; match it or raise an error
-            if clean_release_str(raw_date) in COMING_SOON_PHRASES:
-                # Don't really have a better way to represent a missing
-                # release date than None
-                results['release_date'] = None
-            # Failing everything else, try to just parse a year out and use that
-            elif YEAR_REGEX.search(raw_date):
-                results['release_date'] = dtparse(YEAR_REGEX.search(raw_date).group(1))
-            elif raw_date.lower().startswith('this'):
-                results['release_date'] = dtparse((raw_date.lower().replace('this', '')
-                                                   .strip() + ' {}'.format(dt.datetime.now().year)))
-            else:
-                raise ValueError('Unable to parse release date for app {}: {}'.format(
-                    app_id, raw_date))
-    except NoSuchElementException:
-        # This app doesn't have a release date for some reason
-        pass
 
-    # There's additional detail about VR stuff here, but we're not worried about that for now
-    details_text = driver.find_elements_by_css_selector('.details_block:not(.vrsupport)')[0].text
-    details_match = DETAILS_BOX_REGEX.match(details_text)
-    results['title'] = details_match.group(1)
-    raw_genre = details_match.group(2)
-    if raw_genre is not None:
-        results['genres'] = raw_genre.split(', ')
-    results['developer'] = details_match.group(3)
-    results['publisher'] = details_match.group(4)
+class StoreScraper:
+    '''
+    Fetches and scrapes store pages with one of our BACKENDS, optionally saving
+    each page to a PageArchive.
 
-    block_titles_texts = [element.text
-                          for element in (driver
-                                          .find_elements_by_class_name('block_title'))]
+    validators is a mapping from app ID to the (ETag, Last-Modified) we last saw for its
+    page, used to make conditional requests over HTTP; it's only ever read.
 
-    for text in block_titles_texts:
-        num_achievements_match = NUM_ACHIEVEMENTS_REGEX.match(text)
+    rate_limit is called before every request to steam, if given (see
+    http_backend.wait_for_rate_limit()); some apps take more than one.
 
-        if num_achievements_match:
-            results['num_achievements'] = int(num_achievements_match.group(1))
+    With the api backend, prices are looked up for claim_size apps at a time; call
+    expect() with the apps about to be scraped so they can be looked up together.
 
-    try:
-        raw_metacritic_score = driver.find_element_by_class_name('score').text
-        if raw_metacritic_score != 'NA':
-            results['metacritic_score'] = int(raw_metacritic_score)
-    except NoSuchElementException:
-        # Some games don't have metascores
-        pass
+    Not thread-safe; each crawl worker gets its own.
+    '''
 
-    try:
-        # Look for prices
-        # NOTE: we'll take the first price available on the page (since
-        # it's impossible to tell which one is for the actual game), so
-        # if a game is only available in a package, we'll record its price
-        # as the price of the package
-        game_area = driver.find_element_by_class_name(
-            'game_area_purchase_game'
-        )
-    except NoSuchElementException:
-        # No price on the page
-        game_area = None
+    def __init__(self, backend, archive=None, validators=None, browser_options=None, rate_limit=None):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend: {}'.format(backend))
+
+        # Set up a driver and re-use it (restarting it now and then) so we don't have to
+        # worry about closing it for each app.  It's only started once we need it, so if
+        # we're fetching over HTTP, it's only ever started for pages the HTTP backend
+        # can't handle.  browser_options are passed on to browser.ManagedDriver.
+        self.backend = backend
+        self.browser = ManagedDriver(**(browser_options or {}))
+        self.session = make_session() if backend in ('http', 'api') else None
+        self.archive = archive
+        self.validators = validators if validators is not None else {}
+        self.rate_limit = rate_limit
+        self.prices = PriceLookup(self.session, rate_limit=rate_limit) if backend == 'api' else None
+        # Number of apps to hand us at a time
+        self.claim_size = PRICE_BATCH_SIZE if backend == 'api' else 1
+
+        # (URL, content hash, backend we got it with) of the page we archived during the last
+        # call to scrape(), if any.  Kept even if scraping fails, so we can re-parse the page later.
+        self.last_page = None
+        # (ETag, Last-Modified) steam sent with the page during the last call to scrape(), if any
+        self.last_validators = None
+
+    def _archive_page(self, url, content, backend, span):
+        if self.archive is not None:
+            with span.phase('archive'):
+                self.last_page = (url, self.archive.store(content), backend)
+
+    def expect(self, app_ids):
+        '''
+        Note the apps we're about to be asked to scrape, in order.
+        '''
+        if self.prices is not None:
+            self.prices.expect(app_ids)
+
+    def scrape(self, app_id, span=NULL_SPAN):
+        '''
+        Scrape the store page for the given app ID, timing each phase (and noting why
+        we skipped the app, if we did) in the given crawl_metrics.Span.
+        '''
+        self.last_page = None
+        self.last_validators = None
+
+        results = self._scrape_page(app_id, span)
+        # Skipped apps have nothing but their ID
+        if self.prices is not None and 'game_name' in results:
+            full_price = self.prices.full_price(app_id, span=span)
+            # The API doesn't say whether an app is free when only asked for prices, so
+            # free apps keep the price from their store page
+            if full_price is not None:
+                results['full_price'] = full_price
+        return results
 
-    if game_area is not None:
-        try:
-            # Check within the "game_area" to avoid getting a DLC price
-            raw_price = game_area.find_element_by_class_name('game_purchase_price').text
-            if raw_price.lower() in FREE_TO_PLAY_PHRASES:
-                price = 0
-            elif any(regex.match(raw_price) for regex in FREE_TO_PLAY_REGEXES):
-                price = 0
-            elif raw_price == 'Third-party':
-                # For all examples thus far, this has meant "free", but I don't think
-                # we can assume that if the source is a 3rd party
-                price = None
-            else:
-                price = float(raw_price.replace('$', ''))
-            results['full_price'] = price
-        except NoSuchElementException:
-            # On sale
+    def _scrape_page(self, app_id, span):
+        if self.session is not None:
+            sent_validators = self.validators.get(app_id)
             try:
-                raw_price = game_area.find_element_by_class_name('discount_original_price').text
-                results['full_price'] = float(raw_price.replace('$', ''))
-            except NoSuchElementException:
-                # There's a "game area" block, but it doesn't have a price
-                # in it (the game is free)
-                pass
-
-    results['game_details'] = []
-    game_details_elements = driver.find_elements_by_class_name('game_area_details_specs')
-    for element in game_details_elements:
-        results['game_details'].append(element.find_element_by_css_selector('.name').text)
-
-    results['tags'] = []
-    try:
-        # Try to get the big list of tags if it's there
-        driver.find_element_by_css_selector('.app_tag.add_button').click()
-        tag_elements = driver.find_elements_by_css_selector('#app_tagging_modal a.app_tag')
-    except (NoSuchElementException, ElementNotVisibleException):
-        # Settle for the short list if not
-        tag_elements = driver.find_elements_by_css_selector('a.app_tag')
-    for element in tag_elements:
-        results['tags'].append(element.text)
-
-    return results
-
-
-def insert_with_mapping(*, db, descrs, entity_table, pk_name, join_table, mapping, app_id, crawl_time):
+                fetched = fetch_store_page(self.session, app_id, validators=sent_validators,
+                                           rate_limit=self.rate_limit, span=span)
+            except NotModified:
+                # What we sent is still good
+                self.last_validators = sent_validators
+                raise
+            if fetched is None:
+                # Something wonky with the server response for this store page;
+                # it's redirecting infinitely to itself.  Ignore it
+                span.set_outcome('redirect_loop')
+                return {'steam_app_id': app_id}
+
+            url, content, self.last_validators = fetched
+            self._archive_page(url, content, self.backend, span)
+            try:
+                return parse_store_page_http(app_id, url, content, span=span)
+            except FallbackToBrowser:
+                # The validators are for the page we couldn't handle (ex. a gate), not the
+                # one the browser gets us; keeping them could get us a 304 for the gate
+                # next time and leave the app unparsed for good
+                self.last_validators = None
+
+        url, page_source, root = self.browser.run(
+            lambda driver: load_store_page(driver, app_id, span=span, rate_limit=self.rate_limit), span=span)
+        # Pages the api backend got with a browser still have API prices in their crawls,
+        # so they can't be replayed like the selenium backend's
+        self._archive_page(url, page_source.encode('utf-8'), 'api' if self.backend == 'api' else 'selenium', span)
+        return extract_store_page(app_id, url, root, span=span)
+
+    def close(self):
+        self.browser.close()
+        if self.session is not None:
+            self.session.close()
+
+
+def do_crawl(app_ids, db, backend='selenium', num_workers=1,
+             requests_per_second=DEFAULT_REQUESTS_PER_SECOND, max_requests_per_second=None,
+             batch_size=BATCH_SIZE, archive=None, metrics=None, browser_options=None):
     '''
-    Given a db connection, some list of description data, a table of entities, the name of the PK,
-    a many-to-many join table for the entities to game crawls,
-    a mapping from descrs to entity table IDs, and an app_id/crawl_time,
-    update the entity table/mapping if necessary and insert
-    the entity in the many-to-many join table.
+    Given an iterable of steam app IDs and a db connection, do a crawl for the app IDs
+    and append the results to our list of crawls in the database.
 
-    Mutates the mapping.
+    app_ids can also be a CrawlJobQueue, in which case we crawl whatever we can claim from
+    the shared queue, marking each job done once its crawl is written (or released for a
+    retry, or failed).  Retries are then left to whichever crawler claims the app once
+    they're due.
+
+    The backend (one of BACKENDS) determines how we fetch store pages.  Pages are
+    fetched by num_workers threads, which share a budget of requests to steam.  The
+    budget starts at requests_per_second and adapts to how steam responds, never
+    going above max_requests_per_second (by default, the starting rate).  All
+    database writes happen on the calling thread, batch_size crawls at a time.
+
+    Failed apps are retried with exponential delay, during this crawl if possible and
+    otherwise on a later one; after MAX_ATTEMPTS failures, we leave them alone for a
+    while (GIVE_UP_DELAY).  Apps which failed because steam was throttling us (or timed
+    out) are retried once we've backed off, and those failures only start counting as
+    attempts after the first MAX_ATTEMPTS of them.
+
+    If given a PageArchive, every page we fetch is saved to it so it can be re-parsed later.
+    browser_options are passed on to each worker's browser.ManagedDriver.
+
+    How long each phase of each app's crawl takes, how each app turned out, and how long
+    each database write takes are recorded in metrics (a CrawlMetrics; we make our own if
+    not given one), and a summary is printed at the end.
     '''
-    for descr in descrs:
-        try:
-            entity_id = mapping[descr]
-        except KeyError:
-            entity_id = db[entity_table].insert({'descr': descr})
-            mapping[descr] = entity_id
-
-        db[join_table].insert({
-            'steam_app_id': app_id,
-            'crawl_time': crawl_time,
-            pk_name: entity_id,
-        })
-
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend: {}'.format(backend))
+
+    if metrics is None:
+        metrics = CrawlMetrics()
+
+    writer = CrawlWriter(db, batch_size=batch_size)
+    jobs = app_ids if isinstance(app_ids, CrawlJobQueue) else None
+
+    if max_requests_per_second is None:
+        max_requests_per_second = requests_per_second
+    rate_controller = AdaptiveRateController(
+        TokenBucket(requests_per_second),
+        min_rate=min(MIN_REQUESTS_PER_SECOND, requests_per_second),
+        max_rate=max_requests_per_second,
+    )
+    retry_queue = RetryQueue(db, retry_locally=jobs is None)
+
+    metrics.add_gauge('requests_per_second', 'Current rate of requests to steam, shared by all workers.',
+                      lambda: rate_controller.rate)
+    metrics.add_gauge('buffered_crawls', 'Crawls waiting to be written to the database.',
+                      lambda: len(writer))
+
+    # Workers pull app IDs off a shared iterator, so app_ids can be lazy
+    app_id_iter = iter(app_ids)
+    app_id_lock = threading.Lock()
+    stop_workers = threading.Event()
+
+    # Bounded so workers can't get too far ahead of our DB writes
+    scraped = queue.Queue(maxsize=num_workers * 2)
+    worker_done = object()
+
+    def next_app_id():
+        while not stop_workers.is_set():
+            # Retries come first, since they've already waited
+            app_id = retry_queue.pop_due()
+            if app_id is not None:
+                return app_id
+
+            with app_id_lock:
+                app_id = next(app_id_iter, None)
+            if app_id is not None:
+                return app_id
+
+            # Nothing new to crawl; wait around for any retries scheduled during this crawl.
+            # Retries scheduled after every worker has stopped are picked up by the next crawl.
+            wait = retry_queue.seconds_until_next()
+            if wait is None:
+                return None
+            stop_workers.wait(min(wait, 1))
+        return None
+
+    def next_app_ids(max_count):
+        # Waits for the first one like next_app_id(), then takes whatever else is ready
+        first = next_app_id()
+        if first is None:
+            return []
+        app_ids = [first]
+        while len(app_ids) < max_count:
+            app_id = retry_queue.pop_due()
+            if app_id is None:
+                with app_id_lock:
+                    app_id = next(app_id_iter, None)
+            if app_id is None:
+                break
+            app_ids.append(app_id)
+        return app_ids
 
-def do_crawl(app_ids, db):
-    '''
-    Given a list of steam app IDs and a db connection, do a crawl for the app IDs
-    and append the results to our list of crawls in the database.
-    '''
-    tag_mapping = {r['descr']: r['tag_id'] for r in db['steam_tag'].find()}
-    detail_mapping = {r['descr']: r['detail_id'] for r in db['steam_game_detail'].find()}
-    genre_mapping = {r['descr']: r['genre_id'] for r in db['steam_genre'].find()}
+    def crawl_worker():
+        scraper = None
+        try:
+            scraper = StoreScraper(backend, archive=archive, validators=writer.validators,
+                                   browser_options=browser_options,
+                                   rate_limit=rate_controller.bucket.acquire)
+            # Apps we've taken to crawl next; some backends scrape apps a few at a time
+            pending = collections.deque()
+            while not stop_workers.is_set():
+                if len(pending) == 0:
+                    pending.extend(next_app_ids(scraper.claim_size))
+                    if len(pending) == 0:
+                        break
+                scraper.expect(pending)
+                app_id = pending.popleft()
+
+                span = metrics.start_span(app_id)
+                try:
+                    results = scraper.scrape(app_id, span=span)
+                    scraped.put((app_id, results, scraper.last_page, scraper.last_validators, span, None))
+                except Exception as e:
+                    scraped.put((app_id, None, scraper.last_page, scraper.last_validators, span, e))
+        finally:
+            if scraper is not None:
+                scraper.close()
+            scraped.put(worker_done)
 
     # Add a handler here to allow us to gracefully save our work and quit
-    # if the user halts a crawl early via Ctrl + C.
+    # if the user halts a crawl early via Ctrl + C: the workers stop once they're done
+    # with the pages they're on, and everything they got is written.  A second Ctrl + C
+    # quits right away.
     # NOTE: since background jobs ignore SIGINT, this has no effect if
     # the script is launched in the background; see
     # http://stackoverflow.com/questions/1112343/how-do-i-capture-sigint-in-python#comment68802096_1112357
-    should_quit = False
-
-    # Set up a driver and re-use it so we don't have to worry about
-    # closing it for each app
-    driver = webdriver.Chrome()
-
-    # Keep track of the number of times steam has timed out our request
-    steam_timeouts = 0
-
-    for app_id in tqdm(app_ids):
-        try:
-            db.begin()
-            if should_quit:
-                break
+    # Signal handlers can only be set from the main thread.
+    previous_sigint_handler = None
+
+    def quit_gracefully(signum, frame):
+        print('Stopping once the pages in progress are done; press Ctrl + C again to stop now',
+              file=sys.stderr)
+        stop_workers.set()
+        signal.signal(signal.SIGINT, previous_sigint_handler)
+
+    if threading.current_thread() is threading.main_thread():
+        previous_sigint_handler = signal.signal(signal.SIGINT, quit_gracefully)
+
+    workers = [threading.Thread(target=crawl_worker, daemon=True) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    running_workers = len(workers)
+    total = len(app_ids) if hasattr(app_ids, '__len__') else None
+
+    def flush():
+        start = time.perf_counter()
+        written, failed = writer.flush()
+        metrics.record_flush(time.perf_counter() - start, len(written), len(failed))
+        retry_queue.record_successes(written)
+        if jobs is not None:
+            jobs.complete(written)
+        for app_id, error in failed:
+            record_failure(app_id, error)
+
+    def record_failure(app_id, error):
+        # Problem app; pass along our failure and continue to the next one
+        print('Failed to load app ID {}; continuing'.format(app_id), file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+        finish_failed(app_id, error, retry_queue.record_failure(app_id, error))
+
+    def finish_failed(app_id, error, will_retry):
+        if not will_retry:
+            print('Giving up on app ID {} for {} days after {} attempts'.format(
+                app_id, GIVE_UP_DELAY // 86400, MAX_ATTEMPTS), file=sys.stderr)
+        if jobs is not None:
+            if will_retry:
+                # The retry's due time is in the retry table; nobody will claim it until then
+                jobs.release([app_id])
+            else:
+                jobs.fail(app_id, error)
+
+    def record_throttle(app_id, error):
+        retry_after = getattr(error, 'retry_after', None)
+        if rate_controller.record_throttle(retry_after):
+            print('Steam is throttling us ({}); slowing down to {:.4f} requests/sec'.format(
+                type(error).__name__, rate_controller.rate), file=sys.stderr)
+        # Usually not the app's fault, so this doesn't count toward giving up on it unless
+        # it keeps happening to this app
+        will_retry = retry_queue.record_throttle(app_id, error, rate_controller.retry_delay(retry_after))
+        finish_failed(app_id, error, will_retry)
 
-            time.sleep(CRAWL_TIMEOUT)
-            try:
-                results = scrape_store_page(driver, app_id)
-            except TimeoutException:
-                steam_timeouts += 1
-                if steam_timeouts >= STEAM_TIMEOUT_THRESHOLD:
-                    print('Reached timeout threshold of {}; taking a long nap.'.format(
-                        STEAM_TIMEOUT_THRESHOLD))
-                    time.sleep(CRAWL_TIMEOUT * 100)
-                continue
-
-            crawl_time = dt.datetime.now()
-            results['crawl_time'] = crawl_time
-
-            # Default to empty list if the results don't contain any of these
-            tags, details, genres = [], [], []
-
-            # Pull the lists off before we insert the main crawl record.
-            # Use sets so we don't try to insert duplicates, if there are any.
-            if 'tags' in results:
-                tags = set(results['tags'])
-                del results['tags']
-            if 'game_details' in results:
-                details = set(results['game_details'])
-                del results['game_details']
-            if 'genres' in results:
-                genres = set(results['genres'])
-                del results['genres']
-
-            db['game_crawl'].insert(results)
-
-            if len(tags) > 0:
-                insert_with_mapping(
-                    db=db,
-                    descrs=tags,
-                    entity_table='steam_tag',
-                    pk_name='tag_id',
-                    join_table='game_crawl_tag',
-                    mapping=tag_mapping,
-                    app_id=app_id,
-                    crawl_time=crawl_time
-                )
-
-            if len(details) > 0:
-                insert_with_mapping(
-                    db=db,
-                    descrs=details,
-                    entity_table='steam_game_detail',
-                    pk_name='detail_id',
-                    join_table='game_crawl_detail',
-                    mapping=detail_mapping,
-                    app_id=app_id,
-                    crawl_time=crawl_time
-                )
-
-            if len(genres) > 0:
-                insert_with_mapping(
-                    db=db,
-                    descrs=genres,
-                    entity_table='steam_genre',
-                    pk_name='genre_id',
-                    join_table='game_crawl_genre',
-                    mapping=genre_mapping,
-                    app_id=app_id,
-                    crawl_time=crawl_time
-                )
-            db.commit()
-        except Exception as e:
-            # Problem app; pass along our failure and continue to the next one
-            print('Failed to load app ID {}; continuing'.format(app_id), file=sys.stderr)
-            traceback.print_exc()
-
-            # Ensure Postgres lets us continue by rolling back the current transaction
-            db.rollback()
-    driver.close()
+    try:
+        with tqdm(total=total) as progress:
+            while running_workers > 0:
+                try:
+                    item = scraped.get(timeout=writer.seconds_until_due())
+                except queue.Empty:
+                    # Nothing new, but we've been sitting on some crawls for a while
+                    flush()
+                    continue
+
+                if item is worker_done:
+                    running_workers -= 1
+                    continue
+
+                app_id, results, page, validators, span, error = item
+                progress.update()
+
+                if error is not None and page is not None:
+                    writer.add_page(app_id, page)
+
+                if isinstance(error, THROTTLE_ERRORS):
+                    record_throttle(app_id, error)
+                    outcome = 'timeout' if isinstance(error, (TimeoutException, requests.Timeout)) else 'throttled'
+                    metrics.finish_span(span, outcome, error=error)
+                elif isinstance(error, NotModified):
+                    rate_controller.record_success()
+                    writer.add_heartbeat(app_id, validators=validators)
+                    metrics.finish_span(span, 'not_modified')
+                elif error is not None:
+                    record_failure(app_id, error)
+                    metrics.finish_span(span, 'error', error=error)
+                else:
+                    rate_controller.record_success()
+                    is_new = writer.add(results, page=page, validators=validators)
+                    # Apps we skipped already say why
+                    if span.outcome is None:
+                        span.set_outcome('crawled' if is_new else 'unchanged')
+                    metrics.finish_span(span)
+
+                if writer.is_due():
+                    flush()
+    finally:
+        stop_workers.set()
+        # Let the workers finish what they're doing so they can clean up their browsers
+        while running_workers > 0:
+            if scraped.get() is worker_done:
+                running_workers -= 1
+        flush()
+        if previous_sigint_handler is not None:
+            signal.signal(signal.SIGINT, previous_sigint_handler)
+        print(metrics.summary(), file=sys.stderr)
 
 
 def run():
+    parser = argparse.ArgumentParser(description='Crawl the steam store.')
+    parser.add_argument('--backend', choices=BACKENDS, default='selenium',
+                        help='How to fetch store pages.  "http" is much faster, but falls back '
+                        'to selenium for pages it can\'t handle.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of store pages to fetch concurrently.')
+    parser.add_argument('--requests-per-second', type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help='Starting rate of requests to the steam store, shared by all workers.  '
+                        'The rate slows down when steam throttles us and recovers as requests succeed.')
+    parser.add_argument('--max-requests-per-second', type=float,
+                        help='Rate of requests to the steam store we\'ll never go over.  Defaults to '
+                        'the starting rate.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Number of crawls to write to the database at a time.')
+    parser.add_argument('--recrawl', action='store_true',
+                        help='Recrawl apps we\'ve already crawled once we\'re through the ones we '
+                        'haven\'t, stalest and fastest-changing first.')
+    parser.add_argument('--limit', type=int,
+                        help='Maximum number of apps to crawl.')
+    parser.add_argument('--skip-app-sync', action='store_true',
+                        help='Don\'t sync the list of apps from steam before crawling.')
+    parser.add_argument('--archive-dir',
+                        help='Save every store page we fetch (compressed) in this directory, so crawls '
+                        'can be re-parsed later with replay.py.')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve metrics on this port at /metrics, in Prometheus\' text format.')
+    parser.add_argument('--metrics-log',
+                        help='Append a line of JSON to this file for every app crawled and every '
+                        'write to the database, with how long each phase took.')
+    parser.add_argument('--show-browser', action='store_true',
+                        help='Run Chrome with a window instead of headless, to watch what it\'s doing.')
+    parser.add_argument('--pages-per-browser', type=int, default=PAGES_PER_DRIVER,
+                        help='Restart Chrome after this many pages, to keep its memory in check.')
+    parser.add_argument('--max-browser-memory', type=int, default=MAX_DRIVER_MEMORY_MB,
+                        help='Restart Chrome once it (with chromedriver) uses more than this many MB.')
+    parser.add_argument('--enqueue', action='store_true',
+                        help='Instead of crawling, add the apps we\'d crawl (same options as a crawl: '
+                        '--recrawl, --limit) to the shared job queue, for crawlers run with --from-queue.')
+    parser.add_argument('--from-queue', action='store_true',
+                        help='Crawl apps claimed from the shared job queue, so several crawlers (ex. on '
+                        'different machines) can split up the work.  Each crawler has its own '
+                        '--requests-per-second.')
+    parser.add_argument('--claim-size', type=int, default=CLAIM_SIZE,
+                        help='Number of jobs to claim from the shared queue at a time.')
+    parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS,
+                        help='Seconds claimed jobs are held without a heartbeat before other '
+                        'crawlers can reclaim them.')
+    args = parser.parse_args()
+
+    if args.enqueue and args.from_queue:
+        parser.error('--enqueue and --from-queue can\'t be used together')
+
     db = dataset.connect(os.environ['POSTGRES_URI'], ensure_schema=False)
 
-    # Since we're not super worried about having an up-to-date list of apps,
-    # run this only if the table is empty
-    if db['game'].count() == 0:
+    # Pick up any new releases before we decide what to crawl.  When crawling from the
+    # queue, whoever filled it already did.
+    if not args.skip_app_sync and not args.from_queue:
         upsert_all_apps(db)
 
-    # For now, just crawl the apps we don't already have
-    missing_crawl_query = '''
-    SELECT g.steam_app_id
-    FROM game g
-      LEFT JOIN game_crawl gc
-        USING (steam_app_id)
-    WHERE gc.steam_app_id IS NULL;
-    '''
+    if args.enqueue:
+        num_queued = enqueue(db, prioritized_apps(db, recrawl=args.recrawl, limit=args.limit))
+        print('Queued {} apps; jobs by status: {}'.format(num_queued, job_counts(db)))
+        return
 
-    missing_app_ids = [r['steam_app_id'] for r in db.query(missing_crawl_query)]
+    if args.from_queue:
+        app_ids = CrawlJobQueue(db, claim_size=args.claim_size, lease_seconds=args.lease_seconds)
+    else:
+        app_ids = prioritized_app_ids(db, recrawl=args.recrawl, limit=args.limit)
 
-    do_crawl(missing_app_ids, db)
+    metrics_log = open(args.metrics_log, 'a') if args.metrics_log else None
+    metrics = CrawlMetrics(log_file=metrics_log)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    try:
+        do_crawl(app_ids, db, backend=args.backend, num_workers=args.workers,
+                 requests_per_second=args.requests_per_second,
+                 max_requests_per_second=args.max_requests_per_second, batch_size=args.batch_size,
+                 archive=PageArchive(args.archive_dir) if args.archive_dir else None,
+                 metrics=metrics, browser_options={
+                     'headless': not args.show_browser,
+                     'pages_per_driver': args.pages_per_browser,
+                     'max_memory_mb': args.max_browser_memory,
+                 })
+    finally:
+        if args.from_queue:
+            app_ids.close()
+        metrics.close()
+        if metrics_log is not None:
+            metrics_log.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,289 @@
+'''
+Columnar snapshot of the crawl data for analysis, so the notebooks don't need a live
+database (or a multi-minute SQL dump) every time a kernel restarts.
+
+Crawls are exported as Parquet files partitioned by crawl date and is_dlc, in
+directories like {snapshot}/crawl_date=2017-05-01/is_dlc=false/.  Each export only
+appends the crawls written since the previous one (including old crawls rewritten by
+replay.py); the watermark is kept in the snapshot directory.  load_snapshot() reads the
+files back (memory-mapped) into the same shape as game_crawl_view.
+'''
+import argparse
+import datetime as dt
+import glob
+import json
+import os
+import tempfile
+import uuid
+
+import dataset
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from crawl_writer import DESCRIPTION_TABLE, ENTITIES, GAME_CRAWL_TABLE
+from db_utils import query_rows, stream_query
+
+# File in the snapshot directory holding the export watermark; the leading underscore
+# keeps Parquet readers from treating it as data
+WATERMARK_FILE = '_watermark.json'
+
+# Crawls' written_at is when the transaction writing them started, which is a little
+# before they're committed, so only export crawls written at least this long ago to avoid
+# skipping any which commit after we've moved the watermark past them
+EXPORT_LAG = dt.timedelta(minutes=10)
+
+# Maximum number of crawls per Parquet file
+ROWS_PER_FILE = 100000
+
+# Columns and types of the exported crawls, in the same order as game_crawl_view, followed
+# by when each crawl was written (to tell which copy of a rewritten crawl is newest)
+SCHEMA = pa.schema([
+    pa.field('steam_app_id', pa.int32()),
+    pa.field('crawl_time', pa.timestamp('us', tz='UTC')),
+    pa.field('game_name', pa.string()),
+    pa.field('short_description', pa.string()),
+    pa.field('is_dlc', pa.bool_()),
+    pa.field('reviews_last_30_days', pa.int32()),
+    pa.field('pct_positive_reviews_last_30_days', pa.float32()),
+    pa.field('reviews_all_time', pa.int32()),
+    pa.field('pct_positive_reviews_all_time', pa.float32()),
+    pa.field('release_date', pa.date32()),
+    pa.field('title', pa.string()),
+    pa.field('developer', pa.string()),
+    pa.field('publisher', pa.string()),
+    pa.field('num_achievements', pa.int32()),
+    pa.field('full_price', pa.float32()),
+    pa.field('long_description', pa.string()),
+    pa.field('metacritic_score', pa.int32()),
+    pa.field('genres', pa.list_(pa.string())),
+    pa.field('details', pa.list_(pa.string())),
+    pa.field('tags', pa.list_(pa.string())),
+    pa.field('written_at', pa.timestamp('us', tz='UTC')),
+])
+
+# Columns with few distinct values, which are loaded dictionary-encoded (as categoricals,
+# or lists of strings sharing one copy of each) rather than a string per value.  Every
+# column is written dictionary-encoded, which Parquet falls back from for columns (like
+# the descriptions) with too many distinct values.
+DICTIONARY_COLUMNS = ['developer', 'publisher', 'genres', 'details', 'tags']
+
+LIST_EXPRESSION = '''(
+    SELECT array_agg(e.descr ORDER BY e.descr)
+    FROM {join_table} j
+      JOIN {entity_table} e
+        USING ({pk_name})
+    WHERE j.steam_app_id = gc.steam_app_id
+      AND j.crawl_time = gc.crawl_time
+  )'''
+
+
+def _list_expression(key):
+    entity_table, pk_name, join_table = ENTITIES[key]
+    return LIST_EXPRESSION.format(join_table=join_table, entity_table=entity_table, pk_name=pk_name)
+
+
+# How to get each exported column that doesn't come straight from the crawl table
+COLUMN_EXPRESSIONS = {
+    'short_description': 'sd.description',
+    'long_description': 'ld.description',
+    'genres': _list_expression('genres'),
+    'details': _list_expression('game_details'),
+    'tags': _list_expression('tags'),
+}
+
+# Crawls written (or rewritten) since the last export, however long ago they were made
+EXPORT_QUERY = '''
+SELECT
+  {columns}
+FROM
+  {game_crawl_table} gc
+    LEFT JOIN {description_table} sd
+      ON sd.description_hash = gc.short_description_hash
+    LEFT JOIN {description_table} ld
+      ON ld.description_hash = gc.long_description_hash
+WHERE (CAST(:since AS timestamptz) IS NULL OR gc.written_at > :since)
+  AND gc.written_at <= :until
+ORDER BY gc.crawl_time
+'''.format(game_crawl_table=GAME_CRAWL_TABLE, description_table=DESCRIPTION_TABLE,
+           columns=',\n  '.join('{} AS {}'.format(COLUMN_EXPRESSIONS.get(name, 'gc.{}'.format(name)), name)
+                                 for name in SCHEMA.names))
+
+
+def partition_dir(crawl_time, is_dlc):
+    '''
+    Return the partition (relative to the snapshot directory) crawls with the given
+    crawl time and is_dlc belong in.
+    '''
+    if is_dlc is None:
+        is_dlc_value = 'null'
+    else:
+        is_dlc_value = 'true' if is_dlc else 'false'
+    return os.path.join('crawl_date={}'.format(crawl_time.astimezone(dt.timezone.utc).date().isoformat()),
+                        'is_dlc={}'.format(is_dlc_value))
+
+
+def read_watermark(snapshot_dir):
+    '''
+    Return the time up to which crawls written to the database have been exported to the
+    snapshot, or None if nothing has been exported yet.
+    '''
+    try:
+        with open(os.path.join(snapshot_dir, WATERMARK_FILE)) as f:
+            return dt.datetime.strptime(json.load(f)['exported_until'], '%Y-%m-%dT%H:%M:%S.%f%z')
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(snapshot_dir, exported_until):
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'exported_until': exported_until.strftime('%Y-%m-%dT%H:%M:%S.%f%z')}, f)
+    os.replace(tmp_path, os.path.join(snapshot_dir, WATERMARK_FILE))
+
+
+def write_partition(snapshot_dir, partition, rows, export_id):
+    '''
+    Write the given crawls (tuples in the same order as SCHEMA) to a new file in the partition.
+    '''
+    columns = list(zip(*rows))
+    table = pa.Table.from_arrays([pa.array(list(values), type=field.type)
+                                  for values, field in zip(columns, SCHEMA)],
+                                 schema=SCHEMA)
+
+    path = os.path.join(snapshot_dir, partition)
+    os.makedirs(path, exist_ok=True)
+
+    # Write to a temporary file and move it into place so nobody ever loads half a file
+    fd, tmp_path = tempfile.mkstemp(dir=path, prefix='_')
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path, use_dictionary=True)
+        os.replace(tmp_path, os.path.join(path, '{}-{}.parquet'.format(export_id, uuid.uuid4().hex)))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def do_export(db, snapshot_dir):
+    '''
+    Append every crawl written since the last export to the snapshot.
+
+    Return value: number of crawls exported
+    '''
+    os.makedirs(snapshot_dir, exist_ok=True)
+    since = read_watermark(snapshot_dir)
+    # Go by the database's clock, which written_at comes from
+    (now,), = query_rows(db, 'SELECT now()')
+    until = now - EXPORT_LAG
+    export_id = until.strftime('%Y%m%dT%H%M%S')
+
+    partitions = {}
+    partition_date = None
+    num_exported = 0
+
+    for row in tqdm(stream_query(db, EXPORT_QUERY, {'since': since, 'until': until})):
+        crawl_time, is_dlc = row[1], row[4]
+        partition = partition_dir(crawl_time, is_dlc)
+
+        # Crawls come in order of crawl time, so once we've moved on to another day
+        # we're done with the previous day's partitions (rewritten old crawls just
+        # get new files in their days' partitions)
+        date = partition.split(os.sep)[0]
+        if date != partition_date:
+            for done_partition, rows in partitions.items():
+                write_partition(snapshot_dir, done_partition, rows, export_id)
+            partitions = {}
+            partition_date = date
+
+        rows = partitions.setdefault(partition, [])
+        rows.append(row)
+        if len(rows) >= ROWS_PER_FILE:
+            write_partition(snapshot_dir, partition, partitions.pop(partition), export_id)
+        num_exported += 1
+
+    for partition, rows in partitions.items():
+        write_partition(snapshot_dir, partition, rows, export_id)
+
+    # Only move the watermark once everything's written; if we die partway through,
+    # the next export rewrites the same crawls and the loader drops the duplicates
+    write_watermark(snapshot_dir, until)
+
+    return num_exported
+
+
+def read_snapshot_file(path, columns=None):
+    '''
+    Read one of the snapshot's files (memory-mapped) as a pyarrow Table, with the
+    DICTIONARY_COLUMNS dictionary-encoded.
+    '''
+    source = pa.memory_map(path)
+    # The list columns' values are in leaf columns like tags.list.element (named
+    # differently by different writers), so look them up in the file
+    schema = pq.ParquetFile(source).schema
+    leaf_paths = [schema.column(i).path for i in range(len(schema))]
+    read_dictionary = [leaf_path for leaf_path in leaf_paths
+                       if leaf_path.split('.')[0] in DICTIONARY_COLUMNS]
+    return pq.read_table(source, columns=columns, read_dictionary=read_dictionary)
+
+
+def load_snapshot(snapshot_dir, *, columns=None, latest_only=True, include_dlc=True,
+                  min_crawl_date=None):
+    '''
+    Load the crawls in the snapshot as a DataFrame indexed by steam_app_id, with the
+    same columns as game_crawl_view (or only the given columns).
+
+    If latest_only is True, only the latest crawl of each app is included, like
+    game_crawl_view; otherwise every crawl is.  include_dlc=False skips crawls of DLC
+    (and of apps we couldn't tell), and min_crawl_date skips crawls made before the given
+    date; both skip the files entirely rather than filtering after loading.
+
+    Developer and publisher come back as categoricals.  A crawl rewritten since it was
+    first exported (ex. by replay.py) is in the snapshot more than once; only its newest
+    copy is loaded.
+    '''
+    if columns is not None:
+        # We need these to pick out the latest crawls
+        columns = ['steam_app_id', 'crawl_time', 'written_at'] + [
+            c for c in columns if c not in ('steam_app_id', 'crawl_time', 'written_at')]
+
+    tables = []
+    for path in sorted(glob.glob(os.path.join(snapshot_dir, 'crawl_date=*', 'is_dlc=*', '*.parquet'))):
+        date_dir, dlc_dir = path.split(os.sep)[-3:-1]
+        if not include_dlc and dlc_dir != 'is_dlc=false':
+            continue
+        if min_crawl_date is not None and date_dir < 'crawl_date={}'.format(min_crawl_date.isoformat()):
+            continue
+        tables.append(read_snapshot_file(path, columns=columns))
+
+    if len(tables) == 0:
+        fields = [SCHEMA.field(name) for name in (columns or SCHEMA.names)]
+        table = pa.Table.from_arrays([pa.array([], type=f.type) for f in fields], schema=pa.schema(fields))
+    else:
+        table = pa.concat_tables(tables)
+
+    df = (table.to_pandas()
+          .sort_values(['steam_app_id', 'crawl_time', 'written_at'])
+          # Crawls rewritten since they were exported, or exported twice by an
+          # interrupted export
+          .drop_duplicates(['steam_app_id', 'crawl_time'], keep='last'))
+    if latest_only:
+        df = df.drop_duplicates('steam_app_id', keep='last')
+
+    return df.drop('written_at', axis=1).set_index('steam_app_id')
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Export crawls made since the last export to a Parquet snapshot.')
+    parser.add_argument('snapshot_dir',
+                        help='Directory holding the snapshot.')
+    args = parser.parse_args()
+
+    db = dataset.connect(os.environ['POSTGRES_URI'], ensure_schema=False)
+
+    num_exported = do_export(db, args.snapshot_dir)
+    print('Exported {} crawls'.format(num_exported))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,472 @@
+'''
+Browser-free extraction of the data we care about from the HTML of a steam store page.
+'''
+import datetime as dt
+import json
+import re
+
+from dateutil.parser import parse as dtparse
+from lxml import html as lxml_html
+
+from crawl_metrics import NULL_SPAN
+
+THIRTY_DAY_REVIEW_REGEX = re.compile(r'^([0-9]+)% of the ([,0-9]+) user reviews in the last 30 days')
+ALL_TIME_REVIEW_REGEX = re.compile(r'^([0-9]+)% of the ([,0-9]+) user reviews for this game')
+DETAILS_BOX_REGEX = re.compile(r'^Title: ([^\n]+)'
+                               r'(?:\nGenre: ([^\n]+))?'
+                               r'(?:\nDeveloper: ([^\n]+))?'
+                               r'(?:\nPublisher: ([^\n]+))?')
+NUM_ACHIEVEMENTS_REGEX = re.compile(r'Includes ([,[0-9]+) Steam Achievements')
+
+# The full list of user tags is embedded in the page as an argument to the JS which
+# builds the "add tags" modal, so we don't have to click anything to get it
+TAG_MODAL_REGEX = re.compile(r'InitAppTagModal\(\s*\d+,\s*(\[.*?\])\s*,', re.DOTALL)
+
+FREE_TO_PLAY_PHRASES = frozenset(('free to play', 'free', 'play for free!', 'free demo', 'play for free',
+                                  'free mod', 'play now', 'install theme'))
+FREE_TO_PLAY_REGEXES = frozenset((re.compile('Play .* Demo'),))
+
+# NOTE: Release dates will have punctuation removed before checking
+# against these phrases
+COMING_SOON_PHRASES = frozenset(('coming soon', 'to be announced',
+                                 'tbd', 'when you least expect it', 'tba',
+                                 'скоро', 'not yet available', 'early access soon',
+                                 'eventually', 'coming this year', 'alpha now available',
+                                 'soon', 'early access', 'tba - add to your wishlist',
+                                 'sign up for the close alpha', 'early access coming soon',
+                                 'when its ready', 'free alpha', 'before the second apocalypse',
+                                 'soon™', 'when it is finished', 'when the time comes', 'when its done',
+                                 'wishlist to get notified', ))
+
+# Some release dates are vague ex. "Summer 2017" or "Q2 2016"; map a season/quarter to a month so Python
+# can parse the date
+SEASON_MONTH_MAPPING = {
+    "summer": "july",
+    "spring": "april",
+    "winter": "january",
+    "fall": "october",
+    "q1": "february",
+    "q2": "may",
+    "q3": "august",
+    "q4": "november",
+}
+
+YEAR_REGEX = re.compile(r'(\d{4})')
+
+STORE_BASE_URL = 'http://store.steampowered.com'
+
+# Elements which start a new line of text when rendered by a browser
+BLOCK_TAGS = frozenset(('address', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'h1', 'h2', 'h3',
+                        'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p', 'pre', 'table', 'tr', 'ul'))
+# Elements whose contents never show up as text
+INVISIBLE_TAGS = frozenset(('script', 'style', 'noscript', 'template'))
+
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+
+class ElementNotFound(LookupError):
+    '''
+    Raised when a store page is missing an element we can't do without.
+    '''
+    pass
+
+
+class StoreErrorPage(RuntimeError):
+    '''
+    Raised when steam served us an error page instead of the app's store page, other
+    than the one saying the app isn't available in our region.
+    '''
+    pass
+
+
+def clean_release_str(str_):
+    '''
+    Apply some cleaning to a string which we've already determined isn't a date in order
+    to more conveniently match it to a list of known phrases
+    '''
+    return (str_.lower().strip()
+            .replace('!', '').replace('.', '').replace('?', '')
+            .replace("'", ''))
+
+
+def parse_release_date(raw_date, app_id):
+    '''
+    Turn the text of a store page's release date into a datetime, or None if the
+    app hasn't been released yet.  Raise ValueError if we can't make sense of it.
+    '''
+    # Replace seasons with months if needed
+    for season, month in SEASON_MONTH_MAPPING.items():
+        if season in raw_date.lower():
+            raw_date = raw_date.lower().replace(season, month)
+
+    try:
+        return dtparse(raw_date)
+    except ValueError:
+        # Failed to parse the date; match it or raise an error
+        if clean_release_str(raw_date) in COMING_SOON_PHRASES:
+            # Don't really have a better way to represent a missing
+            # release date than None
+            return None
+        # Failing everything else, try to just parse a year out and use that
+        elif YEAR_REGEX.search(raw_date):
+            return dtparse(YEAR_REGEX.search(raw_date).group(1))
+        elif raw_date.lower().startswith('this'):
+            return dtparse((raw_date.lower().replace('this', '')
+                            .strip() + ' {}'.format(dt.datetime.now().year)))
+        else:
+            raise ValueError('Unable to parse release date for app {}: {}'.format(
+                app_id, raw_date))
+
+
+def parse_price(raw_price):
+    '''
+    Turn the text of a "game_purchase_price" element into a price.  Free apps are 0,
+    and prices we can't tell anything about are None.
+    '''
+    if raw_price.lower() in FREE_TO_PLAY_PHRASES:
+        return 0
+    elif any(regex.match(raw_price) for regex in FREE_TO_PLAY_REGEXES):
+        return 0
+    elif raw_price == 'Third-party':
+        # For all examples thus far, this has meant "free", but I don't think
+        # we can assume that if the source is a 3rd party
+        return None
+    else:
+        return float(raw_price.replace('$', ''))
+
+
+def _class_predicate(class_name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(class_name)
+
+
+def find_by_class(element, class_name):
+    '''
+    Return all descendants of the element with the given CSS class.
+    '''
+    return element.xpath('.//*[{}]'.format(_class_predicate(class_name)))
+
+
+def find_one_by_class(element, class_name):
+    '''
+    Return the first descendant of the element with the given CSS class, raising
+    ElementNotFound if there isn't one.
+    '''
+    found = element.xpath('(.//*[{}])[1]'.format(_class_predicate(class_name)))
+    if len(found) == 0:
+        raise ElementNotFound('No element with class {}'.format(class_name))
+    return found[0]
+
+
+def find_by_id(element, id_):
+    '''
+    Return the descendant of the element with the given ID, or None.
+    '''
+    found = element.xpath('.//*[@id=$id_]', id_=id_)
+    return found[0] if len(found) > 0 else None
+
+
+def _is_hidden(element):
+    style = element.get('style', '').replace(' ', '').lower()
+    return 'display:none' in style
+
+
+def element_text(element):
+    '''
+    Approximate the text a browser would render for an element (what selenium's
+    WebElement.text gives us): hidden elements and scripts are dropped, whitespace is
+    collapsed, and block-level elements are put on their own lines.
+    '''
+    chunks = []
+
+    def add_text(text):
+        # Source whitespace (including newlines) renders as a single space; only
+        # block-level elements break lines
+        if text:
+            chunks.append(WHITESPACE_REGEX.sub(' ', text))
+
+    def walk(el):
+        if not isinstance(el.tag, str) or el.tag in INVISIBLE_TAGS or _is_hidden(el):
+            return
+        is_block = el.tag in BLOCK_TAGS
+        if is_block:
+            chunks.append('\n')
+        add_text(el.text)
+        for child in el:
+            walk(child)
+            add_text(child.tail)
+        if is_block:
+            chunks.append('\n')
+
+    if isinstance(element.tag, str) and element.tag not in INVISIBLE_TAGS:
+        add_text(element.text)
+        for child in element:
+            walk(child)
+            add_text(child.tail)
+
+    lines = (WHITESPACE_REGEX.sub(' ', line).strip() for line in ''.join(chunks).split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def is_gated(url, root):
+    '''
+    Whether a page is one of steam's age or NSFW gates rather than the actual store page.
+    '''
+    return ('/agecheck/' in url
+            or find_by_id(root, 'agegate_box') is not None
+            or len(find_by_class(root, 'agegate_tags')) > 0)
+
+
+def _description_text(element):
+    # Steam styles the description headers as uppercase; match what we'd see in a browser
+    heading, sep, body = element_text(element).partition('\n')
+    return heading.upper() + sep + body
+
+
+def _parse_tags(root):
+    # Prefer the full list of tags from the tag modal's data if it's there
+    for script in root.xpath('//script[not(@src)]/text()'):
+        tag_modal_match = TAG_MODAL_REGEX.search(script)
+        if tag_modal_match:
+            try:
+                return [tag['name'] for tag in json.loads(tag_modal_match.group(1))]
+            except (ValueError, KeyError, TypeError):
+                break
+
+    # Settle for the short list if not
+    return [element_text(element)
+            for element in root.xpath('//a[{}]'.format(_class_predicate('app_tag')))
+            if not _is_hidden(element)]
+
+
+def parse_store_page(app_id, url, page_html, span=NULL_SPAN):
+    '''
+    Extract all the information we can from the HTML of the store page for a given app ID.
+    The URL is the one we ended up at after any redirects.
+
+    Returns the same results dict as scrape_store_page.
+    '''
+    with span.phase('html'):
+        root = lxml_html.fromstring(page_html)
+    return extract_store_page(app_id, url, root, span=span)
+
+
+def _skip_reason(app_id, url, root):
+    '''
+    Return why we should skip the page if it isn't an actual store page we should extract
+    data from (ex. somewhere steam redirected us, or an error we should ignore), or None
+    if it is.
+    '''
+    if url in (STORE_BASE_URL, '{}/'.format(STORE_BASE_URL)):
+        # We were redirected; the app doesn't have a store page.
+        return 'no_store_page'
+    elif 'store.steampowered.com/video' in url:
+        # This is a trailer for something else; we'll get the actual app later.
+        return 'video'
+    elif 'store.steampowered.com/sale' in url:
+        # This redirects to a store sale page for some reason; ignore it.
+        return 'sale'
+
+    if find_by_id(root, 'AppHubCards') is not None:
+        # The app has no store page; its store page
+        # redirects to its community hub instead.  Skip it.
+        return 'app_hub'
+
+    error_box = find_by_id(root, 'error_box')
+    if error_box is not None:
+        error_texts = [element_text(e) for e in find_by_class(error_box, 'error')]
+        if error_texts[:1] == ['This item is currently unavailable in your region']:
+            # We can't see this app; ignore it
+            return 'region_locked'
+        raise StoreErrorPage('Got an error page for app_id {}: {}'.format(
+            app_id, ' '.join(error_texts)))
+
+    error_codes = [element_text(e) for e in find_by_class(root, 'error-code')]
+    if error_codes[:1] == ['ERR_TOO_MANY_REDIRECTS']:
+        # Something wonky with the server response for this store page;
+        # it's redirecting infinitely to itself.  Ignore it
+        return 'redirect_loop'
+
+    return None
+
+
+def _extract_description(app_id, root, results):
+    '''
+    Extract the long description and whether the app is DLC.
+
+    Return value: why we should skip the app if it's something we don't care about, or None
+    '''
+    descriptions = [_description_text(e) for e in find_by_class(root, 'game_area_description')]
+    for description in descriptions:
+        if description.startswith('ABOUT THIS GAME'):
+            results['is_dlc'] = False
+            results['long_description'] = description
+        elif description.startswith('ABOUT THIS CONTENT'):
+            results['is_dlc'] = True
+            results['long_description'] = description
+        elif description.startswith('FEATURE LIST'):
+            # This has always been DLC, from what I've seen, but I don't
+            # think we can assume that
+            results['is_dlc'] = None
+            results['long_description'] = description
+        elif description.startswith('ABOUT THIS SERIES'):
+            # This is streaming video; we don't care about it
+            return 'series'
+        elif description.startswith('ABOUT THIS SOFTWARE'):
+            # This is computer software; ignore it
+            return 'software'
+        elif description.startswith('ABOUT THIS VIDEO'):
+            # Video content; ignore it
+            return 'video_content'
+        elif description.startswith('ABOUT THIS HARDWARE'):
+            # Steam hardware; ignore it
+            return 'hardware'
+    if 'long_description' not in results and len(descriptions) > 0:
+        raise RuntimeError('Unable to parse description for app_id {}'.format(app_id))
+    return None
+
+
+def _extract_game_name(app_id, root, results):
+    results['game_name'] = element_text(find_one_by_class(root, 'apphub_AppName'))
+
+
+def _extract_short_description(app_id, root, results):
+    try:
+        results['short_description'] = element_text(
+            find_one_by_class(root, 'game_description_snippet'))
+    except ElementNotFound:
+        # DLC doesn't have a short description
+        pass
+
+
+def _extract_reviews(app_id, root, results):
+    reviews_texts = [element.get('data-store-tooltip', '')
+                     for element in find_by_class(root, 'user_reviews_summary_row')]
+
+    for text in reviews_texts:
+        thirty_day_match = THIRTY_DAY_REVIEW_REGEX.match(text)
+
+        if thirty_day_match:
+            results['pct_positive_reviews_last_30_days'] = int(thirty_day_match.group(1))
+            results['reviews_last_30_days'] = int(thirty_day_match.group(2).replace(',', ''))
+        else:
+            all_time_match = ALL_TIME_REVIEW_REGEX.match(text)
+
+            if all_time_match:
+                results['pct_positive_reviews_all_time'] = int(all_time_match.group(1))
+                results['reviews_all_time'] = int(all_time_match.group(2).replace(',', ''))
+
+
+def _extract_release_date(app_id, root, results):
+    release_dates = root.xpath('(//*[{}]//*[{}])[1]'.format(_class_predicate('release_date'),
+                                                           _class_predicate('date')))
+    # Some apps don't have a release date for some reason
+    if len(release_dates) > 0:
+        results['release_date'] = parse_release_date(element_text(release_dates[0]), app_id)
+
+
+def _extract_details_block(app_id, root, results):
+    # There's additional detail about VR stuff here, but we're not worried about that for now
+    details_blocks = root.xpath('//*[{} and not({})]'.format(_class_predicate('details_block'),
+                                                             _class_predicate('vrsupport')))
+    if len(details_blocks) == 0:
+        raise ElementNotFound('No details block for app_id {}'.format(app_id))
+    details_match = DETAILS_BOX_REGEX.match(element_text(details_blocks[0]))
+    results['title'] = details_match.group(1)
+    raw_genre = details_match.group(2)
+    if raw_genre is not None:
+        results['genres'] = raw_genre.split(', ')
+    results['developer'] = details_match.group(3)
+    results['publisher'] = details_match.group(4)
+
+
+def _extract_num_achievements(app_id, root, results):
+    for element in find_by_class(root, 'block_title'):
+        num_achievements_match = NUM_ACHIEVEMENTS_REGEX.match(element_text(element))
+
+        if num_achievements_match:
+            results['num_achievements'] = int(num_achievements_match.group(1))
+
+
+def _extract_metacritic_score(app_id, root, results):
+    try:
+        raw_metacritic_score = element_text(find_one_by_class(root, 'score'))
+        if raw_metacritic_score != 'NA':
+            results['metacritic_score'] = int(raw_metacritic_score)
+    except ElementNotFound:
+        # Some games don't have metascores
+        pass
+
+
+def _extract_full_price(app_id, root, results):
+    # NOTE: we'll take the first price available on the page (since
+    # it's impossible to tell which one is for the actual game), so
+    # if a game is only available in a package, we'll record its price
+    # as the price of the package
+    game_areas = find_by_class(root, 'game_area_purchase_game')
+    if len(game_areas) > 0:
+        game_area = game_areas[0]
+        # Check within the "game_area" to avoid getting a DLC price
+        prices = find_by_class(game_area, 'game_purchase_price')
+        original_prices = find_by_class(game_area, 'discount_original_price')
+        if len(prices) > 0:
+            results['full_price'] = parse_price(element_text(prices[0]))
+        elif len(original_prices) > 0:
+            # On sale
+            results['full_price'] = float(element_text(original_prices[0]).replace('$', ''))
+        # Otherwise there's a "game area" block, but it doesn't have a price
+        # in it (the game is free)
+
+
+def _extract_game_details(app_id, root, results):
+    results['game_details'] = []
+    for element in find_by_class(root, 'game_area_details_specs'):
+        results['game_details'].append(element_text(find_one_by_class(element, 'name')))
+
+
+def _extract_tags(app_id, root, results):
+    results['tags'] = _parse_tags(root)
+
+
+# Extraction of the rest of the fields, once we know the page is a store page we care
+# about, as (name, function taking the app ID, parsed page, and results to fill in)
+FIELD_EXTRACTORS = (
+    ('game_name', _extract_game_name),
+    ('short_description', _extract_short_description),
+    ('reviews', _extract_reviews),
+    ('release_date', _extract_release_date),
+    ('details_block', _extract_details_block),
+    ('num_achievements', _extract_num_achievements),
+    ('metacritic_score', _extract_metacritic_score),
+    ('full_price', _extract_full_price),
+    ('game_details', _extract_game_details),
+    ('tags', _extract_tags),
+)
+
+
+def extract_store_page(app_id, url, root, span=NULL_SPAN):
+    '''
+    Same as parse_store_page, but operates on an already-parsed lxml tree.
+
+    The time taken to extract each field is recorded in the given crawl_metrics.Span, as
+    is the reason we skipped the app, if we did.
+    '''
+    results = {'steam_app_id': app_id}
+
+    with span.phase('store_page_checks'):
+        skip_reason = _skip_reason(app_id, url, root)
+
+    # Get the description first, since it tells us whether the app is streaming video
+    # (which means we don't care about it)
+    if skip_reason is None:
+        with span.phase('field.long_description'):
+            skip_reason = _extract_description(app_id, root, results)
+
+    if skip_reason is not None:
+        span.set_outcome(skip_reason)
+        return results
+
+    for name, extract in FIELD_EXTRACTORS:
+        with span.phase('field.{}'.format(name)):
+            extract(app_id, root, results)
+
+    return results
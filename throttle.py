@@ -0,0 +1,138 @@
+'''
+Tools for keeping the crawl polite to steam no matter how many workers are running.
+'''
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket limiting the rate of requests shared by all crawl workers.
+
+    Tokens accumulate at `rate` per second, up to `burst`; each request takes one.
+    '''
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError('Rate must be positive, got {}'.format(rate))
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Tokens don't accumulate while we're paused
+        start = max(self._last_refill, self._paused_until)
+        if now > start:
+            self._tokens = min(self.burst, self._tokens + (now - start) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        '''
+        Block until a request is allowed.
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self):
+        '''
+        Take a token if one's available right now.
+
+        Return value: whether we got one
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return False
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def pause(self, seconds):
+        '''
+        Stop handing out tokens to anyone for the given number of seconds.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, now + seconds)
+
+
+class AdaptiveRateController:
+    '''
+    Adjusts the rate of a TokenBucket based on how steam responds, AIMD-style: the rate
+    creeps up additively as requests succeed and is cut multiplicatively whenever steam
+    shows signs of throttling us (timeouts, 429s, error pages).
+
+    Thread-safe.
+    '''
+
+    def __init__(self, bucket, *, min_rate, max_rate, increase=None, decrease_factor=0.5,
+                 decrease_interval=30):
+        self.bucket = bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # By default, recover from a single decrease in ~50 successful requests
+        self.increase = increase if increase is not None else max_rate / 100
+        self.decrease_factor = decrease_factor
+        # Requests already in flight when steam starts throttling us will
+        # probably fail too; only back off once for all of them
+        self.decrease_interval = decrease_interval
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def record_success(self):
+        with self._lock:
+            self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
+
+    def record_throttle(self, retry_after=None):
+        '''
+        Back off after steam throttled a request.  If steam told us how long to wait,
+        stop sending requests for that long.
+
+        Return value: whether we backed off (False if we recently did)
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+
+            if (self._last_decrease is not None
+                    and now - self._last_decrease < self.decrease_interval):
+                return False
+
+            self._last_decrease = now
+            self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.decrease_factor))
+            return True
+
+    def retry_delay(self, retry_after=None):
+        '''
+        Return the number of seconds to wait before retrying a throttled request: as long
+        as steam asked us to wait, if it said, and at least one request's worth of time at
+        our backed-off rate.
+        '''
+        return max(retry_after or 0, 1 / self.rate)